@@ -0,0 +1,402 @@
+# === analyse.py ===
+# * Function: offline analysis of recorded olimex-emg-read sessions.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""Batch analysis of recorded sessions.
+
+Every recording given (or found in a directory given: data_*.csv,
+data_*.bin and calibration_data_*.csv) goes through the same DSP as a
+live session - the Channel notch filter, the p-p or RMS envelope, activity
+detection and the spectrum features - and gets one summary row per
+channel. Sessions are shared out over a pool of worker processes:
+    python analyse.py ./data --procs 4 --output summary.csv
+
+Recordings are read --chunk rows at a time (see loadlib), so a session
+never has to fit in memory; --cache keeps a binary copy of each CSV so
+the next run doesn't have to parse it again. The live filter is causal;
+--zero-phase filters forwards and then backwards instead (as scipy's
+filtfilt), which needs the whole filtered signal, so that's kept in a
+temporary file rather than memory.
+
+A channel's activation threshold is the one given with -t, or else
+--rest-factor times the median envelope over the first --rest seconds
+(i.e. the patient resting while the recording starts).
+"""
+
+import os
+import csv
+import glob
+import argparse
+import itertools
+import tempfile
+import multiprocessing
+import numpy as np
+from scipy import signal
+import dsplib
+import loadlib
+import timinglib
+import configlib
+import engine
+
+PATTERNS = ['data_*.csv', 'data_*.bin', 'calibration_data_*.csv']
+COLUMNS = ['session', 'channel', 'samples', 'seconds', 'missed', 'rate',
+           'rms', 'envelope', 'env_mean', 'env_max', 'threshold',
+           'active_pct', 'activations', 'mean_burst_ms', 'mean_freq',
+           'median_freq', 'mdf_slope']  # mdf_slope: Hz per minute
+
+
+def open_session(filename, rows=65536, cache=False):
+    """Open a recording of any kind, to be read in chunks.
+
+    Returns (channels, sampfreq, chunks): channels maps each channel name
+    to its column in the chunks, sampfreq is the SAMP_FREQ the recording
+    says it was made with (binary recordings only, else None), and chunks
+    yields (N, 2 + nchans) int arrays of at most `rows` packets - OCRval,
+    count, then the channels' raw samples.
+    cache: as for loadlib.Session.
+    """
+    session = loadlib.Session(filename, cache)
+    sampfreq = session.meta['sampfreq'] if session.layout == 'binary' else None
+    channels = session.channels
+    if channels is None:  # raw CSVs: named as in the default config
+        cfg = configlib.defaults()
+        configlib.channel_config(cfg, session.nchans)
+        channels = cfg['indices']
+    return channels, sampfreq, session.blocks(rows)
+
+
+class ChannelStats(object):
+    """Envelope, detection and spectrum summary of one channel's session.
+
+    add() takes the filtered signal in order, in blocks of any size; it
+    runs it through the Channel's own history, SpectralAnalyser and
+    ThresholdDetector, keeping running sums only.
+    """
+
+    def __init__(self, ch, threshold=None, rest=0, rest_factor=3.,
+                 hysteresis=0.):
+        """Constructor.
+
+        ch: the engine.Channel to use.
+        threshold: activation threshold, None = from the first rest samples.
+        """
+        self.ch = ch
+        self.step = max(ch.datalen // 2, 1)  # so no spectrum frame is skipped
+        self.rest = rest
+        self.rest_factor = rest_factor
+        self.hysteresis = hysteresis
+        self.threshold = None
+        self.pending = []  # envelope values waiting for a threshold
+        self.waiting = 0  # number of them
+        if threshold is not None:
+            self._set_threshold(threshold)
+        self.n = 0
+        self.sum = self.sumsq = 0.
+        self.env_sum = self.env_max = 0.
+        self.active = 0  # samples active
+        self.activations = 0
+        self.was_active = False
+        self.frames = 0
+        self.mean_freq = self.median_freq = 0.
+        self.fit = np.zeros(5)  # frames, sums of t, f, t*t, t*f: mdf_slope
+
+    def _set_threshold(self, threshold):
+        self.threshold = threshold
+        self.ch.detector.set_thresholds(threshold,
+                                        threshold * (1. - self.hysteresis))
+
+    def add(self, filt):
+        """Take in the next block of filtered samples."""
+        for i in range(0, len(filt), self.step):
+            self._add(filt[i:i + self.step])
+
+    def _add(self, filt):
+        ch = self.ch
+        self.n += len(filt)
+        self.sum += filt.sum()
+        self.sumsq += filt.dot(filt)
+        ch.data.extend(filt)
+        due = ch.spectrum.update(ch.data)
+        if due:
+            spectrum = ch.spectrum
+            mean_freq = spectrum.mean_freq.latest(due)
+            mdf = spectrum.median_freq.latest(due)
+            t = (np.arange(spectrum.frames - due, spectrum.frames)
+                 * spectrum.hop + spectrum.fftlen) / float(ch.sampfreq)
+            self.frames += due
+            self.mean_freq += mean_freq.sum()
+            self.median_freq += mdf.sum()
+            self.fit += [due, t.sum(), mdf.sum(), t.dot(t), t.dot(mdf)]
+        env = ch.detector.envelope_of(filt)
+        self.env_sum += env.sum()
+        self.env_max = max(self.env_max, env.max())
+        if self.threshold is None:
+            self.pending.append(env)
+            self.waiting += len(env)
+            if self.waiting < self.rest:
+                return
+            env = self._settle()
+        self._decide(env)
+
+    def _settle(self):
+        """Set the threshold from the rest envelope; return the envelope."""
+        env = np.concatenate(self.pending)
+        self.pending = []
+        rest = env[:self.rest] if self.rest else env
+        self._set_threshold(self.rest_factor * np.median(rest))
+        return env
+
+    def _decide(self, env):
+        states = self.ch.detector.decide(env)
+        self.active += int(states.sum())
+        rising = np.flatnonzero(np.diff(states.astype(np.int8),
+                                        prepend=int(self.was_active)) == 1)
+        self.activations += len(rising)
+        self.was_active = bool(states[-1])
+
+    def row(self, rate):
+        """The channel's summary, as a dict of COLUMNS (less session)."""
+        if self.threshold is None and self.pending:
+            self._decide(self._settle())  # session shorter than the rest
+        n = max(self.n, 1)
+        mean = self.sum / n
+        frames = max(self.frames, 1)
+        k, st, sf, stt, stf = self.fit
+        slope = (k * stf - st * sf) / (k * stt - st * st) if k > 1 else 0.
+        return {'channel': self.ch.ID,
+                'samples': self.n,
+                'rms': np.sqrt(max(self.sumsq / n - mean * mean, 0.)),
+                'envelope': self.ch.detector.envelope,
+                'env_mean': self.env_sum / n,
+                'env_max': self.env_max,
+                'threshold': self.threshold,
+                'active_pct': 100. * self.active / n,
+                'activations': self.activations,
+                'mean_burst_ms': (1e3 * self.active / rate / self.activations
+                                  if self.activations else 0.),
+                'mean_freq': self.mean_freq / frames,
+                'median_freq': self.median_freq / frames,
+                'mdf_slope': 60. * slope}
+
+
+def _gap_filled(chans, block, diffs, policy):
+    """Each channel's samples with missed packets filled in, (N, nchans)."""
+    out = []
+    for ch in chans:
+        last = ch.raw_Q.last()
+        raw = dsplib.fill_gaps(block[:, ch.idx], diffs, last, policy)
+        ch.raw_Q.extend(raw)
+        out.append(dsplib.hold_nans(raw, last))
+    return np.column_stack(out)
+
+
+def analyse_session(filename, cfg, thresholds=None, zero_phase=False,
+                    rows=65536, rest=2., rest_factor=3., cache=False):
+    """Analyse one recording; return a list of summary rows, one per channel.
+
+    cfg: the main config dict (sampfreq, clock, filter, detection and gap
+    settings).
+    thresholds: dict of channel name -> activation threshold.
+    The whole session is taken at one sample rate, the one the clock gets
+    from its first packet (see timinglib.SampleClock): the filters,
+    detection times, spectrum and every column of the summary use it.
+    """
+    thresholds = thresholds or {}
+    channels, sampfreq, chunks = open_session(filename, rows, cache)
+    cfg = dict(cfg, indices=channels)
+    if sampfreq:
+        cfg['sampfreq'] = sampfreq
+    clock = timinglib.SampleClock(cfg['sampfreq'], cfg['clock'])
+    rate = clock.expected
+    first = next(chunks, None)
+    if first is not None:
+        if cfg['clock'] == 'ocr':
+            rate = timinglib.ocr_rate(int(first[0, 0]), cfg['sampfreq'])
+        chunks = itertools.chain([first], chunks)
+    chans = [engine.Channel(name, cfg, rate)
+             for name in sorted(channels, key=channels.get)]
+    stats = [ChannelStats(ch, thresholds.get(ch.ID), int(rest * rate),
+                          rest_factor, cfg['hysteresis']) for ch in chans]
+    if not zero_phase:
+        for block in chunks:
+            diffs = clock.update(block, now=0.)[0]
+            raw = _gap_filled(chans, block, diffs, cfg['gap_policy'])
+            for i, (ch, st) in enumerate(zip(chans, stats)):
+                st.add(ch.filt.process(raw[:, i]))
+    else:
+        # forwards into a scratch file, backwards over it in place (from the
+        # end, a chunk at a time), then forwards again for the features
+        sos = chans[0].filt.sos
+        zi = None
+        scratch = tempfile.TemporaryFile()
+        n = 0
+        for block in chunks:
+            diffs = clock.update(block, now=0.)[0]
+            raw = _gap_filled(chans, block, diffs, cfg['gap_policy'])
+            if zi is None:  # start in steady state, as filtfilt does
+                zi = signal.sosfilt_zi(sos)[:, :, np.newaxis] * raw[0]
+            out, zi = signal.sosfilt(sos, raw, axis=0, zi=zi)
+            scratch.write(np.ascontiguousarray(out).tobytes())
+            n += len(out)
+        if n:
+            scratch.flush()
+            data = np.memmap(scratch, np.float64, 'r+', 0, (n, len(chans)))
+            zi = signal.sosfilt_zi(sos)[:, :, np.newaxis] * data[-1]
+            for end in range(n, 0, -rows):
+                start = max(end - rows, 0)
+                out, zi = signal.sosfilt(sos, data[start:end][::-1], axis=0,
+                                         zi=zi)
+                data[start:end] = out[::-1]
+            for start in range(0, n, rows):
+                part = np.array(data[start:start + rows])
+                for i, st in enumerate(stats):
+                    st.add(part[:, i])
+            del data
+        scratch.close()
+    session = os.path.basename(filename)
+    seconds = clock.sample / rate
+    summary = []
+    for st in stats:
+        row = st.row(rate)
+        row.update(session=session, seconds=seconds, missed=clock.missed,
+                   rate=rate)
+        summary.append(row)
+    return summary
+
+
+def _analyse_job(job):
+    """Pool worker: analyse_session(*job), or an error message."""
+    try:
+        return job[0], analyse_session(*job), None
+    except Exception as e:  # one bad file mustn't stop the batch
+        return job[0], [], '{}: {}'.format(type(e).__name__, e)
+
+
+def find_sessions(paths):
+    """Recordings among paths, looking inside any directories."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in PATTERNS:
+                files.extend(glob.glob(os.path.join(path, pattern)))
+        else:
+            files.append(path)
+    return sorted(set(files))
+
+
+def run(files, cfg, thresholds=None, procs=None, zero_phase=False,
+        rows=65536, rest=2., rest_factor=3., cache=False):
+    """Analyse files in a pool of procs processes (0 = this one).
+
+    Yields (filename, rows, error) as each session finishes, in order.
+    The other arguments are as for analyse_session.
+    """
+    jobs = [(filename, cfg, thresholds, zero_phase, rows, rest, rest_factor,
+             cache) for filename in files]
+    if procs == 0:
+        for job in jobs:
+            yield _analyse_job(job)
+        return
+    pool = multiprocessing.Pool(procs)
+    try:
+        for result in pool.imap(_analyse_job, jobs):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def format_table(rows):
+    """Summary rows as lines of a fixed-width table."""
+    cols = COLUMNS[1:]
+    cells = [cols] + [[_cell(row[col]) for col in cols] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(cols))]
+    return ['  '.join(cell.rjust(w) for cell, w in zip(line, widths))
+            for line in cells]
+
+
+def _cell(value):
+    if isinstance(value, float):
+        return '{:.2f}'.format(value)
+    return '{}'.format(value)
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs='+',
+                        help="recordings, or directories of them")
+    parser.add_argument("-o", "--output",
+                        help="write all the rows to this CSV")
+    parser.add_argument("-P", "--procs", type=int,
+                        help="worker processes (default: one per CPU, \
+                              0 = none)")
+    parser.add_argument("-t", "--threshold", action="append", default=[],
+                        metavar="CHAN=VALUE",
+                        help="activation threshold for a channel")
+    parser.add_argument("-z", "--zero-phase", action="store_true",
+                        help="filter forwards and backwards (no phase lag)")
+    parser.add_argument("--envelope", choices=["p2p", "rms"],
+                        help="detection envelope (default p2p)")
+    parser.add_argument("--sampfreq", type=int,
+                        help="SAMP_FREQ in the firmware, Hz (default 256; \
+                              binary recordings have their own)")
+    parser.add_argument("--gaps", choices=dsplib.GAP_POLICIES,
+                        help="how to fill in missed packets")
+    parser.add_argument("--rest", type=float, default=2.,
+                        help="seconds at the start taken as rest (default 2)")
+    parser.add_argument("--rest-factor", type=float, default=3.,
+                        help="threshold = this * median rest envelope \
+                              (default 3)")
+    parser.add_argument("--chunk", type=int, default=65536,
+                        help="rows read at a time (default 65536)")
+    parser.add_argument("--cache", action="store_true",
+                        help="keep a binary copy of each CSV next to it, \
+                              so the next run reads that instead")
+    args = parser.parse_args()
+    defaults = configlib.defaults()
+    cfg = dict((key, defaults[key]) for key in
+               engine.Channel.CONFIG_KEYS + ['clock', 'hysteresis'])
+    if args.envelope:
+        cfg['envelope'] = args.envelope
+    if args.sampfreq:
+        cfg['sampfreq'] = args.sampfreq
+    if args.gaps:
+        cfg['gap_policy'] = args.gaps
+    thresholds = {}
+    for item in args.threshold:
+        name, value = item.split('=', 1)
+        thresholds[name] = float(value)
+    files = find_sessions(args.paths)
+    if not files:
+        parser.error('no recordings found')
+    results = []
+    for filename, rows, error in run(files, cfg, thresholds, args.procs,
+                                     zero_phase=args.zero_phase,
+                                     rows=args.chunk, rest=args.rest,
+                                     rest_factor=args.rest_factor,
+                                     cache=args.cache):
+        if error:
+            print 'Skipping {}: {}'.format(filename, error)
+            continue
+        print '\n{} ({:.1f} s, {} missed)'.format(
+            filename, rows[0]['seconds'] if rows else 0.,
+            rows[0]['missed'] if rows else 0)
+        for line in format_table(rows):
+            print line
+        results.extend(rows)
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.DictWriter(f, COLUMNS, lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(results)
+        print 'Wrote {} rows to {}'.format(len(results), args.output)
+
+
+if __name__ == '__main__':
+    _main()
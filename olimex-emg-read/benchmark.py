@@ -0,0 +1,309 @@
+# === benchmark.py ===
+# * Function: benchmarks for the olimex-emg-read hot paths.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""Benchmarks for decoding, filtering, detection and plotting.
+
+Runs headless with no serial port: input comes from a VirtualBoard, or
+from a recording (--recording). Each stage is timed per call at several
+sample rates, channel counts and block sizes, and the results are printed
+(or saved with --output) as JSON so runs can be compared between versions:
+    python benchmark.py --output bench_before.json
+Stages that need something that isn't available here (i.e. Qt for the
+plot stage) are listed as skipped, with the reason.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import numpy as np
+import packetlib as pl
+import dsplib
+import recordlib
+import virtualboard as vb
+import configlib
+import engine
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')  # no window needed
+try:
+    import classes
+    gui_error = None
+except Exception as e:  # missing Qt, pyqtgraph, win32api...
+    classes = None
+    gui_error = '{}: {}'.format(type(e).__name__, e)
+
+RATES = [256, 512, 2048, 8192]
+CHANNELS = [4, 16]
+BLOCKS = [1, 32, 512]  # 1 = per-sample handling
+PROCS = [0, 2, 4]  # DSP worker processes, 0 = in the calling thread
+
+
+def _timed(func, calls):
+    """Call func(i) for each i in calls; return per-call times in seconds."""
+    times = np.empty(len(calls))
+    clock = time.time
+    for n, i in enumerate(calls):
+        t = clock()
+        func(i)
+        times[n] = clock() - t
+    return times
+
+
+def _summary(stage, times, samples, **params):
+    """Build one result record from per-call times."""
+    total = times.sum()
+    result = {'stage': stage,
+              'calls': len(times),
+              'samples': samples,
+              'seconds': total,
+              'samples_per_sec': samples / total if total else None,
+              'us_per_sample': 1e6 * total / samples if samples else None,
+              'latency_us': {'mean': 1e6 * times.mean(),
+                             'p50': 1e6 * np.percentile(times, 50),
+                             'p99': 1e6 * np.percentile(times, 99),
+                             'max': 1e6 * times.max()}}
+    result.update(params)
+    return result
+
+
+def _blocks(n, block):
+    return [(i, min(i + block, n)) for i in range(0, n, block)]
+
+
+def bench_decode(raw, rate, block):
+    """Framing + decoding of raw serial bytes, block packets at a time."""
+    framer = pl.PacketFramer()
+    size = block * pl.PACKET_SIZE
+    chunks = [raw[i:i + size] for i in range(0, len(raw), size)]
+    times = _timed(lambda c: pl.decode_packets(framer.feed(c)), chunks)
+    return _summary('decode', times, framer.packets, rate=rate, block=block)
+
+
+class _Port(object):
+    """Enough of a serial port for Engine to be built without one."""
+    port = baudrate = timeout = None
+    is_open = False
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+
+def _channels(rate, nchans):
+    """Make nchans Channels, cycling over the 4 packet columns."""
+    cfg = configlib.defaults()
+    cfg['sampfreq'] = rate
+    cfg['clock'] = 'nominal'  # rate is the packet rate here, not SAMP_FREQ
+    cfg['datalen'] = 4 * rate
+    names = ['ch{}'.format(i) for i in range(nchans)]
+    cfg['plot_names'] = names
+    cfg['indices'] = dict((n, 2 + i % 4) for i, n in enumerate(names))
+    return cfg, [engine.Channel(n, cfg) for n in names]
+
+
+def bench_filter(rows, rate, nchans, block):
+    """Channel.read_in (gap filling, notch filter, history, spectrum)."""
+    cfg, chans = _channels(rate, nchans)
+    diffs = np.ones(len(rows), np.int32)
+
+    def step(span):
+        for ch in chans:
+            ch.read_in(rows[span[0]:span[1]], diffs[span[0]:span[1]])
+    times = _timed(step, _blocks(len(rows), block))
+    return _summary('filter', times, len(rows) * nchans, rate=rate,
+                    channels=nchans, block=block)
+
+
+def bench_spectrum(rows, rate, nchans):
+    """SpectralAnalyser.update on its own, one frame per call."""
+    cfg, chans = _channels(rate, nchans)
+    for ch in chans:
+        ch.read_in(rows, np.ones(len(rows), np.int32))
+    hop = chans[0].spectrum.hop
+    col = rows[:, 2].astype(np.float64)
+
+    def step(i):
+        for ch in chans:
+            ch.data.extend(col[i * hop:(i + 1) * hop])
+            ch.spectrum.update(ch.data)
+    calls = range(max(len(rows) // hop, 1))
+    return _summary('spectrum', _timed(step, calls), len(calls) * nchans,
+                    rate=rate, channels=nchans, fftlen=chans[0].spectrum.fftlen)
+
+
+def bench_procs(rows, rate, nchans, block, procs):
+    """All of the channels' DSP, in the calling thread or in worker processes."""
+    cfg, chans = _channels(rate, nchans)
+    diffs = np.ones(len(rows), np.int32)
+    dsp = engine.ProcessDSP(chans, procs) if procs else None
+
+    def step(span):
+        args = rows[span[0]:span[1]], diffs[span[0]:span[1]]
+        if dsp is not None:
+            dsp.process(*args)
+        else:
+            for ch in chans:
+                ch.read_in(*args)
+    try:
+        times = _timed(step, _blocks(len(rows), block))
+    finally:
+        if dsp is not None:
+            dsp.close()
+    return _summary('dsp', times, len(rows) * nchans, rate=rate,
+                    channels=nchans, block=block, procs=procs)
+
+
+def _engine(rate, nchans):
+    """An Engine with nchans channels and no serial port."""
+    return engine.Engine(_channels(rate, nchans)[0], None, None, ser=_Port())
+
+
+def bench_detect(rows, rate, nchans, block, threshold=100.):
+    """Channel.detect and Engine.update_states: per-sample threshold detection."""
+    emg = _engine(rate, nchans)
+    for name in emg.names:
+        emg.set_threshold(name, threshold)
+    col = rows[:, 2].astype(np.float64)
+
+    def step(span):
+        block = col[span[0]:span[1]]
+        for ch in emg.channels:
+            ch.detect(block)
+        emg.update_states()
+    times = _timed(step, _blocks(len(rows), block))
+    emg.stop()
+    return _summary('detect', times, len(rows) * nchans, rate=rate,
+                    channels=nchans, block=block)
+
+
+def bench_keys(rate, nchans, calls=1000, bindings=64):
+    """Engine.send_keys, without actually pressing anything.
+
+    The channel states go round 16 combinations, so most calls see a
+    change; bindings random rules over the first 4 channels, in 4 groups.
+    """
+    emg = _engine(rate, nchans)
+    engine.kl.use('recording')
+    rng = np.random.RandomState(0)
+    keys = sorted(engine.kl.Base.values())
+    try:
+        emg.key_map = [(keys[i % len(keys)],
+                        dict((name, [None, True, False][rng.randint(3)])
+                             for name in emg.names[:4]),
+                        i % 4, rng.randint(3)) for i in range(bindings)]
+
+        def step(i):
+            emg.bits = i % 16
+            emg.send_keys()
+        times = _timed(step, range(calls))
+    finally:
+        emg.stop()
+        engine.kl.close()
+    return _summary('send_keys', times, calls, rate=rate,
+                    keys=len(emg.key_map))
+
+
+def bench_gui(rows, rate, ticks=100):
+    """DisplayWindow.update_plots, one call per timer tick."""
+    cfg = configlib.defaults()
+    cfg['sampfreq'] = rate
+    cfg['clock'] = 'nominal'
+    cfg['cal'] = []
+    cfg['engine'] = emg = engine.Engine(cfg, None, None, ser=_Port())
+    cfg['handler'] = emg.handler
+    win = classes.DisplayWindow(cfg)
+    win.plot_timer.stop()
+    per_tick = max(rate * cfg['plot_timer_ms'] // 1000, 1)
+    col = rows[:, 2].astype(np.float64)
+
+    def tick(i):
+        start = (i * per_tick) % max(len(col) - per_tick, 1)
+        for plt in win.plot_names:
+            win.data[plt].extend(col[start:start + per_tick])
+        win.update_plots()
+    times = _timed(tick, range(ticks))
+    emg.stop()
+    return _summary('update_plots', times,
+                    ticks * per_tick * len(win.plot_names), rate=rate,
+                    channels=len(win.plot_names))
+
+
+def run(rates=RATES, channels=CHANNELS, blocks=BLOCKS, seconds=2.,
+        recording=None, procs=PROCS):
+    """Run every stage; return lists of result and skipped-stage dicts."""
+    results = []
+    for rate in rates:
+        if recording:
+            rows = recordlib.read_recording(recording)
+        else:
+            board = vb.VirtualBoard(rate, seed=0)
+            rows = pl.decode_packets(board.generate(int(seconds * rate)))
+        raw = pl.encode_packets(rows)
+        for block in blocks:
+            results.append(bench_decode(raw, rate, block))
+            for nchans in channels:
+                results.append(bench_detect(rows, rate, nchans, block))
+        for nchans in channels:
+            for block in blocks:
+                results.append(bench_filter(rows, rate, nchans, block))
+                if block == 1:
+                    continue  # a round trip to another process per sample
+                for n in procs:
+                    results.append(bench_procs(rows, rate, nchans, block, n))
+            results.append(bench_spectrum(rows, rate, nchans))
+            results.append(bench_keys(rate, nchans))
+        if classes is not None:
+            results.append(bench_gui(rows, rate))
+    skipped = []
+    if classes is None:
+        skipped.append({'stage': 'update_plots', 'reason': gui_error})
+    return results, skipped
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rates", type=int, nargs='+', default=RATES)
+    parser.add_argument("--channels", type=int, nargs='+', default=CHANNELS)
+    parser.add_argument("--blocks", type=int, nargs='+', default=BLOCKS)
+    parser.add_argument("--procs", type=int, nargs='+', default=PROCS)
+    parser.add_argument("--seconds", type=float, default=2.,
+                        help="seconds of synthetic data per sample rate")
+    parser.add_argument("--recording", help="use a recorded session as input")
+    parser.add_argument("-o", "--output", help="write JSON here, not stdout")
+    args = parser.parse_args()
+    stdout = sys.stdout
+    sys.stdout = sys.stderr  # the engine's status messages, not the JSON
+    try:
+        results, skipped = run(args.rates, args.channels, args.blocks,
+                               args.seconds, args.recording, args.procs)
+    finally:
+        sys.stdout = stdout
+    report = {'time': time.time(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'input': args.recording or 'virtualboard',
+              'results': results,
+              'skipped': skipped}
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    _main()
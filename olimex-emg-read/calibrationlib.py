@@ -0,0 +1,217 @@
+# === calibrationlib.py ===
+# * Function: automatic thresholds from a calibration run, for olimex-emg-read.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""A library for working out detection thresholds from a calibration run.
+
+A calibration run takes the patient through a list of patterns (see
+classes.cal_pattern): `repeats` times each, the cued channels are tensed
+for t_on seconds and released for t_off, while the static channels are
+held tensed all the way through. cue_schedule() turns the patterns into
+Steps for a timer to go through. Calibration takes each block of filtered
+samples from the engine and keeps it, in memory, with what every channel
+was meant to be doing at the time: 1 = active, 0 = at rest.
+
+fit() then sorts the samples of every channel into three piles, all at
+once (the first `settle` seconds of every step are left out, as the
+patient reacts to the cue):
+    active     the channel was meant to be active
+    rest       nothing was meant to be active
+    crosstalk  the channel was meant to be at rest, but another wasn't
+and puts the threshold between the top of the rest and crosstalk
+envelopes (95th percentile, less hysteresis) and the bottom of the active
+one (10th percentile). The gap between those two is the channel's margin;
+a channel without enough of one can't be told apart from its neighbours.
+"""
+
+import warnings
+from collections import namedtuple
+import numpy as np
+import dsplib
+
+SETTLE_S = 0.3  # default: seconds left out at the start of every step
+NOISE_PCT = 95  # percentile of rest & crosstalk envelopes to stay above
+ACTIVE_PCT = 10  # percentile of the active envelope to stay below
+
+# one step of the cue schedule: pattern & repeat number, 'on' or 'off',
+# how long it lasts (s) and what each channel should be doing (1/0)
+Step = namedtuple('Step', 'pattern repeat phase duration labels')
+
+
+def cue_schedule(patterns, names):
+    """The Steps to take the patient through patterns, in order."""
+    steps = []
+    for i, pattern in enumerate(patterns):
+        for repeat in range(pattern.repeats):
+            for phase, duration in [('on', pattern.t_on),
+                                    ('off', pattern.t_off)]:
+                labels = dict((name, int(name in pattern.static or
+                                         (phase == 'on' and
+                                          name in pattern.cued)))
+                              for name in names)
+                steps.append(Step(i, repeat, phase, duration, labels))
+    return steps
+
+
+class Calibration(object):
+    """Labelled data from a calibration run, and the thresholds from it.
+
+    on_block() is an Engine subscriber; it only keeps blocks while a step
+    is being cued (see cue()), so the time spent waiting for the user to
+    click through isn't counted as rest.
+    """
+
+    def __init__(self, names, sampfreq, window, envelope='p2p',
+                 settle=SETTLE_S):
+        """Constructor.
+
+        names: channel names, in the order the engine has them.
+        window, envelope: as for the engine's ThresholdDetectors.
+        """
+        self.names = list(names)
+        self.sampfreq = sampfreq
+        self.window = window
+        self.envelope = envelope
+        self.settle = settle
+        self.fits = None  # fit()'s last results, kept for profilelib
+        self.clear()
+
+    def clear(self):
+        """Throw away everything recorded so far."""
+        self.blocks = []  # (filtered samples (N, nchans), labels, step)
+        self.labels = None  # what's being cued now, None = not recording
+        self.step = -1  # steps cued so far, less one
+
+    def cue(self, labels):
+        """Start a new step: labels is a dict of channel name -> 1/0."""
+        self.labels = np.array([labels.get(name, 0) for name in self.names],
+                               np.int8)
+        self.step += 1
+
+    def pause(self):
+        """Stop keeping blocks until the next cue()."""
+        self.labels = None
+
+    def on_block(self, results, changed):
+        """Engine subscriber: keep the block, if a step is being cued."""
+        labels = self.labels
+        if labels is None:
+            return
+        filt = np.column_stack([results[name][1] for name in self.names])
+        self.blocks.append((filt, labels, self.step))
+
+    def samples(self):
+        """Everything kept so far: (filtered, labels, step), one row a sample."""
+        blocks = list(self.blocks)
+        nchans = len(self.names)
+        if not blocks:
+            return (np.zeros((0, nchans)), np.zeros((0, nchans), np.int8),
+                    np.zeros(0, np.int64))
+        filt = np.concatenate([b[0] for b in blocks])
+        lengths = [len(b[0]) for b in blocks]
+        labels = np.repeat(np.array([b[1] for b in blocks]), lengths, axis=0)
+        steps = np.repeat([b[2] for b in blocks], lengths)
+        return filt, labels, steps
+
+    def fit(self, hysteresis=0.):
+        """Work out every channel's threshold.
+
+        hysteresis: as in the config; the channel goes inactive at
+        (1 - hysteresis) * threshold, which has to stay above the noise.
+        Returns a dict of channel name -> dict of:
+            threshold: the threshold, None if there's no data to go on
+            rest, crosstalk, active: the envelope percentiles used
+            crosstalk_from: {other channel: its effect on this one}, the
+                noise percentile while only that channel was active
+            margin: active - max(rest, crosstalk), envelope units
+            ok: True if a threshold fits between the noise (hysteresis
+                and all) and the active envelope
+        """
+        filt, labels, steps = self.samples()
+        n = len(steps)
+        env = dsplib.sliding_envelope(filt, self.window, self.envelope)
+        # samples since the current step started: skip the settling time,
+        # and any envelope reaching back into the step before
+        starts = np.ones(n, bool)
+        starts[1:] = steps[1:] != steps[:-1]
+        since = np.arange(n) - np.maximum.accumulate(
+            np.where(starts, np.arange(n), 0))
+        settled = since >= max(int(self.settle * self.sampfreq),
+                               self.window - 1)
+        valid = settled[:, np.newaxis] & ~np.isnan(env)
+        others = labels.sum(axis=1)[:, np.newaxis] - labels  # others active
+        active = _percentile(env, valid & (labels == 1), ACTIVE_PCT)
+        rest = _percentile(env, valid & (labels == 0) & (others == 0),
+                           NOISE_PCT)
+        crosstalk = _percentile(env, valid & (labels == 0) & (others > 0),
+                                NOISE_PCT)
+        alone = labels.sum(axis=1) == 1  # one channel active, for the matrix
+        from_each = [_percentile(env, valid & (labels == 0) &
+                                 (alone & (labels[:, i] == 1))[:, np.newaxis],
+                                 NOISE_PCT) for i in range(len(self.names))]
+        with warnings.catch_warnings():  # all-NaN: no data for a channel
+            warnings.simplefilter('ignore')
+            noise = np.fmax(rest, crosstalk)
+            # lowest on threshold that keeps the off threshold above the
+            # noise, and the highest that the active envelope still crosses;
+            # aim between them, or for no false alarms if they overlap
+            low = noise / max(1. - hysteresis, 1e-6)
+            threshold = np.where(low < active, (low + active) / 2.,
+                                 np.fmax(low, active))
+            margin = active - noise
+            fits_between = low < active
+        fits = {}
+        for j, name in enumerate(self.names):
+            fits[name] = {
+                'threshold': _value(threshold[j]),
+                'rest': _value(rest[j]),
+                'crosstalk': _value(crosstalk[j]),
+                'active': _value(active[j]),
+                'crosstalk_from': dict(
+                    (other, _value(from_each[i][j]))
+                    for i, other in enumerate(self.names)
+                    if i != j and not np.isnan(from_each[i][j])),
+                'margin': _value(margin[j]),
+                'ok': bool(fits_between[j])}
+        self.fits = fits
+        return fits
+
+
+def _percentile(env, mask, q):
+    """Per-channel percentile q of env where mask is set (NaN if nowhere)."""
+    with warnings.catch_warnings():  # all-NaN columns
+        warnings.simplefilter('ignore')
+        return np.nanpercentile(np.where(mask, env, np.nan), q, axis=0)
+
+
+def _value(x):
+    """A float for the results, None for NaN."""
+    return None if np.isnan(x) else float(x)
+
+
+def format_fits(fits):
+    """fit()'s results as lines of text, one per channel."""
+    lines = []
+    for name in sorted(fits):
+        fit = fits[name]
+        if fit['threshold'] is None:
+            lines.append('{}: no calibration data'.format(name))
+            continue
+        lines.append('{}: threshold {:.1f} (active {}, rest {}, crosstalk {}, '
+                     'margin {})'.format(
+                         name, fit['threshold'],
+                         *[_text(fit[key]) for key in
+                           ['active', 'rest', 'crosstalk', 'margin']]) +
+                     ('' if fit['ok'] else ' - CAN\'T SEPARATE'))
+    return lines
+
+
+def _text(x):
+    return '-' if x is None else '{:.1f}'.format(x)
@@ -17,15 +17,11 @@ Yep.
 from pyqtgraph.Qt import QtGui, QtCore
 import pyqtgraph as pg
 import numpy as np
-from scipy import signal
-from collections import deque
-from threading import Thread
-import threading
-import serial
-import datetime
 import time
 import keylib as kl
-# from functools import partial
+import dsplib
+import calibrationlib
+import profilelib
 
 app = QtGui.QApplication([])  # apparently this is necessary
 
@@ -34,7 +30,6 @@ app = QtGui.QApplication([])  # apparently this is necessary
 #     return np.convolve(x, np.ones((N,))/N)[(N-1):]
 
 
-# unimplemented calibration feature
 class cal_pattern(object):
     """An object to contain parameters for each calibration pattern.
 
@@ -65,19 +60,23 @@ class DisplayWindow(object):
 
         # state variables
         self.docalibration = False
-        self.sendkeys = False
-        self.chanstates = {}
-        for name in cfg['names']:
-            self.chanstates[name] = False
+        self.engine = cfg['engine']  # does the DSP & detection, see engine.py
 
         # keyboard event things
         cfg['keys'] = kl.Base
         self.combo_map = []
         self.selected_keys = []
+        self.selected_groups = []  # exclusive group of each key, 0 = none
+
+        # calibration: labelled data & threshold fitting, see calibrationlib
+        self.calibration = calibrationlib.Calibration(
+            self.engine.names, self.engine.rate, cfg['detect_window'],
+            cfg['envelope'], cfg['calcfg']['settle'])
+        self.engine.subscribe(self.calibration.on_block)
 
         # window & dialog setup
         self.mainwin = QtGui.QMainWindow()
-        self.calibrator = calDialog(cfg, self)  # unimplemented
+        self.calibrator = calDialog(cfg, self)
         self.keyselect = keysDialog(cfg, self)
 
         # set window properties, central widget, layouts, control bar
@@ -87,10 +86,11 @@ class DisplayWindow(object):
         self.mainwin.setCentralWidget(self.central_widget)
         self.mainbar = QtGui.QVBoxLayout()
         self.top_layout = QtGui.QHBoxLayout()
-        self.side_layouts = {'left': QtGui.QVBoxLayout(),
-                             'right': QtGui.QVBoxLayout()}
-        self.top_layout.addLayout(self.side_layouts['left'])
-        self.top_layout.addLayout(self.side_layouts['right'])
+        # plots fill cfg['plot_columns'] columns, in plot_names order
+        self.side_layouts = [QtGui.QVBoxLayout()
+                             for i in range(cfg['plot_columns'])]
+        for layout in self.side_layouts:
+            self.top_layout.addLayout(layout)
         self.top_layout.addLayout(self.mainbar)
         self.central_widget.setLayout(self.top_layout)
 
@@ -103,10 +103,13 @@ class DisplayWindow(object):
         self.mb_widgets['dorecord'].stateChanged.connect(self.chbox_dorecord_changed)
 
         self.mb_widgets['loadcfg'] = QtGui.QPushButton('Load config')
-        # self.mb_widgets['loadcfg'].clicked.connect(self.btn_loadcfg_click)
+        self.mb_widgets['loadcfg'].clicked.connect(self.btn_loadcfg_click)
+
+        self.mb_widgets['savecfg'] = QtGui.QPushButton('Save config')
+        self.mb_widgets['savecfg'].clicked.connect(self.btn_savecfg_click)
 
         self.mb_widgets['cal'] = QtGui.QPushButton('Calibrate')
-        # self.mb_widgets['cal'].clicked.connect(self.btn_cal_click)
+        self.mb_widgets['cal'].clicked.connect(self.btn_cal_click)
 
         self.mb_widgets['sendkeys'] = QtGui.QCheckBox('Send keyboard events')
         self.mb_widgets['sendkeys'].stateChanged.connect(self.chbox_sendkeys_changed)
@@ -114,147 +117,257 @@ class DisplayWindow(object):
         self.mb_widgets['keycfg'] = QtGui.QPushButton('Configure keys')
         self.mb_widgets['keycfg'].clicked.connect(self.btn_keycfg_click)
 
+        # what the plots show: filtered signal, or the spectral stage's output
+        self.views = ['signal', 'spectrum', 'median_freq', 'mean_freq']
+        self.view = 'signal'
+        self.mb_widgets['view'] = QtGui.QComboBox()
+        self.mb_widgets['view'].addItems(['Signal', 'Spectrum',
+                                          'Median freq', 'Mean freq'])
+        self.mb_widgets['view'].currentIndexChanged.connect(self.combo_view_changed)
+
+        # pipeline metrics, see metricslib; refreshed with the title bar
+        self.mb_widgets['status'] = QtGui.QLabel('')
+        self.mb_widgets['status'].setFont(QtGui.QFont('Monospace', 7))
+
         # mainbar layout setup
         self.mainbar.addWidget(self.mb_widgets['streamctl'])
         self.mainbar.addWidget(self.mb_widgets['dorecord'])
         self.mainbar.addSpacing(1)
         self.mainbar.addWidget(self.mb_widgets['loadcfg'])
+        self.mainbar.addWidget(self.mb_widgets['savecfg'])
         self.mainbar.addWidget(self.mb_widgets['cal'])
         self.mainbar.addSpacing(1)
         self.mainbar.addWidget(self.mb_widgets['keycfg'])
         self.mainbar.addWidget(self.mb_widgets['sendkeys'])
+        self.mainbar.addSpacing(1)
+        self.mainbar.addWidget(self.mb_widgets['view'])
         self.mainbar.addStretch(1)
+        self.mainbar.addWidget(self.mb_widgets['status'])
 
         # timers & data structures
         self.plot_timer = QtCore.QTimer()
         self.plot_timer.timeout.connect(self.update_plots)
         plot_names = cfg['plot_names']
         self.plot_names = plot_names
-        plot_colours = {2: (255, 111, 055),
-                        3: (055, 111, 255),
-                        4: (255, 99, 111),
-                        5: (111, 99, 255)}
+        plot_colours = [(255, 111, 055),  # by ADC, round and round
+                        (055, 111, 255),
+                        (255, 99, 111),
+                        (111, 99, 255)]
         # pre-initializing lots of dicts
         self.plotwidgets = {}
         self.plotcontrols = {}
         self.plots = {}
-        self.datalen = 4 * cfg['sampfreq']
+        self.datalen = int(4 * self.engine.rate)
         self.data = {}
-        self.ffts = {}
-        self.fftlen = cfg['sampfreq'] / 4
-        self.fftcount = self.fftlen / 8
-        self.detect_time = {}
-        self.cal_thread = None  # unimplemented
-
-        for plt in plot_names:
+        self.spectra = dict((ch.ID, ch.spectrum) for ch in self.engine.channels)
+        # drawing: signal plots are min/max decimated to the widget's width,
+        # and only redrawn when something new has come in
+        self.decimators = {}
+        self.drawn = {}  # plot -> buffer count / frame number last drawn
+        self.next_title = 0.  # title bar is only updated every title_interval_ms
+        self.newest = self.traced = None  # blocks received / drawn, tracing
+        # lets old data clear the plots before calibration starts
+        self.cal_timer = QtCore.QTimer()
+        self.cal_timer.setSingleShot(True)
+        self.cal_timer.timeout.connect(self.calibrator.on_show)
+
+        for num, plt in enumerate(plot_names):
             # set up the plot area & plot controls & threshold controls
             self.plotwidgets[plt] = pg.PlotWidget(name=plt)
             bar = {}
-            bar['tlabel'] = QtGui.QLabel('Threshold (p-p): ')
+            bar['tlabel'] = QtGui.QLabel('Threshold ({}): '.format(cfg['envelope']))
             bar['tctlbox'] = QtGui.QSpinBox()
             bar['tctlbox'].setRange(0, 1023)
             bar['tctlbox'].setSingleStep(1)
             bar['tctlbox'].setSuffix(' counts')
             bar['tctlbox'].setValue(0)
+            bar['tctlbox'].valueChanged.connect(
+                lambda value, chname=plt: self.threshold_changed(chname, value))
             bar['detected'] = QtGui.QLabel('DETECT', )
             bar['layout'] = QtGui.QHBoxLayout()
             bar['layout'].addWidget(bar['tlabel'])
             bar['layout'].addWidget(bar['tctlbox'])
             bar['layout'].addWidget(bar['detected'])
-            self.detect_time[plt] = 0.0
-            bar['hbox'] = QtGui.QGroupBox('Channel {} (\'{}\' on ADC{}) controls'.format(cfg['names'][plt], plt, (cfg['indices'][plt] - 2)))
+            board, adc = divmod(cfg['indices'][plt] - 2, cfg['board_chans'])
+            if board:
+                adc = '{} of board {}'.format(adc, board)
+            bar['hbox'] = QtGui.QGroupBox('Channel {} (\'{}\' on ADC{}) controls'.format(cfg['names'][plt], plt, adc))
             bar['hbox'].setLayout(bar['layout'])
             self.plotcontrols[plt] = bar
             self.plots[plt] = self.plotwidgets[plt].plot()
-            self.plots[plt].setPen(plot_colours[cfg['indices'][plt]])
-            # if plt.startswith('L'):
-            if plt.startswith('th'):
-                self.side_layouts['left'].addWidget(self.plotwidgets[plt])
-                self.side_layouts['left'].addWidget(bar['hbox'])
-            # elif plt.startswith('R'):
-            elif plt.startswith('fi'):
-                self.side_layouts['right'].addWidget(self.plotwidgets[plt])
-                self.side_layouts['right'].addWidget(bar['hbox'])
-
-            self.data[plt] = deque([0.0]*self.datalen, self.datalen)
-            self.ffts[plt] = np.zeros(self.fftlen / 2)  # len(rfft) = fftlen/2
+            self.plots[plt].setPen(plot_colours[(cfg['indices'][plt] - 2) %
+                                                len(plot_colours)])
+            column = self.side_layouts[num * len(self.side_layouts) //
+                                       len(plot_names)]
+            column.addWidget(self.plotwidgets[plt])
+            column.addWidget(bar['hbox'])
+
+            self.data[plt] = dsplib.RingBuffer(self.datalen)
 
             self.plotwidgets[plt].setRange(yRange=(0., 1024.))
 
         # testing plots by adding sine wave data (?)
-        for i in xrange(0, self.datalen):
-            for plt in plot_names:
-                self.data[plt].appendleft(np.sin(i/10.))
-                if i == self.datalen - 1:
-                    self.plots[plt].setData(self.data[plt])
+        test_wave = np.sin(np.arange(self.datalen) / 10.)
+        for plt in plot_names:
+            self.data[plt].extend(test_wave)
+            self.plots[plt].setData(self.data[plt].latest()[::-1])
 
+        self.engine.subscribe(self.on_block)
         self.plot_timer.start(cfg['plot_timer_ms'])
         self.mainwin.show()
 
+    def on_block(self, results, changed):
+        """Engine subscriber: take in each block of filtered samples.
+
+        Called from the DSP worker thread, so just stash the data.
+        """
+        for plt in self.plot_names:
+            self.data[plt].extend(results[plt][1])
+        if self.engine.tracer is not None:
+            self.newest = self.engine.stamp.sample
+
     def update_plots(self):
-        """Update all plots and perform threshold detection.
+        """Update all plots and show the detection state of each channel.
 
-        Call sendkeys if necesssary.
+        Detection itself happens in the engine, after every block.
         """
+        if self.mainwin.isMinimized() or not self.mainwin.isVisible():
+            return
         title_string = self.cfg['title']
+        now = time.time()
+        metrics = self.engine.metrics
+        do_title = now >= self.next_title
+        if do_title:
+            self.next_title = now + self.cfg['title_interval_ms'] / 1000.
+        states = self.engine.states
+        view = self.view
         for plt in self.plot_names:
-            threshold = self.plotcontrols[plt]['tctlbox'].value()
-            # self.plots[plt].setData(self.ffts[plt])
-            self.plots[plt].setData(self.data[plt])
-            title_string += '\
-                | {0} p-p : {1:.0f}\
-                '.format(plt, np.amax(self.data[plt]) - np.amin(self.data[plt]))
-            # if  time.time() > self.detect_time[plt]:
-            fresh = np.fromiter(self.data[plt], np.float, 64)
-            if (np.amax(fresh) - np.amin(fresh)) > threshold:
-                # self.detect_time[plt] = time.time() + 0.25
+            dec = self._decimator(plt)
+            dec.update(self.data[plt])
+            spectrum = self.spectra[plt]
+            if do_title:
+                title_string += '\
+                    | {0} p-p : {1:.0f} MDF : {2:.0f} Hz\
+                    '.format(plt, dec.peak_to_peak(), spectrum.median_freq.last())
+            if states[plt]:
                 self.plotcontrols[plt]['detected'].setText('DETECT')
-                self.chanstates[plt] = True
-                # print np.amax(self.data[plt])
             else:
                 self.plotcontrols[plt]['detected'].setText('none')
-                self.chanstates[plt] = False
-        self.mainwin.setWindowTitle(title_string)
-        if self.sendkeys:
-            self.send_keys()
+            if self.plotwidgets[plt].visibleRegion().isEmpty():
+                continue  # hidden or scrolled off
+            if view == 'signal':
+                latest = dec.done
+            elif view == 'spectrum':
+                latest = spectrum.mean_freq.count  # one per frame
+            else:
+                latest = getattr(spectrum, view).count
+            if self.drawn.get(plt) == latest:
+                continue  # nothing new
+            self.drawn[plt] = latest
+            if view == 'signal':
+                env = dec.envelope()
+                # newest sample on the left, x in samples
+                self.plots[plt].setData(np.arange(len(env)) * (dec.bucket / 2.),
+                                        env[::-1])
+            elif view == 'spectrum':
+                self.plots[plt].setData(spectrum.freqs, spectrum.power)
+            else:
+                feature = getattr(spectrum, view).latest(copy=True)
+                self.plots[plt].setData(feature[::-1])
+        if do_title:
+            self.mainwin.setWindowTitle(title_string)
+            self.mb_widgets['status'].setText('\n'.join(metrics.status_lines()))
         app.processEvents()  # trigger graphics update
+        metrics.observe('time.plot', time.time() - now)
+        tracer = self.engine.tracer
+        if tracer is not None and self.newest != self.traced:
+            tracer.mark(self.newest, 'plot')
+            self.traced = self.newest
+
+    def _decimator(self, plt):
+        """Return plt's MinMaxDecimator, remade if the plot has been resized."""
+        width = max(self.plotwidgets[plt].width(), 1)
+        bucket = max(-(-self.datalen // width), 1)  # samples per pixel, rounded up
+        dec = self.decimators.get(plt)
+        if dec is None or dec.bucket != bucket:
+            dec = dsplib.MinMaxDecimator(self.datalen // bucket, bucket)
+            self.decimators[plt] = dec
+            self.drawn.pop(plt, None)
+        return dec
+
+    def combo_view_changed(self, index):
+        """Switch all plots between the signal and the spectral views."""
+        self.view = self.views[index]
+        self.drawn = {}  # redraw everything
+        for plt in self.plot_names:
+            widget = self.plotwidgets[plt]
+            if self.view == 'signal':
+                widget.setRange(yRange=(0., 1024.))
+            elif self.view == 'spectrum':
+                widget.enableAutoRange()
+            else:
+                widget.setRange(yRange=(0., self.engine.rate / 2.))
 
     def clear_plots(self):
-        """Convert all plots to flatline.
-
-        There is probably a better way to do this.
-        """
+        """Convert all plots to flatline."""
         for plt in self.plot_names:
-            q = self.data[plt]
-            flatline = q[0]
-            for _ in xrange(0, self.datalen):
-                q.appendleft(flatline)
+            self.data[plt].clear(self.data[plt].last())
         return
 
-    # def threshold_changed(self, chname):
-    #     print chname
-    #     self.thresholds[chname] = self.plotcontrols[chname]['tctlbox'].value()
+    def threshold_changed(self, chname, value):
+        """Pass a new threshold on to the engine."""
+        self.engine.set_threshold(chname, value)
+
+    def update_key_map(self):
+        """Hand the key combos from keysDialog to the engine.
 
-    def send_keys(self):
-        """Check channel states and send keyboard events."""
-        for i in range(0, len(self.selected_keys)):
-            # iterate over the list of keys we're sending
-            Key = self.selected_keys[i]
+        Checked = must be active, Unchecked = must be inactive, else don't care.
+        Within an exclusive group, the key highest up the list wins.
+        """
+        wanted = {QtCore.Qt.CheckState.Checked: True,
+                  QtCore.Qt.CheckState.Unchecked: False}
+        key_map = []
+        for Key, press_cond, group in zip(self.selected_keys, self.combo_map,
+                                          self.selected_groups):
             if Key:  # check if key is not None
-                press_cond = self.combo_map[i]
-                do_press = True
-                for name in self.cfg['names']:
-                    # if so check each channel state against entry in combo_map
-                    # call keyDown if match, keyUp if no match
-                    if press_cond[name] == QtCore.Qt.CheckState.Checked:
-                        do_press = do_press & self.chanstates[name]
-                    elif press_cond[name] == QtCore.Qt.CheckState.Unchecked:
-                        do_press = do_press & (not self.chanstates[name])
-                if do_press:
-                    kl.KeyDown(Key, True)
-                else:
-                    kl.KeyUp(Key, True)
-        return
+                key_map.append((Key, dict((name, wanted.get(state))
+                                          for name, state in press_cond.items()),
+                                group or None, 0))
+        self.engine.key_map = key_map
+
+    def set_key_map(self, key_map):
+        """Show a key map (i.e. from a profile) in keysDialog, and hand it
+        to the engine as it is. Bindings beyond cfg['num_keys'] aren't shown."""
+        states = {True: QtCore.Qt.CheckState.Checked,
+                  False: QtCore.Qt.CheckState.Unchecked}
+        groups = {}  # group -> its number in the dialog
+        for i in range(len(self.combo_map)):
+            Key, press_cond, group = None, {}, None
+            if i < len(key_map):
+                Key, press_cond, group = (tuple(key_map[i]) + (None,))[:3]
+            self.selected_keys[i] = Key
+            self.selected_groups[i] = (0 if group is None else
+                                       groups.setdefault(group, len(groups) + 1))
+            for name in self.combo_map[i]:
+                self.combo_map[i][name] = states.get(
+                    press_cond.get(name), QtCore.Qt.CheckState.PartiallyChecked)
+        self.keyselect.show_stored()
+        self.engine.key_map = list(key_map)
+
+    def load_profile(self, name):
+        """Apply a saved profile's thresholds, key map and calibration.
+
+        The rest of its config only takes effect at startup (--profile).
+        """
+        profile = profilelib.load(name, self.cfg['profile_dir'])
+        for chname, value in profile['thresholds'].items():
+            if chname in self.plotcontrols:
+                self.plotcontrols[chname]['tctlbox'].setValue(int(value))
+                self.engine.set_threshold(chname, value)  # not rounded
+        self.set_key_map(profile['key_map'])
+        self.calibration.fits = profile['calibration']
+        self.cfg['profile'] = name
+        print 'Loaded profile {}'.format(name)
 
     def btn_streamctl_click(self):
         """Start or stop parsing serial data."""
@@ -282,12 +395,33 @@ class DisplayWindow(object):
 
     def chbox_sendkeys_changed(self):
         """Toggle sending keyboard events"""
-        self.sendkeys = self.mb_widgets['sendkeys'].isChecked()
+        self.engine.sendkeys = self.mb_widgets['sendkeys'].isChecked()
 
     def btn_loadcfg_click(self):
-        """Load saved configuration parameters."""
-        # caller = 'loadcfg'
-        raise NotImplementedError('more work to do')
+        """Load a saved profile (see profilelib)."""
+        names = profilelib.profile_names(self.cfg['profile_dir'])
+        if not names:
+            print 'No profiles in {}'.format(self.cfg['profile_dir'])
+            return
+        current = names.index(self.cfg['profile']) \
+            if self.cfg['profile'] in names else 0
+        name, ok = QtGui.QInputDialog.getItem(
+            self.mainwin, 'Load config', 'Patient profile:', names, current,
+            False)
+        if ok:
+            self.load_profile(str(name))
+
+    def btn_savecfg_click(self):
+        """Save the config, thresholds, key map & calibration as a profile."""
+        name, ok = QtGui.QInputDialog.getText(
+            self.mainwin, 'Save config', 'Patient profile:',
+            QtGui.QLineEdit.Normal, self.cfg['profile'] or '')
+        name = str(name).strip()
+        if ok and name:
+            self.cfg['profile'] = name
+            print 'Saved profile to {}'.format(profilelib.save(
+                name, self.cfg, self.engine.thresholds, self.engine.key_map,
+                self.calibration.fits, self.cfg['profile_dir']))
 
     def btn_keycfg_click(self):
         """Open key press config window/dialog."""
@@ -296,13 +430,11 @@ class DisplayWindow(object):
         # raise NotImplementedError('more work to do')
 
     def btn_cal_click(self):
-        """Perform calibration.
-
-        Feature unfinished.
-        """
+        """Start calibration, or stop it (cancelled or finished)."""
         caller = 'cal'
         if not self.docalibration:
             self.docalibration = True
+            self.cfg['handler'].docalibration = True
             self.mb_widgets[caller].setText('click to cancel calibration')
             disable_list = self.mb_widgets.values()
             disable_list.remove(self.mb_widgets[caller])
@@ -316,10 +448,11 @@ class DisplayWindow(object):
         """Reset calibration dialog."""
         caller = 'cal'
         self.docalibration = False
+        self.cfg['handler'].docalibration = False
         self.mb_widgets[caller].setText('click to calibrate')
         self.enable_widgets(self.mb_widgets.values())
         self.cfg['handler'].do_polling = False
-        self.cfg['handler'].nowrite = not self.mb_widgets[caller].isChecked()
+        self.cfg['handler'].nowrite = not self.mb_widgets['dorecord'].isChecked()
 
     def disable_widgets(self, widgets):
         """Disable every widget in a list of widgets."""
@@ -336,34 +469,40 @@ class DisplayWindow(object):
         app.processEvents()
 
     def calibration_handler(self):
-        """Calibration handler."""
+        """Calibration handler.
+
+        Streaming (to a calibration file) starts straight away, and the
+        dialog is let go once the plots have had time to clear.
+        """
         if self.docalibration:
+            self.cfg['handler'].cal_labels = self.calibrator.tests
             self.cfg['handler'].do_polling = True
             self.cfg['handler'].nowrite = False
 
             print 'doing calibration'
-            self.cal_thread = threading.Timer(float(self.datalen / self.cfg['sampfreq']),
-                                              self.calibrator.on_show)
-            self.cal_thread.start()
+            self.calibration.clear()
+            self.calibrator.reset()
+            self.cal_timer.start(int(1000 * self.datalen / self.engine.rate))
             self.calibrator.exec_()
         else:
-            if self.cal_thread:
-                self.cal_thread.cancel()
-                print 'calibration cancelled'
-                self._btn_cal_reset()
+            self.cal_timer.stop()
+            self.calibrator.stop()
+            print 'calibration stopped'
         return
 
-    def _cal_timeout(self):
-        print 'timeout!'
-        self._btn_cal_reset()
-        return
+    def apply_calibration(self, fits):
+        """Set the thresholds from Calibration.fit(), through the spinboxes."""
+        for name, fit in fits.items():
+            if fit['threshold'] is not None and name in self.plotcontrols:
+                self.plotcontrols[name]['tctlbox'].setValue(
+                    int(round(fit['threshold'])))
 
 
-# unimplemented
 class calDialog(QtGui.QDialog):
     """A dialog window for instructing the user through calibration.
 
-    Not yet implemented properly. Unfinished.
+    The cues are run from step_timer, so the GUI (plots and all) carries
+    on while the user follows them.
     """
 
     def __init__(self, cfg, parent=None):
@@ -385,10 +524,9 @@ class calDialog(QtGui.QDialog):
                 ?? Reset button ?? - cancel & restart current pattern
 
             Internal things:
-                Have a thing which outputs to a calibration file OR memory
-                    ---NEEDS to hook into IO_handler functions
-                csv format: x[0], ch03dp, x[1], ch13dp, x[2], ch23dp, x[3], ch33dp,
-                    where x is an array of containing each channel's activation state
+                The cued state of each channel goes to the calibration file
+                (IO_handler.cal_labels) and, with the filtered samples, to the
+                parent's Calibration, which fits the thresholds at the end.
         """
         self.parent = parent
         super(calDialog, self).__init__(parent.mainwin)
@@ -444,16 +582,40 @@ class calDialog(QtGui.QDialog):
         self.buttonBox.button(QtGui.QDialogButtonBox.Ok).setEnabled(False)
 
         self.cfg = cfg
-        self.tests ={}
+        self.tests ={}  # channel -> cued state, for the calibration file
         for ID in cfg['indices']:
             # self.tests[ID] = cfg['indices'][ID] % 2
             self.tests[ID] = 0
+        self.steps = []  # what's left of the current pattern's cue schedule
+        self.step_timer = QtCore.QTimer(self)
+        self.step_timer.setSingleShot(True)
+        self.step_timer.timeout.connect(self.next_step)
         # self.show()
 
+    def reset(self):
+        """Back to the first pattern, waiting for on_show()."""
+        self.stop()
+        self.pattern_idx = 0
+        self.buttonBox.button(QtGui.QDialogButtonBox.Ok).setEnabled(False)
+        self.instructions.setText('purging queue')
+        self.prompt.setText('Please wait...')
+        self.textBox.moveCursor(QtGui.QTextCursor.Start,
+                                QtGui.QTextCursor.MoveAnchor)
+        self.textBox.moveCursor(QtGui.QTextCursor.EndOfLine,
+                                QtGui.QTextCursor.KeepAnchor)
+
+    def stop(self):
+        """Stop cueing; nothing's labelled active any more."""
+        self.step_timer.stop()
+        self.steps = []
+        self.parent.calibration.pause()
+        for key in self.tests:
+            self.tests[key] = 0
+
     def on_show(self):
         """Activate buttons and labels appropriately.
 
-        Should be called in a timer thread straight after QDialog exec.
+        Called by the parent's cal_timer straight after QDialog exec.
         Timeout should be long enough to flush entire queue.
         = datalen / sampfreq"""
         self.buttonBox.button(QtGui.QDialogButtonBox.Ok).setEnabled(True)
@@ -467,11 +629,8 @@ class calDialog(QtGui.QDialog):
         self.reject()
 
     def btn_ok_click(self):
-        print 'ok clicked'
+        """Start cueing the next pattern; after the last, set the thresholds."""
         if self.pattern_idx < len(self.patterns):
-            # self.tests = {}
-            repeat_count = 0
-            prompt_end = '/' + str(self.repeats)
             curr_pattern = self.patterns[self.pattern_idx]
             self.move_box_selection(self.textBox)
             self.buttonBox.button(QtGui.QDialogButtonBox.Ok).setEnabled(False)
@@ -480,55 +639,52 @@ class calDialog(QtGui.QDialog):
             else:
                 instruct_text = self.instruction_strings[1] + str(curr_pattern.cued)
             self.instructions.setText(instruct_text)
-            app.processEvents()
-            for ID in self.cfg['indices']:
-                if ID in curr_pattern.cued:
-                    print 'cueing' + ID + ', ',
-                if ID in curr_pattern.static:
-                    self.tests[ID] = 1
-                    print 'holding ' + ID + ', ',
-                else:
-                    self.tests[ID] = 0
-            print ''
-            # time.sleep(self.on_time)
-            # print ' ...release! test {}/{}'.format(self.pattern_idx + 1,
-            #                                        len(self.patterns))
-            # time.sleep(self.off_time)
-            while repeat_count < self.repeats:
-                repeat_count += 1
-                # tense target/s
-                self.prompt.setText(self.prompt_strings[1] + str(repeat_count) + prompt_end)
-                for ID in curr_pattern.cued:
-                    self.tests[ID] = 1
-                app.processEvents()
-                time.sleep(self.on_time)
-                # release target/s
-                self.prompt.setText(self.prompt_strings[2] + str(repeat_count) + prompt_end)
-                for ID in curr_pattern.cued:
-                    self.tests[ID] = 0
-                app.processEvents()
-                time.sleep(self.off_time)
-
-            for key in self.tests:
-                self.tests[key] = 0
-            print 'click ok to do next test'
-            self.buttonBox.button(QtGui.QDialogButtonBox.Ok).setEnabled(True)
-            self.pattern_idx += 1
-            if self.pattern_idx < len(self.patterns):
-                curr_pattern = self.patterns[self.pattern_idx]
-                if curr_pattern.static:
-                    instruct_text = self.instruction_strings[0] + str(curr_pattern.cued) + ', holding ' + str(curr_pattern.static)
-                else:
-                    instruct_text = self.instruction_strings[0] + str(curr_pattern.cued)
-                self.instructions.setText(instruct_text)
-                self.prompt.setText(self.prompt_strings[0])
-            else:
-                self.instructions.setText(self.instruction_strings[2])
-                self.prompt.setText('')
+            print 'calibrating pattern {}/{}'.format(self.pattern_idx + 1,
+                                                     len(self.patterns))
+            self.steps = calibrationlib.cue_schedule([curr_pattern],
+                                                     list(self.cfg['indices']))
+            self.next_step()
         else:
+            calibration = self.parent.calibration
+            calibration.sampfreq = self.parent.engine.rate  # for the settle time
+            fits = calibration.fit(self.cfg['hysteresis'])
+            for line in calibrationlib.format_fits(fits):
+                print line
+            self.parent.apply_calibration(fits)
             self.parent.btn_cal_click()
             self.accept()
 
+    def next_step(self):
+        """Cue the next tense/release step (step_timer calls this)."""
+        if not self.steps:
+            self.pattern_done()
+            return
+        step = self.steps.pop(0)
+        prompt = self.prompt_strings[1 if step.phase == 'on' else 2]
+        self.prompt.setText(prompt + '{}/{}'.format(step.repeat + 1,
+                                                    self.repeats))
+        self.tests.update(step.labels)  # for the calibration file
+        self.parent.calibration.cue(step.labels)
+        self.step_timer.start(int(1000 * step.duration))
+
+    def pattern_done(self):
+        """Wait for OK before the next pattern (or the end)."""
+        self.stop()
+        print 'click ok to do next test'
+        self.buttonBox.button(QtGui.QDialogButtonBox.Ok).setEnabled(True)
+        self.pattern_idx += 1
+        if self.pattern_idx < len(self.patterns):
+            curr_pattern = self.patterns[self.pattern_idx]
+            if curr_pattern.static:
+                instruct_text = self.instruction_strings[0] + str(curr_pattern.cued) + ', holding ' + str(curr_pattern.static)
+            else:
+                instruct_text = self.instruction_strings[0] + str(curr_pattern.cued)
+            self.instructions.setText(instruct_text)
+            self.prompt.setText(self.prompt_strings[0])
+        else:
+            self.instructions.setText(self.instruction_strings[2])
+            self.prompt.setText('')
+
     def move_box_selection(self, box):
         box.moveCursor(QtGui.QTextCursor.StartOfLine, QtGui.QTextCursor.MoveAnchor)
         box.moveCursor(QtGui.QTextCursor.Down, QtGui.QTextCursor.MoveAnchor)
@@ -556,10 +712,10 @@ class keysDialog(QtGui.QDialog):
         """
         self.parent = parent
         super(keysDialog, self).__init__(parent.mainwin)
-        title = QtGui.QLabel('Key Configuration:\n(checked=must be active, cleared=must be inactive, other=dontcare)')
+        title = QtGui.QLabel('Key Configuration:\n(checked=must be active, cleared=must be inactive, other=dontcare)\n(only the first matching key of each group is sent)')
 
         # num_keys controls the number of key selectors
-        num_keys = 4  # needs to be stored and loaded from cfg
+        num_keys = cfg['num_keys']
 
         # add button controls and descriptive labels
         self.buttonBox = QtGui.QDialogButtonBox(self)
@@ -578,6 +734,8 @@ class keysDialog(QtGui.QDialog):
         # for each channel, create an empty list for checkboxes and store in a dict
         self.chanBoxes = {}
         verticals = {'keys': QtGui.QVBoxLayout(self)}  # also create a dict for all the columns
+        groups = QtGui.QVBoxLayout(self)  # exclusive group column, last
+        groups.addWidget(QtGui.QLabel('Group'), 1, 4)
         for name in cfg['names']:
             self.chanBoxes[name] = []
             verticals[name] = QtGui.QVBoxLayout(self)  # add a column for the channel
@@ -585,15 +743,22 @@ class keysDialog(QtGui.QDialog):
 
         # populate a list with comboboxes
         self.keySelectors = []
+        self.groupSelectors = []
         for i in range(num_keys):
             parent.combo_map.append({})
             parent.selected_keys.append(None)
+            parent.selected_groups.append(0)
             this_key = QtGui.QComboBox(self)
             this_key.addItem('Select Key...', None)
             for keyname in cfg['keys']:
                 this_key.addItem(keyname, cfg['keys'][keyname])
             self.keySelectors.append(this_key)
             verticals['keys'].addWidget(this_key)
+            this_group = QtGui.QSpinBox(self)
+            this_group.setRange(0, num_keys)
+            this_group.setSpecialValueText('none')  # shown for 0
+            self.groupSelectors.append(this_group)
+            groups.addWidget(this_group, 1, 4)
             # also for every combobox add a checkbox to each channel's checkboxlist
             for name in cfg['names']:
                 cb = QtGui.QCheckBox(self)
@@ -611,8 +776,9 @@ class keysDialog(QtGui.QDialog):
             self.selectionGrid.setColumnMinimumWidth(i, 96)
             self.selectionGrid.setColumnStretch(i, 1)
             i += 1
+        self.selectionGrid.addLayout(groups, 2, i, (1 + num_keys), 1)
 
-        self.selectionGrid.addWidget(self.buttonBox, 8, 0, 1, -1, 4)
+        self.selectionGrid.addWidget(self.buttonBox, 4 + num_keys, 0, 1, -1, 4)
         self.selectionGrid.setColumnMinimumWidth(1, 32)
         self.selectionGrid.setRowMinimumHeight(2, 48)
 
@@ -621,16 +787,21 @@ class keysDialog(QtGui.QDialog):
 
         self.cfg = cfg
 
-    def btn_cancel_click(self):
-        # discard changes, revert checkboxes and key selectors to stored state
+    def show_stored(self):
+        # set checkboxes and key selectors to the state stored in the parent
         p = self.parent
         for i in range(0, len(p.combo_map)):
             cBoxIndex = self.keySelectors[i].findData(p.selected_keys[i])
             if cBoxIndex == -1:
                 cBoxIndex = 0
             self.keySelectors[i].setCurrentIndex(cBoxIndex)
+            self.groupSelectors[i].setValue(p.selected_groups[i])
             for name in p.cfg['names']:
                 self.chanBoxes[name][i].setCheckState(p.combo_map[i][name])
+
+    def btn_cancel_click(self):
+        # discard changes, revert checkboxes and key selectors to stored state
+        self.show_stored()
         self.reject()
 
     def btn_ok_click(self):
@@ -638,297 +809,8 @@ class keysDialog(QtGui.QDialog):
         p = self.parent
         for i in range(0, len(p.combo_map)):
             p.selected_keys[i] = self.keySelectors[i].itemData(self.keySelectors[i].currentIndex())
+            p.selected_groups[i] = self.groupSelectors[i].value()
             for name in p.cfg['names']:
                 p.combo_map[i][name] = self.chanBoxes[name][i].checkState()
+        p.update_key_map()
         self.accept()
-
-
-class Channel(object):
-    """A class for DSP and plotting related functions."""
-
-    def __init__(self, ID, cfg):
-        """Basic constructor.
-
-        Takes parameters:
-        ID: string identifying the muscle attached to this channel.
-        index: int specifying where this channel is in the parsed_data array
-        cfg: the 'config' dict containing global constants.
-        """
-        self.cfg = cfg
-        if self.cfg['raw_output']:
-            print 'outputting raw'
-        self.raw_Q = deque([0.0] * cfg['datalen'], cfg['datalen'])
-        self.datalen = cfg['datalen']
-        self.ID = ID
-        self.idx = cfg['indices'][ID]
-        self.sampfreq = cfg['sampfreq']
-        self.plotwin = cfg['win']
-        self.read_data = []
-        self.read_diff = 0
-        # Thread control
-        self.read_trigger = False
-        self.terminated = False
-        self.fftcounter = 0
-        # DSP setup
-        stop = cfg['mainsfreq'] + cfg['notch_width'] * np.array([-1., 1.])
-        b_AC1, a_AC1 = signal.butter(cfg['filt_order'],
-                                     stop/(self.sampfreq / 2.0),
-                                     'bandstop')  # create the mains filter
-
-        stop = .5 * cfg['mainsfreq'] + cfg['notch_width'] * np.array([-1., 1.])
-        b_AC2, a_AC2 = signal.butter(cfg['filt_order'],
-                                     stop/(self.sampfreq / 2.0),
-                                     'bandstop')  # create the mains/2 filter
-
-        # stop = 2. * cfg['mainsfreq'] + cfg['notch_width'] * np.array([-1., 1.])
-        # b_AC3, a_AC3 = signal.butter(cfg['filt_order'],
-        #                              stop/(self.sampfreq / 2.0),
-        #                              'bandstop')  # create the 2*mains filter
-
-        # convolve all filter coefficients to yield combined filter
-        self.a = np.convolve(a_AC2, a_AC1)
-        # self.a = np.convolve(np.convolve(a_AC2, a_AC1), a_AC3)
-        self.b = np.convolve(b_AC2, b_AC1)
-        # self.b = np.convolve(np.convolve(b_AC2, b_AC1), b_AC3)
-        self.filtlen = max(len(self.a), len(self.b))
-
-    def read_in(self):
-        """Checks for missed packets, then calls dsp() as required."""
-        while not self.terminated:  # run forever!
-            if self.read_trigger:  # check for trigger
-                self.read_trigger = False
-                data = self.read_data
-                diff = self.read_diff
-                newVal = float(data[self.idx])
-                if diff != 1:
-                    # interpolation routine
-                    nextVal = self.raw_Q[0]
-                    delta = (newVal - nextVal) / diff
-                    print diff
-                    for _ in xrange(0, diff):
-                        nextVal += delta
-                        self.dsp(nextVal)
-                else:
-                    self.dsp(newVal)
-        print '{} channel thread terminating...'.format(self.ID)
-        return
-
-    def dsp(self, newVal):
-        """Performs the actual signal processing.
-
-        50Hz  notch filter (Butterworth).
-        100Hz notch filter (Butterworth). <-- actually 25 Hz
-        """
-        self.raw_Q.appendleft(newVal)
-
-        if self.cfg['raw_output'] == True:
-            self.plotwin.data[self.ID].appendleft(float(newVal))
-            # if self.ID == 'R_AS':
-            #     print newVal
-            return
-
-        # #### ==== FILTER MATH ==== ####
-        # We've already computed the two coefficient vectors a and b.
-        # If N is the length of b, and M is the length of a,
-        # and x is the input vector, and y is the output vector,
-        # and x[0] is the most recent input, and y[0] is the most recent output
-        # (which we haven't yet calculated) then:
-        #
-        #     a[0]*y[0] + a[1]*y[1] + ... + a[M-1]*y[M-1]
-        #       == b[0]*x[0] + b[1]*x[1] + ... + b[N-1]*x[N-1]
-        #
-        #
-        # rearranging for y[0]:
-        #
-        #     y[0] == ( (b[0]*x[0] + b[1]*x[1] + ... + b[N-1]*x[N-1])
-        #             - (a[1]*y[1] + ... + a[M-1]*y[M-1]) ) / a[0]
-
-        # filtX = np.array([newVal], np.float)  # x[0] is the latest raw value
-        # for i in range(1, len(self.b)):  # fill filtX with raw data values
-        #     filtX = np.append(filtX, np.array(self.raw_Q[i], np.float))
-        #
-        # filtY = np.array([0], np.float)  # y[0] is 0 so that a[0]*y[0] is ignored
-        # for i in range(1, len(self.a)):  # fill filtY with past output values
-        #     filtY = np.append(filtY, np.array(self.plotwin.data[self.ID][i-1],
-        #                                       np.float))
-
-        filtX = np.fromiter(self.raw_Q, np.float, self.filtlen)
-        filtY = np.append([0.], np.fromiter(self.plotwin.data[self.ID],
-                                            np.float, self.filtlen - 1))
-
-        # calculate y[0]
-        out = (self.b.dot(filtX) - self.a.dot(filtY)) / self.a[0]
-        self.plotwin.data[self.ID].appendleft(out)  # append y[0] to the filtered data queue
-
-        if self.fftcounter >= self.plotwin.fftcount:
-            self.fftcounter = 0
-            self.plotwin.ffts[self.ID] = self.short_fft()
-        else:
-            self.fftcounter += 1
-
-        # delete function variables... just in case
-        del filtX
-        del filtY
-        return out
-
-    def short_fft(self):
-        """Return the real-fft value of this channel's data queue."""
-        # front = np.fromiter(self.plotwin.data[self.ID], np.float)[:self.plotwin.fftlen]
-        # return np.abs(np.fft.rfft(front))
-        iter_tmp = np.fromiter(self.plotwin.data[self.ID], np.float)
-        return np.abs(np.fft.rfft(iter_tmp[:self.plotwin.fftlen]))[1:]
-
-
-class IO_handler(object):
-    """Handler for I/O."""
-
-    def __init__(self, port, bauds, channels, nowrite=True):
-        try:
-            ser = serial.Serial()
-            ser.port = port
-            ser.baudrate = bauds
-            ser.open()
-            print 'connect success!'
-            self.ser = ser
-            self.channels = channels
-            self.do_polling = False
-            self.kill_thread = False
-            self.dsp_threads = []
-            self.nowrite = nowrite
-            for ch in channels:
-                dsp_thread = Thread(target=ch.read_in, args=())
-                self.dsp_threads.append(dsp_thread)
-                ch.terminated = False
-                ch.read_trigger = False
-                dsp_thread.start()
-        except (OSError, serial.SerialException):
-            print 'Error opening serial port: ' + port
-            exit(2)
-
-    def poll_serial(self):
-        """Monstrous function to handle serial comms and data output."""
-        while not self.kill_thread:  # superloop
-            if self.ser.is_open and self.do_polling:
-                # this only runs once when do_polling becomes true
-                DO_ONCE = True
-                nowrite = self.nowrite
-                cfg = self.channels[0].cfg
-                docalibration = cfg['win'].docalibration
-                # self.init_chans()
-                if not nowrite:
-                    output, filename = self._open_output_file(docalibration)
-                # initialize counter and header check bytes
-                samples = 0
-                h = 'cc'  # header value --- 0xFC
-                h1 = ''
-                h2 = ''
-                self.ser.reset_input_buffer()  # purge buffer
-                while self.ser.is_open and self.do_polling:  # superloop in a superloop
-                    if self.ser.in_waiting:  # data available
-                        h2 = self.ser.read().encode('hex')  # read it
-                        if (h2 == h) and (h1 == h):  # check if got both headers
-                            samples += 1
-                            h1 = ''
-                            raw_data = self.ser.read(7)  # read the rest
-                            parsed_data = self._parse_raw(raw_data)  # parse it
-                            if not nowrite and not docalibration:  # write it
-                                output_line = self._format_output(parsed_data)
-                                output.write(output_line)
-                            else:  # something to do with docalibration
-                                output_line = '{},{},'.format(parsed_data[0],
-                                                              parsed_data[1])
-
-                            # on first sample, force diff to 1
-                            if DO_ONCE:
-                                prev_count = parsed_data[1] - 1
-                                diff = 1
-                                DO_ONCE = False
-                            else:
-                                diff = (parsed_data[1] - prev_count + 256) % 256
-                                prev_count = parsed_data[1]
-
-                            # iterate over channels, trigger read_in
-                            for ch in self.channels:
-                                if docalibration:
-                                    filt = cfg['win'].data[ch.ID][0]
-                                    cal = cfg['win'].calibrator.tests[ch.ID]
-                                    output_line += '{0:.0f},{1:.2f},{2},'.format(ch.raw_Q[0],
-                                                                                 filt,
-                                                                                 cal)
-                                ch.read_data = parsed_data
-                                ch.read_diff = diff
-                                ch.read_trigger = True
-                                # end for
-
-                            if docalibration:  # add newline if calibrating
-                                output_line += '\n'
-                                output.write(output_line)
-                        else:  # didn't get both headers. Try again.
-                            h1 = h2
-                if not nowrite:
-                    # clean up (stream stop) - close output file
-                    print "Recorded {} samples to {}".format(samples, filename)
-                    if not output.closed:
-                        output.close()
-            else:
-                # flush serial buffer & sleep half a second
-                self.ser.reset_input_buffer()
-                time.sleep(0.5)
-
-        # clean up (exit) - stop DSP threads and close serial port
-        if self.ser.is_open:
-            self.ser.close()
-        for ch in self.channels:
-            ch.terminated = True
-        return
-
-    def _parse_raw(self, raw_data):
-        """Parse the data packet. Does a lot of bit-shifting."""
-        return [ord(raw_data[0]), ord(raw_data[1]),
-                ((ord(raw_data[6]) & 3) << 8) + ord(raw_data[2]),
-                ((ord(raw_data[6]) & 12) << 6) + ord(raw_data[3]),
-                ((ord(raw_data[6]) & 48) << 4) + ord(raw_data[4]),
-                ((ord(raw_data[6]) & 192) << 2) + ord(raw_data[5])]
-
-    def _format_output(self, parsed_data):
-        return "{},{},{},{},{},{}\n".format(parsed_data[0],
-                                            parsed_data[1],
-                                            parsed_data[2],
-                                            parsed_data[3],
-                                            parsed_data[4],
-                                            parsed_data[5])
-
-    def _open_output_file(self, docalibration):
-        filename = datetime.datetime.now().strftime("data_%Y-%m-%d_%H%M-%S") + ".csv"
-        if docalibration:
-            filename = 'calibration_' + filename
-        filename = './data/' + filename
-        try:
-            output = open(filename, 'w')
-        except (OSError, IOError):
-            print 'Error opening file: {}'.format(filename)
-            exit(2)
-        else:
-            if not docalibration:
-                output.write("RAW DATA ONLY\nOCRval,count,Ch0,Ch1,Ch2,Ch3\n")
-            else:
-                # sorted(channels, key=lambda ch: ch.idx)
-                # output.write("Columns\nOCRval,count,Ch0,Ch1,Ch2,Ch3\n")
-                header_line = "Columns\n,,"
-                line2 = '\nOCRval,count,'
-                for ch in self.channels:
-                    header_line += 'Ch{} ({}),,,'.format(ch.idx-2, ch.ID)
-                    line2 += 'raw,filt,cal,'
-                line2 += '\n'
-                header_line += line2
-                output.write(header_line)
-        return output, filename
-
-    # def init_chans(self):
-    #     for ch in self.channels:
-    #         dsp_thread = Thread(target=ch.read_in, args=())
-    #         self.dsp_threads.append(dsp_thread)
-    #         ch.terminated = False
-    #         ch.read_trigger = False
-    #         dsp_thread.start()
-    #     return
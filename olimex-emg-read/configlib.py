@@ -0,0 +1,97 @@
+# === configlib.py ===
+# * Function: the default settings, shared by every olimex-emg-read tool.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""The default config dict: board, filter, detection, GUI and channel
+settings.
+
+olimex-emg-read.py starts from defaults() and changes it from the command
+line and profiles; analyse.py and benchmark.py start from the same
+settings without going through the main program. channel_config() fits a
+config's channels to the number a board (or recording) actually has.
+"""
+
+import copy
+
+CONFIG = {'sampfreq': 256,  # SAMP_FREQ in the firmware, Hz (see timinglib)
+          'datalen': 4096,  # data queue length
+          'mainsfreq': 50,  # local mains freq, Hz
+          'notch_width': 0.5,  # notch filter bandwidth, Hz
+          'filt_order': 3,  # notch filter order
+          'raw_output': False,
+          'fftlen': 64,  # spectrum frame length, samples
+          'fft_overlap': 0.5,  # fraction of each frame shared with the next
+          'envelope': 'p2p',  # detection envelope, 'p2p' or 'rms'
+          'detect_window': 64,  # envelope window, samples
+          'hysteresis': 0.2,  # goes inactive below (1 - this) * threshold
+          'hold_ms': 100,  # minimum time a channel stays active, ms
+          'refractory_ms': 50,  # min. time before it can go active again, ms
+          'record_format': 'csv',  # 'csv' or 'bin'
+          'board_chans': 4,  # channels per board, NUM_CHANS in the firmware
+          'dsp_procs': 0,  # worker processes for the channel DSP, 0 = none
+          'clock': 'ocr',  # rate from the packets' OCR value, or 'nominal'
+          'gap_policy': 'interpolate',  # missed packets, dsplib.GAP_POLICIES
+          'metrics_log_s': 60,  # metrics log line interval, s (0 = none)
+          'metrics_port': None,  # metrics HTTP port on localhost, None = off
+          'trace': None,  # file to write a latency trace to, None = off
+          'num_keys': 4,  # key bindings in the key configuration dialog
+          'key_backend': None,  # keylib backend, None = first that works
+          'profile': None,  # name of the profile in use, see profilelib
+          'profile_dir': 'profiles',  # where profiles are kept
+          'title': 'EMG Grapher',  # window title
+          'width': 1280,  # window width
+          'height': 800,  # window height
+          'plot_timer_ms': 50,  # plot update interval, ms
+          'plot_columns': 2,  # plots are laid out in this many columns
+          'title_interval_ms': 500,  # title bar (p-p, MDF) update interval, ms
+          'plot_names': ['th_add', 'th_abd', 'fi_flx', 'fi_ext'],
+          'indices': {'th_add': 5,  # index of chan's data in packet
+                      'th_abd': 4,
+                      'fi_flx': 3,
+                      'fi_ext': 2},
+          'names': {'th_add': 'ADduct Thumb',  # description of channel
+                    'th_abd': 'ABduct Thumb',
+                    'fi_flx': 'Flex Fingers',
+                    'fi_ext': 'Extend Fingers'},
+          'keys': None}
+
+# calibration: see calibrationlib; settle is the seconds ignored after
+# each cue (reaction time)
+CONFIG['calcfg'] = {'repeats': 5,
+                    # 'intervals': [.1, .2],
+                    'intervals': [1., 2.],
+                    'settle': 0.3}
+
+
+def defaults():
+    """A copy of CONFIG to change as needed (nested dicts and all)."""
+    return copy.deepcopy(CONFIG)
+
+
+def channel_config(cfg, nchans):
+    """Fit the channel names & indices in cfg to nchans channels in total.
+
+    Named channels on columns that don't exist are dropped; columns
+    without a name get a generic one ('ch4' for the 5th channel, etc).
+    """
+    for name in list(cfg['plot_names']):
+        if cfg['indices'][name] >= 2 + nchans:
+            cfg['plot_names'].remove(name)
+    taken = set(cfg['indices'][name] for name in cfg['plot_names'])
+    for col in range(2, 2 + nchans):
+        if col not in taken:
+            name = 'ch{}'.format(col - 2)
+            cfg['plot_names'].append(name)
+            cfg['indices'][name] = col
+            cfg['names'][name] = 'Channel {}'.format(col - 2)
+    for key in ['indices', 'names']:  # keysDialog goes through 'names'
+        for name in list(cfg[key]):
+            if name not in cfg['plot_names']:
+                del cfg[key][name]
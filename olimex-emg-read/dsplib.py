@@ -0,0 +1,541 @@
+# === dsplib.py ===
+# * Function: signal processing building blocks for olimex-emg-read.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""A library for the buffering and filtering done on each EMG channel.
+
+Run it directly to check the block filter against the old per-sample
+direct-form maths.
+"""
+
+from __future__ import print_function
+import ctypes
+import multiprocessing
+from collections import deque
+import numpy as np
+from scipy import signal
+
+
+class RingBuffer(object):
+    """A fixed-capacity ring buffer of samples, backed by a NumPy array.
+
+    Every sample is stored twice, in a backing array of twice the capacity,
+    so the latest N samples are always one contiguous slice and latest()
+    can return a view without copying.
+
+    Meant for one writer thread and any number of readers. The writer
+    fills in the data before bumping count, so a reader never sees samples
+    that haven't been written yet. A view from latest(n) stays valid until
+    another (capacity - n) samples have been written; ask for a copy if it
+    has to live longer than that.
+    """
+
+    def __init__(self, capacity, dtype=np.float64, fill=0.):
+        """Constructor."""
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self._buf = np.empty(2 * capacity, self.dtype)
+        self._buf.fill(fill)
+        self.count = 0  # total samples ever written
+
+    def __len__(self):
+        return self.capacity
+
+    def extend(self, block):
+        """Append a block of samples, oldest first."""
+        block = np.asarray(block, self.dtype)
+        n = len(block)
+        cap = self.capacity
+        if n > cap:  # only the newest samples will fit anyway
+            block = block[-cap:]
+        pos = (self.count + n - len(block)) % cap
+        first = min(len(block), cap - pos)
+        rest = len(block) - first
+        buf = self._buf
+        buf[pos:pos + first] = block[:first]
+        buf[pos + cap:pos + cap + first] = block[:first]
+        if rest:  # wrapped around
+            buf[:rest] = block[first:]
+            buf[cap:cap + rest] = block[first:]
+        self.count += n  # publish
+
+    def append(self, value):
+        """Append a single sample."""
+        self.extend([value])
+
+    def clear(self, value=0.):
+        """Overwrite the whole history with one value."""
+        self.extend(np.full(self.capacity, value, self.dtype))
+
+    def last(self):
+        """Return the newest sample."""
+        return self._buf[self.count % self.capacity + self.capacity - 1]
+
+    def latest(self, n=None, copy=False):
+        """Return the latest n samples (default: all of them), oldest first."""
+        if n is None or n > self.capacity:
+            n = self.capacity
+        end = self.count % self.capacity + self.capacity
+        view = self._buf[end - n:end]
+        return view.copy() if copy else view
+
+
+class SharedRingBuffer(RingBuffer):
+    """A RingBuffer in shared memory, for use across processes.
+
+    The samples and the count are multiprocessing shared memory, so a
+    child process handed this object (i.e. as a Process argument) writes
+    to the very buffer the parent reads, with no copying in between.
+    """
+
+    def __init__(self, capacity, dtype=np.float64, fill=0.):
+        """Constructor."""
+        dtype = np.dtype(dtype)
+        self._raw = multiprocessing.RawArray(ctypes.c_char,
+                                             2 * capacity * dtype.itemsize)
+        self._count = multiprocessing.RawValue(ctypes.c_longlong, 0)
+        self._attach(capacity, dtype)
+        self._buf.fill(fill)
+
+    @classmethod
+    def copy_of(cls, buf):
+        """Return a SharedRingBuffer holding the same history as buf."""
+        shared = cls(buf.capacity, buf.dtype)
+        shared._buf[:] = buf._buf
+        shared.count = buf.count
+        return shared
+
+    def _attach(self, capacity, dtype):
+        self.capacity = capacity
+        self.dtype = dtype
+        self._buf = np.frombuffer(self._raw, dtype)
+
+    @property
+    def count(self):
+        return self._count.value
+
+    @count.setter
+    def count(self, value):
+        self._count.value = value
+
+    def __getstate__(self):
+        return self.capacity, self.dtype.str, self._raw, self._count
+
+    def __setstate__(self, state):
+        capacity, dtype, self._raw, self._count = state
+        self._attach(capacity, np.dtype(dtype))
+
+
+def shared_array(values):
+    """Copy values into shared memory; return (ctypes array, ndarray view).
+
+    Pass the ctypes array to another process and np.frombuffer it there
+    to see the same memory.
+    """
+    values = np.asarray(values, np.float64)
+    raw = multiprocessing.RawArray(ctypes.c_double, len(values))
+    view = np.frombuffer(raw, np.float64)
+    view[:] = values
+    return raw, view
+
+
+class MinMaxDecimator(object):
+    """A min/max envelope of a RingBuffer, for drawing it in fewer points.
+
+    Samples are taken `bucket` at a time and each bucket is reduced to its
+    min and max, so spikes still show however far the trace is squashed.
+    update() only looks at whole buckets written since the last call.
+    """
+
+    def __init__(self, capacity, bucket):
+        """Constructor. capacity: number of buckets kept."""
+        self.bucket = bucket
+        self.mins = RingBuffer(capacity)
+        self.maxs = RingBuffer(capacity)
+        self.done = None  # buffer count up to which buckets have been taken
+
+    def update(self, buf):
+        """Take in any new whole buckets from buf; return how many."""
+        bucket = self.bucket
+        keep = min(self.mins.capacity, buf.capacity // bucket) * bucket
+        count = buf.count
+        if self.done is None or count - self.done > keep:
+            # first time, or fallen behind: start again from the newest samples
+            self.done = count - keep
+        n = (count - self.done) // bucket
+        if n <= 0:
+            return 0
+        block = buf.latest(count - self.done)[:n * bucket].reshape(n, bucket)
+        self.mins.extend(block.min(axis=1))
+        self.maxs.extend(block.max(axis=1))
+        self.done += n * bucket
+        return n
+
+    def envelope(self):
+        """Return min, max, min, max... of every bucket, oldest first."""
+        out = np.empty(2 * self.mins.capacity)
+        out[0::2] = self.mins.latest()
+        out[1::2] = self.maxs.latest()
+        return out
+
+    def peak_to_peak(self):
+        """Max - min over all the buckets."""
+        return np.amax(self.maxs.latest()) - np.amin(self.mins.latest())
+
+
+# notch designs so far: notch_key() -> sos (read-only), shared by every
+# channel with the same settings; profilelib saves and restores these
+_notch_designs = {}
+
+
+def notch_key(cfg, sampfreq):
+    """What a notch design depends on, as a hashable key."""
+    return (cfg['mainsfreq'], cfg['notch_width'], cfg['filt_order'], sampfreq)
+
+
+def notch_sos(cfg, sampfreq):
+    """Design the combined mains and mains/2 notch as second-order sections.
+
+    Uses cfg['mainsfreq'], cfg['notch_width'] and cfg['filt_order'].
+    Cascading the two sets of sections is the same filter as convolving
+    their b/a polynomials, but without the 12th-order numerical headaches.
+    A design is only worked out once; the array returned is read-only.
+    """
+    key = notch_key(cfg, sampfreq)
+    sos = _notch_designs.get(key)
+    if sos is None:
+        nyq = sampfreq / 2.0
+        sections = []
+        for centre in [cfg['mainsfreq'], .5 * cfg['mainsfreq']]:
+            stop = centre + cfg['notch_width'] * np.array([-1., 1.])
+            sections.append(signal.butter(cfg['filt_order'], stop / nyq,
+                                          'bandstop', output='sos'))
+        sos = _notch_designs[key] = _frozen(np.vstack(sections))
+    return sos
+
+
+def notch_designs():
+    """Every notch designed (or loaded) so far, as a dict of key -> sos."""
+    return dict(_notch_designs)
+
+
+def load_notch_designs(designs):
+    """Add designs (a dict of notch_key() -> sos) to the ones notch_sos()
+    hands out, i.e. saved by an earlier run."""
+    for key, sos in designs.items():
+        _notch_designs[tuple(key)] = _frozen(np.array(sos, np.float64))
+
+
+def _frozen(a):
+    a.flags.writeable = False
+    return a
+
+
+class NotchFilter(object):
+    """A stateful IIR filter that processes blocks of samples.
+
+    The filter state (zi) is kept between calls, so feeding a signal in
+    blocks of any size gives the same output as filtering it all at once.
+    """
+
+    def __init__(self, sos):
+        """Constructor. sos: second-order sections, i.e. from notch_sos."""
+        self.sos = np.asarray(sos, np.float64)
+        self.zi = np.zeros((self.sos.shape[0], 2))
+
+    def reset(self):
+        """Zero the filter state."""
+        self.zi[:] = 0.
+
+    def process(self, block):
+        """Filter a block of samples and return the filtered block."""
+        out, self.zi = signal.sosfilt(self.sos, block, zi=self.zi)
+        return out
+
+
+class SpectralAnalyser(object):
+    """Short-time spectrum and EMG frequency features of one channel.
+
+    Every `hop` samples another frame of the last `fftlen` samples is
+    windowed (Hann) and transformed, straight from a RingBuffer view, so
+    each frame costs the same however long the history is. The frame mean
+    is removed first, so the ADC offset doesn't swamp the low bins.
+
+    After each frame: power holds the one-sided power spectrum (freqs
+    gives the bin centres), and the mean and median frequency are appended
+    to the mean_freq and median_freq RingBuffers, for fatigue tracking.
+    """
+
+    def __init__(self, fftlen, hop, sampfreq, history=256):
+        """Constructor. history: number of feature values kept."""
+        self.fftlen = fftlen
+        self.hop = hop
+        self.window = np.hanning(fftlen)
+        self.freqs = np.fft.rfftfreq(fftlen, 1. / sampfreq)
+        self.power = np.zeros(len(self.freqs))
+        self.mean_freq = RingBuffer(history)
+        self.median_freq = RingBuffer(history)
+        self.frames = 0  # frames done so far
+        self._next = fftlen  # buffer count at which the next frame ends
+
+    def update(self, buf):
+        """Do any frames that became due in buf (a RingBuffer) since last time.
+
+        Returns the number of frames done; if samples came in faster than
+        the buffer can hold, the oldest due frames are skipped.
+        """
+        count = buf.count
+        if count < self._next:
+            return 0
+        due = (count - self._next) // self.hop + 1
+        # the newest frame ends `back` samples before the newest sample
+        back = count - (self._next + (due - 1) * self.hop)
+        due = min(due, (buf.capacity - back - self.fftlen) // self.hop + 1)
+        span = buf.latest(self.fftlen + (due - 1) * self.hop + back)
+        span = span[:len(span) - back]
+        step = span.strides[0]
+        frames = np.lib.stride_tricks.as_strided(
+            span, (due, self.fftlen), (self.hop * step, step))
+        frames = (frames - frames.mean(axis=1)[:, np.newaxis]) * self.window
+        power = np.abs(np.fft.rfft(frames, axis=1)) ** 2
+        total = power.sum(axis=1)
+        total[total == 0] = 1.  # flat line: call it 0 Hz
+        self.mean_freq.extend(power.dot(self.freqs) / total)
+        half = np.cumsum(power, axis=1) >= (total / 2.)[:, np.newaxis]
+        self.median_freq.extend(self.freqs[np.argmax(half, axis=1)])
+        self.power[:] = power[-1]  # in place, it may be in shared memory
+        self.frames += due
+        self._next = count - back + self.hop
+        return due
+
+
+GAP_POLICIES = ['interpolate', 'hold', 'nan']
+
+
+def fill_gaps(values, diffs, last, policy='interpolate'):
+    """Fill in the samples of missed packets.
+
+    values: one channel's samples from a block of packets.
+    diffs: packet counter step for each packet (1 unless packets were lost).
+    last: the sample before the block, to interpolate or hold from.
+    policy: what goes in the gaps, one of GAP_POLICIES - a straight line
+    from the previous sample, the previous sample again, or NaN.
+    Returns sum(diffs) samples, where a packet with a step of d is preceded
+    by d-1 filled-in values.
+    """
+    values = np.asarray(values, np.float64)
+    diffs = np.asarray(diffs)
+    if np.all(diffs == 1):
+        return values
+    prev = np.empty_like(values)
+    prev[0] = last
+    prev[1:] = values[:-1]
+    if policy != 'interpolate':
+        out = np.repeat(prev, diffs)
+        if policy == 'nan':
+            out.fill(np.nan)
+        out[np.cumsum(diffs) - 1] = values  # the packets that did arrive
+        return out
+    # step number within each gap, 1..d
+    starts = np.cumsum(diffs) - diffs
+    steps = np.arange(starts[-1] + diffs[-1]) - np.repeat(starts, diffs) + 1
+    frac = steps / np.repeat(diffs, diffs).astype(np.float64)
+    prev = np.repeat(prev, diffs)
+    return prev + (np.repeat(values, diffs) - prev) * frac
+
+
+def hold_nans(block, last):
+    """Replace NaNs in a block with the last real sample before each one.
+
+    last: the sample before the block, for NaNs at the start of it.
+    """
+    ok = ~np.isnan(block)
+    if ok.all():
+        return block
+    x = np.concatenate([[last], block])
+    src = np.where(np.concatenate([[True], ok]), np.arange(len(x)), 0)
+    return x[np.maximum.accumulate(src)][1:]
+
+
+def sliding_envelope(x, window, envelope='p2p'):
+    """A ThresholdDetector envelope of a whole signal at once.
+
+    x: (N,) or (N, nchans) samples. The envelope at each sample is of the
+    `window` samples ending there (NaN for the first window - 1), worked
+    out for every sample and channel in one go rather than sample by sample.
+    """
+    x = np.asarray(x, np.float64)
+    out = np.empty(x.shape)
+    out.fill(np.nan)
+    if len(x) < window:
+        return out
+    if envelope == 'rms':
+        x = np.concatenate([np.zeros((1,) + x.shape[1:]), x])
+        sums = np.cumsum(x, axis=0)
+        means = (sums[window:] - sums[:-window]) / window
+        sums = np.cumsum(x * x, axis=0)
+        var = (sums[window:] - sums[:-window]) / window - means * means
+        out[window - 1:] = np.sqrt(np.maximum(var, 0.))
+        return out
+    windows = np.lib.stride_tricks.as_strided(
+        x, (len(x) - window + 1, window) + x.shape[1:],
+        x.strides[:1] + x.strides)
+    out[window - 1:] = windows.max(axis=1) - windows.min(axis=1)
+    return out
+
+
+class SlidingMinMax(object):
+    """Running min and max over the last `window` samples.
+
+    Keeps a monotonic deque of (index, value) for each, so every new sample
+    costs O(1) on average however long the window is.
+    """
+
+    def __init__(self, window):
+        """Constructor."""
+        self.window = window
+        self.n = 0  # samples pushed so far
+        self._max = deque()  # values decreasing from the front
+        self._min = deque()  # values increasing from the front
+
+    def push(self, x):
+        """Add a sample; return (min, max) of the window ending with it."""
+        i = self.n
+        self.n += 1
+        old = i - self.window
+        mx, mn = self._max, self._min
+        while mx and mx[-1][1] <= x:
+            mx.pop()
+        mx.append((i, x))
+        if mx[0][0] <= old:
+            mx.popleft()
+        while mn and mn[-1][1] >= x:
+            mn.pop()
+        mn.append((i, x))
+        if mn[0][0] <= old:
+            mn.popleft()
+        return mn[0][1], mx[0][1]
+
+
+class ThresholdDetector(object):
+    """Decides, sample by sample, whether a channel is active.
+
+    The envelope is either the peak-to-peak ('p2p') or the RMS about the
+    mean ('rms', the ADC values sit on a DC offset) of the last `window`
+    samples. A channel goes active when the envelope rises
+    above `on` and inactive when it falls below `off` (hysteresis), but
+    stays active for at least `hold` samples and, once released, can't go
+    active again for `refractory` samples.
+    """
+
+    def __init__(self, window, on=0., off=None, hold=0, refractory=0,
+                 envelope='p2p'):
+        """Constructor. hold and refractory are in samples."""
+        if envelope not in ('p2p', 'rms'):
+            raise ValueError('unknown envelope: {}'.format(envelope))
+        self.window = window
+        self.hold = hold
+        self.refractory = refractory
+        self.envelope = envelope
+        self.set_thresholds(on, off)
+        self._minmax = SlidingMinMax(window)
+        self._history = RingBuffer(window)  # for the rms running sums
+        self._since = refractory  # samples since the last change of state
+        self.active = False
+
+    def set_thresholds(self, on, off=None):
+        """Change the on/off thresholds; off defaults to on (no hysteresis)."""
+        self.on = on
+        self.off = on if off is None else off
+
+    def envelope_of(self, block):
+        """Return the envelope at each sample of a new block."""
+        if self.envelope == 'rms':
+            if not self._history.count:  # no history yet: don't ramp up from 0
+                self._history.clear(block[0])
+            # window sums from cumsums over the history plus the block
+            x = np.concatenate([[0.], self._history.latest(self.window - 1),
+                                block])
+            self._history.extend(block)
+            w = self.window
+            sums = np.cumsum(x)
+            means = (sums[w:] - sums[:-w]) / w
+            sums = np.cumsum(x * x)
+            var = (sums[w:] - sums[:-w]) / w - means * means
+            return np.sqrt(np.maximum(var, 0.))
+        push = self._minmax.push
+        env = np.empty(len(block))
+        for k, x in enumerate(block.tolist()):
+            lo, hi = push(x)
+            env[k] = hi - lo
+        return env
+
+    def process(self, block):
+        """Feed a block of samples; return the active state after each one."""
+        return self.decide(self.envelope_of(block))
+
+    def decide(self, env):
+        """Run the on/off logic over envelope values from envelope_of()."""
+        states = np.empty(len(env), np.bool_)
+        active, since = self.active, self._since
+        on, off, hold, refractory = self.on, self.off, self.hold, self.refractory
+        for k, e in enumerate(env.tolist()):
+            if active:
+                if e < off and since >= hold:
+                    active, since = False, 0
+            elif e > on and since >= refractory:
+                active, since = True, 0
+            since += 1
+            states[k] = active
+        self.active, self._since = active, since
+        return states
+
+
+def direct_form(b, a, x):
+    """Filter x one sample at a time, exactly as Channel.dsp used to.
+
+    y[0] = (b[0]*x[0] + ... + b[N-1]*x[N-1] - a[1]*y[1] - ... ) / a[0]
+    with x[0] and y[0] the newest samples. Slow; only here for checking.
+    """
+    filtlen = max(len(a), len(b))
+    b = np.append(b, np.zeros(filtlen - len(b)))
+    a = np.append(a, np.zeros(filtlen - len(a)))
+    xs = np.zeros(filtlen)
+    ys = np.zeros(filtlen)
+    out = np.empty(len(x))
+    for i, val in enumerate(x):
+        xs = np.roll(xs, 1)
+        xs[0] = val
+        ys = np.roll(ys, 1)
+        ys[0] = 0.
+        ys[0] = (b.dot(xs) - a.dot(ys)) / a[0]
+        out[i] = ys[0]
+    return out
+
+
+if __name__ == '__main__':
+    test_cfg = {'mainsfreq': 50, 'notch_width': 0.5, 'filt_order': 3}
+    fs = 256
+    sos = notch_sos(test_cfg, fs)
+    # the old combined filter: convolved b/a polynomials of both notches
+    b, a = np.array([1.]), np.array([1.])
+    for centre in [50., 25.]:
+        stop = centre + test_cfg['notch_width'] * np.array([-1., 1.])
+        b_AC, a_AC = signal.butter(test_cfg['filt_order'], stop / (fs / 2.0),
+                                   'bandstop')
+        b, a = np.convolve(b, b_AC), np.convolve(a, a_AC)
+    t = np.arange(4 * fs) / float(fs)
+    x = 512 + 100 * np.sin(2 * np.pi * 50 * t) + np.random.randn(len(t)) * 20
+    expected = direct_form(b, a, x)
+    filt = NotchFilter(sos)
+    got = np.concatenate([filt.process(blk) for blk in np.array_split(x, 37)])
+    err = np.max(np.abs(got - expected))
+    print('max abs difference, block SOS vs per-sample: {:.3g}'.format(err))
+    print('OK' if err < 1e-6 * np.max(np.abs(expected)) else 'MISMATCH')
@@ -0,0 +1,881 @@
+# === engine.py ===
+# * Function: the acquisition and detection engine behind olimex-emg-read.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""The serial -> decode -> filter -> detect -> action pipeline, minus the GUI.
+
+Nothing in here needs Qt. The GUI (classes.DisplayWindow) is just one of
+the engine's subscribers; olimex-emg-read.py --headless runs without it.
+"""
+
+import sys
+import numpy as np
+from threading import Thread
+import multiprocessing
+import Queue
+import serial
+import datetime
+import time
+import packetlib as pl
+import dsplib
+import recordlib
+import timinglib
+import metricslib
+import tracelib
+import keyrules
+import keylib as kl
+
+
+class Channel(object):
+    """A class for the DSP done on one EMG channel."""
+
+    # the config keys a Channel uses, all a worker process gets (ProcessDSP)
+    CONFIG_KEYS = ['raw_output', 'datalen', 'indices', 'sampfreq', 'fftlen',
+                   'fft_overlap', 'mainsfreq', 'notch_width', 'filt_order',
+                   'detect_window', 'hold_ms', 'refractory_ms', 'envelope',
+                   'gap_policy', 'clock']
+
+    def __init__(self, ID, cfg, sampfreq=None):
+        """Basic constructor.
+
+        Takes parameters:
+        ID: string identifying the muscle attached to this channel.
+        index: int specifying where this channel is in the parsed_data array
+        cfg: the 'config' dict containing global constants.
+        sampfreq: the rate the samples really come at, Hz; default the one
+        cfg's sampfreq and clock say to expect, see timinglib.expected_rate.
+        """
+        self.cfg = cfg
+        if self.cfg['raw_output']:
+            print 'outputting raw'
+        self.raw_Q = dsplib.RingBuffer(cfg['datalen'])
+        self.datalen = cfg['datalen']
+        self.ID = ID
+        self.idx = cfg['indices'][ID]
+        if sampfreq is None:
+            sampfreq = timinglib.expected_rate(cfg)
+        self.sampfreq = sampfreq
+        self.data = dsplib.RingBuffer(cfg['datalen'])  # filtered history
+        # spectrum & median/mean freq, every hop samples
+        fftlen = cfg['fftlen']
+        self.spectrum = dsplib.SpectralAnalyser(
+            fftlen, max(int(fftlen * (1. - cfg['fft_overlap'])), 1), self.sampfreq)
+        # DSP setup - combined mains and mains/2 notch, as 2nd-order sections
+        # (a 2*mains notch would just be another notch_sos centre)
+        self.filt = dsplib.NotchFilter(dsplib.notch_sos(cfg, self.sampfreq))
+        # activity detection, on the filtered samples
+        hold = int(cfg['hold_ms'] * self.sampfreq / 1000.)
+        refractory = int(cfg['refractory_ms'] * self.sampfreq / 1000.)
+        self.detector = dsplib.ThresholdDetector(
+            cfg['detect_window'], hold=hold, refractory=refractory,
+            envelope=cfg['envelope'])
+        self.levels = np.zeros(2)  # on, off thresholds; see Engine.set_threshold
+
+    def set_rate(self, sampfreq):
+        """Change the sample rate, Hz, i.e. to what the board's OCR value says.
+
+        Redoes everything that depends on it: the notch filter (started
+        again from rest), spectrum frequencies and the detector's hold and
+        refractory times.
+        """
+        cfg = self.cfg
+        self.sampfreq = sampfreq
+        self.spectrum.freqs = np.fft.rfftfreq(self.spectrum.fftlen, 1. / sampfreq)
+        self.filt = dsplib.NotchFilter(dsplib.notch_sos(cfg, sampfreq))
+        self.detector.hold = int(cfg['hold_ms'] * sampfreq / 1000.)
+        self.detector.refractory = int(cfg['refractory_ms'] * sampfreq / 1000.)
+
+    def read_in(self, block, diffs, sampfreq=None):
+        """Fills in missed packets, then calls dsp() on this channel's data.
+
+        block: (N, 2 + nchans) array of decoded packets.
+        diffs: packet counter step for each packet, 1 if none were missed.
+        sampfreq: the block's sample rate (its timinglib.Stamp's), if known;
+        if it's changed, set_rate() is called first.
+        Returns the raw and filtered samples, gaps included; how the gaps
+        are filled is up to cfg['gap_policy'], see dsplib.fill_gaps.
+        """
+        if sampfreq is not None and sampfreq != self.sampfreq:
+            self.set_rate(sampfreq)
+        raw = dsplib.fill_gaps(block[:, self.idx], diffs, self.raw_Q.last(),
+                               self.cfg['gap_policy'])
+        return raw, self.dsp(raw)
+
+    def dsp(self, block):
+        """Performs the actual signal processing on a block of new samples.
+
+        50Hz  notch filter (Butterworth).
+        100Hz notch filter (Butterworth). <-- actually 25 Hz
+        Filter state is carried over between blocks, see dsplib.NotchFilter.
+        Then any spectrum frames that are due, see dsplib.SpectralAnalyser,
+        and activity detection, see detect().
+        NaNs (missed samples) are kept in the raw history, but everything
+        after that sees the sample before them instead: a NaN would stay
+        in the filter state for good.
+        """
+        held = dsplib.hold_nans(block, self.raw_Q.last())
+        self.raw_Q.extend(block)
+
+        if self.cfg['raw_output'] == True:
+            out = held
+        else:
+            out = self.filt.process(held)
+        self.data.extend(out)
+        self.spectrum.update(self.data)
+        self.detect(out)
+        return out
+
+    def detect(self, block):
+        """Run the detector over a block; the result is in detector.active."""
+        self.detector.set_thresholds(*self.levels.tolist())
+        return self.detector.process(block)
+
+    def share(self):
+        """Move the channel's outputs into shared memory, for ProcessDSP.
+
+        The histories, spectrum features and thresholds are all replaced
+        by shared copies. Returns what attach() needs to use the same
+        memory from a worker process.
+        """
+        spectrum = self.spectrum
+        self.raw_Q = dsplib.SharedRingBuffer.copy_of(self.raw_Q)
+        self.data = dsplib.SharedRingBuffer.copy_of(self.data)
+        spectrum.mean_freq = dsplib.SharedRingBuffer.copy_of(spectrum.mean_freq)
+        spectrum.median_freq = dsplib.SharedRingBuffer.copy_of(
+            spectrum.median_freq)
+        power, spectrum.power = dsplib.shared_array(spectrum.power)
+        levels, self.levels = dsplib.shared_array(self.levels)
+        return {'raw_Q': self.raw_Q, 'data': self.data,
+                'mean_freq': spectrum.mean_freq,
+                'median_freq': spectrum.median_freq,
+                'power': power, 'levels': levels}
+
+    def attach(self, shared):
+        """Use the shared memory from another Channel's share()."""
+        self.raw_Q = shared['raw_Q']
+        self.data = shared['data']
+        self.spectrum.mean_freq = shared['mean_freq']
+        self.spectrum.median_freq = shared['median_freq']
+        self.spectrum.power = np.frombuffer(shared['power'], np.float64)
+        self.levels = np.frombuffer(shared['levels'], np.float64)
+
+
+def _dsp_process(names, cfg, sampfreq, shared, inbox, outbox):
+    """Worker process for ProcessDSP: does the DSP of a group of channels.
+
+    Takes (block, diffs, sampfreq) from inbox and answers each with the
+    channels' detector states; None stops it.
+    """
+    channels = [Channel(name, cfg, sampfreq) for name in names]
+    for ch, state in zip(channels, shared):
+        ch.attach(state)
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        block, diffs, sampfreq = item
+        for ch in channels:
+            ch.read_in(block, diffs, sampfreq)
+        outbox.put([ch.detector.active for ch in channels])
+
+
+class ProcessDSP(object):
+    """Runs the Channels' DSP in worker processes, to get round the GIL.
+
+    The channels are split into nprocs groups, each filtered (and its
+    spectrum and detection done) by its own process. Every block is sent
+    to all of them and process() waits until they're all done with it.
+    The outputs - raw & filtered histories, spectrum features - are in
+    shared memory (see Channel.share), so the GUI and everything else
+    read the channels exactly as they would without worker processes.
+    """
+
+    def __init__(self, channels, nprocs, timeout=1.0):
+        """Constructor. Starts the worker processes."""
+        self.channels = channels
+        cfg = dict((key, channels[0].cfg[key]) for key in Channel.CONFIG_KEYS)
+        self.groups = [channels[i::nprocs] for i in range(nprocs)
+                       if channels[i::nprocs]]
+        self.timeout = timeout  # how often to check a worker is still alive
+        self.workers = []  # (process, inbox, outbox) per group
+        for group in self.groups:
+            inbox, outbox = multiprocessing.Queue(), multiprocessing.Queue()
+            proc = multiprocessing.Process(
+                target=_dsp_process,
+                args=([ch.ID for ch in group], cfg, group[0].sampfreq,
+                      [ch.share() for ch in group], inbox, outbox))
+            proc.daemon = True
+            proc.start()
+            self.workers.append((proc, inbox, outbox))
+
+    def process(self, block, diffs, sampfreq=None):
+        """Have every channel read_in a block; return what read_in would.
+
+        The (raw, filtered) samples returned are views of the shared
+        histories, valid until the next block is processed (and so only
+        the last datalen of them, if the block is longer than that).
+        """
+        if sampfreq is not None and sampfreq != self.channels[0].sampfreq:
+            for ch in self.channels:  # for the spectrum freqs the GUI uses
+                ch.set_rate(sampfreq)
+        for proc, inbox, outbox in self.workers:
+            inbox.put((block, diffs, sampfreq))
+        for group, (proc, inbox, outbox) in zip(self.groups, self.workers):
+            while True:
+                try:
+                    states = outbox.get(True, self.timeout)
+                    break
+                except Queue.Empty:
+                    if not proc.is_alive():
+                        raise RuntimeError('DSP worker process died')
+            for ch, active in zip(group, states):
+                ch.detector.active = active
+        n = int(diffs.sum())
+        return [(ch.raw_Q.latest(n), ch.data.latest(n)) for ch in self.channels]
+
+    def close(self):
+        """Stop the worker processes."""
+        for proc, inbox, outbox in self.workers:
+            inbox.put(None)
+        for proc, inbox, outbox in self.workers:
+            proc.join()
+
+
+class Board(object):
+    """One Olimex board on one serial port: reads and decodes its packets."""
+
+    def __init__(self, ser, nchans=pl.NUM_CHANS):
+        """Constructor. ser: an open serial port (or stand-in)."""
+        self.ser = ser
+        self.nchans = nchans
+        self.packet_size = pl.packet_size(nchans)
+        self.framer = pl.PacketFramer(self.packet_size)
+        self.bytes_read = 0
+        self.received = None  # when the last block's bytes came in
+
+    @property
+    def is_open(self):
+        return self.ser.is_open
+
+    @property
+    def eof(self):
+        """True once a recording being replayed has run out (a serial port
+        never does), see recordlib.ReplaySerial."""
+        return getattr(self.ser, 'eof', False)
+
+    def start(self):
+        """Throw away anything old, ready to start streaming."""
+        self.ser.reset_input_buffer()  # purge buffer
+        self.framer.reset()
+
+    def stop(self):
+        pass
+
+    def flush(self):
+        self.ser.reset_input_buffer()
+
+    def close(self):
+        if self.ser.is_open:
+            self.ser.close()
+
+    def read(self):
+        """Return the next block of decoded packets, or None on timeout.
+
+        Blocks until at least a packet's worth of bytes arrives (or the
+        port times out), then takes everything that's waiting; received is
+        when they did.
+        """
+        chunk = self.ser.read(max(self.packet_size, self.ser.in_waiting))
+        received = time.time()
+        self.bytes_read += len(chunk)
+        packets = self.framer.feed(chunk)
+        if not packets:
+            return None
+        self.received = received
+        return pl.decode_packets(packets, nchans=self.nchans)
+
+
+class BoardMerger(object):
+    """Several Boards, each read by its own thread, merged into one stream.
+
+    Each board's packets are put in order by its packet counter, starting
+    from the first packet it sends after start(), and packets it missed
+    are interpolated. Then row k of the merged stream is sample k of every
+    board: OCR value of the first board, a merged packet counter, then the
+    channels of each board in turn. The boards aren't clocked together, so
+    this is only as aligned as their crystals.
+    """
+
+    def __init__(self, boards, queue_len=256, max_lag=4096,
+                 gap_policy='interpolate'):
+        """Constructor.
+
+        max_lag: samples a board may get ahead of the slowest one before
+        its oldest are thrown away (i.e. if a board stops sending).
+        gap_policy: how missed packets are filled in, see dsplib.fill_gaps;
+        'nan' is taken as 'hold', the merged rows are integers.
+        """
+        self.boards = boards
+        self.gap_policy = 'hold' if gap_policy == 'nan' else gap_policy
+        self.nchans = sum(board.nchans for board in boards)
+        self.queue = Queue.Queue(queue_len)  # (board number, block, received)
+        self.max_lag = max_lag
+        self.threads = []
+        self.running = False
+        # stats
+        self.samples_filled = [0] * len(boards)  # interpolated, per board
+        self.samples_dropped = [0] * len(boards)  # lost to the queue or max_lag
+
+    @property
+    def is_open(self):
+        return all(board.is_open for board in self.boards)
+
+    @property
+    def eof(self):
+        """True once a board's recording has run out and been merged."""
+        return self.queue.empty() and any(
+            board.eof and not thread.is_alive()
+            for board, thread in zip(self.boards, self.threads))
+
+    def start(self):
+        """Reset every board and start their reader threads."""
+        self.pending = [[] for board in self.boards]  # gap-filled blocks
+        self.prev_count = [None] * len(self.boards)
+        self.last = [None] * len(self.boards)  # last samples, to fill from
+        self.ocr = 0
+        self.sample = 0  # merged samples handed out
+        self.received = None  # see read()
+        self.running = True
+        self.threads = []
+        for i, board in enumerate(self.boards):
+            board.start()
+            thread = Thread(target=self._read_board, args=(i,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Stop the reader threads."""
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+
+    def flush(self):
+        for board in self.boards:
+            board.flush()
+
+    def close(self):
+        for board in self.boards:
+            board.close()
+
+    def _read_board(self, i):
+        board = self.boards[i]
+        while self.running and board.is_open and not board.eof:
+            block = board.read()
+            if block is None:
+                continue
+            try:
+                self.queue.put((i, block, board.received), True, 0.1)
+            except Queue.Full:  # shows up as a gap, and gets filled
+                self.samples_dropped[i] += len(block)
+
+    def _take(self, i, block):
+        """Add a board's block to its pending samples, gaps filled in."""
+        counts = block[:, 1]
+        if self.prev_count[i] is None:
+            self.prev_count[i] = counts[0] - 1
+            self.last[i] = block[0, 2:]
+        diffs = np.diff(counts, prepend=self.prev_count[i]) % 256
+        diffs[diffs == 0] = 256  # a whole counter cycle went missing
+        self.prev_count[i] = counts[-1]
+        self.samples_filled[i] += int(diffs.sum()) - len(diffs)
+        if i == 0:
+            self.ocr = block[-1, 0]
+        filled = np.empty((diffs.sum(), block.shape[1] - 2))
+        for c in range(filled.shape[1]):
+            filled[:, c] = dsplib.fill_gaps(block[:, 2 + c], diffs,
+                                            self.last[i][c], self.gap_policy)
+        self.last[i] = filled[-1]
+        self.pending[i].append(filled)
+
+    def read(self, timeout=0.1):
+        """Return the next block of merged rows, or None if there are none yet.
+
+        received is when the earliest of the boards' blocks taken in came in.
+        """
+        received = []
+        try:
+            i, block, t = self.queue.get(True, timeout)
+            while True:  # take whatever else is waiting too
+                self._take(i, block)
+                received.append(t)
+                i, block, t = self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+        if received:
+            self.received = min(received)
+        pending = [np.concatenate(blocks) if blocks else np.zeros((0, board.nchans))
+                   for blocks, board in zip(self.pending, self.boards)]
+        n = min(len(p) for p in pending)
+        for i, p in enumerate(pending):
+            excess = len(p) - n - self.max_lag
+            if excess > 0:
+                self.samples_dropped[i] += excess
+                p = p[excess:]
+            self.pending[i] = [p[n:]] if len(p) > n else []
+            pending[i] = p[:n]
+        if not n:
+            return None
+        out = np.empty((n, 2 + self.nchans), np.int32)
+        out[:, 0] = self.ocr
+        out[:, 1] = (self.sample + np.arange(n)) % 256
+        np.rint(np.hstack(pending), out=out[:, 2:], casting='unsafe')
+        self.sample += n
+        return out
+
+
+class IO_handler(object):
+    """Handler for I/O."""
+
+    def __init__(self, port, bauds, channels, nowrite=True, read_timeout=0.1,
+                 queue_len=256, put_timeout=0.05, record_format='csv',
+                 flush_interval=1.0, ser=None, nchans=pl.NUM_CHANS, dsp=None,
+                 sampfreq=256, clock='ocr', gap_policy='interpolate',
+                 metrics=None, tracer=None):
+        """Constructor.
+
+        port: serial port name, or a list of them for several boards.
+        ser: optional stand-in for the serial port (or a list, one per
+        port), i.e. a recordlib.ReplaySerial; otherwise a serial.Serial is
+        opened.
+        nchans: channels per board (or a list, one per port).
+        dsp: optional ProcessDSP to do the channels' DSP, instead of the
+        DSP worker thread doing it itself.
+        sampfreq, clock: nominal sample rate and where the real one comes
+        from, see timinglib.SampleClock.
+        gap_policy: how missed packets are filled in, see dsplib.fill_gaps.
+        metrics: a metricslib.Metrics to report to, default a new one.
+        tracer: optional tracelib.Tracer to mark blocks' progress with.
+        """
+        ports = port if isinstance(port, list) else [port]
+        sers = ser if isinstance(ser, list) else [ser] * len(ports)
+        if not isinstance(nchans, list):
+            nchans = [nchans] * len(ports)
+        try:
+            self.boards = []
+            for port, ser, board_chans in zip(ports, sers, nchans):
+                if ser is None:
+                    ser = serial.Serial()
+                ser.port = port
+                ser.baudrate = bauds
+                ser.timeout = read_timeout  # so reads block instead of spinning
+                ser.open()
+                print 'connect success!'
+                self.boards.append(Board(ser, board_chans))
+            self.ser = self.boards[0].ser
+            self.framer = self.boards[0].framer
+            self.nchans = sum(nchans)  # channels in the merged stream
+            if len(self.boards) == 1:
+                self.source = self.boards[0]
+            else:
+                self.source = BoardMerger(self.boards, queue_len,
+                                          gap_policy=gap_policy)
+            self.channels = channels
+            self.dsp = dsp
+            # sample numbers, timestamps and gap/rate events
+            self.clock = timinglib.SampleClock(sampfreq, clock)
+            self.do_polling = False
+            self.kill_thread = False
+            self.nowrite = nowrite
+            self.docalibration = False  # record calibration data instead
+            self.cal_labels = {}  # channel -> cued state, for calibration files
+            self.subscribers = []  # called with (block, diffs, results, stamp)
+            self.record_format = record_format  # 'csv' or 'bin'
+            self.flush_interval = flush_interval  # seconds between file flushes
+            # decoded blocks go to a single DSP worker through a bounded queue;
+            # if it can't keep up the poller waits up to put_timeout, then
+            # drops the block and counts it
+            self.dsp_queue = Queue.Queue(queue_len)
+            self.put_timeout = put_timeout
+            self.queue_overflows = 0  # blocks dropped because the queue was full
+            self.samples_dropped = 0  # packets in those blocks
+            self.max_queue_depth = 0
+            self.metrics = metricslib.Metrics() if metrics is None else metrics
+            self.tracer = tracer
+            self._add_gauges()
+            self.dsp_threads = [Thread(target=self.dsp_worker, args=())]
+            for dsp_thread in self.dsp_threads:
+                dsp_thread.start()
+        except (OSError, serial.SerialException):
+            print 'Error opening serial port: ' + port
+            exit(2)
+
+    def _add_gauges(self):
+        """Report the stats kept all over the place through self.metrics."""
+        gauge = self.metrics.gauge
+        for i, board in enumerate(self.boards):
+            name = 'board{}.'.format(i)
+            gauge(name + 'bytes_read', lambda b=board: b.bytes_read)
+            gauge(name + 'packets', lambda b=board: b.framer.packets)
+            gauge(name + 'resyncs', lambda b=board: b.framer.resyncs)
+            gauge(name + 'bytes_discarded', lambda b=board: b.framer.discarded)
+            if self.source is not board:  # merged
+                gauge(name + 'samples_filled',
+                      lambda i=i: self.source.samples_filled[i])
+                gauge(name + 'samples_dropped',
+                      lambda i=i: self.source.samples_dropped[i])
+        gauge('clock.rate', lambda: self.clock.rate)
+        gauge('clock.gaps', lambda: self.clock.gaps)
+        gauge('clock.samples_missed', lambda: self.clock.missed)
+        gauge('dsp_queue.depth', self.dsp_queue.qsize)
+        gauge('dsp_queue.max_depth', lambda: self.max_queue_depth)
+        gauge('dsp_queue.overflows', lambda: self.queue_overflows)
+        gauge('dsp_queue.samples_dropped', lambda: self.samples_dropped)
+        gauge('keys.sent', lambda: kl.output.sent if kl.output else 0)
+        gauge('keys.coalesced', lambda: kl.output.coalesced if kl.output else 0)
+
+    def poll_serial(self):
+        """Monstrous function to handle serial comms and data output."""
+        source = self.source  # a Board, or a BoardMerger of several
+        while not self.kill_thread:  # superloop
+            if source.is_open and self.do_polling:
+                # this only runs once when do_polling becomes true
+                clock = self.clock
+                tracer = self.tracer
+                nowrite = self.nowrite
+                docalibration = self.docalibration
+                output = None  # a recordlib.RecordWriter, when recording
+                if not nowrite:
+                    output = self._open_output_file(docalibration)
+                # initialize counter, clock and the board(s)
+                samples = 0
+                clock.reset()
+                source.start()
+                while source.is_open and self.do_polling:  # superloop in a superloop
+                    block = source.read()
+                    if block is None:
+                        if source.eof:  # the end of a replay
+                            break
+                        continue
+                    samples += len(block)
+                    if not nowrite and not docalibration:  # write it
+                        output.put(block)
+
+                    # packet counter steps & when the block was sampled
+                    diffs, stamp = clock.update(block, source.received)
+                    if tracer is not None:
+                        tracer.mark(stamp.sample, 'read', stamp.received)
+
+                    # hand the block to the DSP worker
+                    cal_output = output if docalibration else None
+                    try:
+                        self.dsp_queue.put((block, diffs, stamp, cal_output),
+                                           True, self.put_timeout)
+                    except Queue.Full:
+                        self.queue_overflows += 1
+                        self.samples_dropped += len(block)
+                    self.max_queue_depth = max(self.max_queue_depth,
+                                               self.dsp_queue.qsize())
+                source.stop()
+                # let the DSP worker catch up before closing anything
+                self.dsp_queue.join()
+                for board in self.boards:
+                    if board.framer.resyncs:
+                        print 'Lost sync on {} {} times, discarded {} bytes'.format(
+                            board.ser.port, board.framer.resyncs, board.framer.discarded)
+                if source is not self.boards[0]:
+                    print 'Interpolated {} samples, dropped {}, per board'.format(
+                        source.samples_filled, source.samples_dropped)
+                if clock.missed:
+                    print 'Missed {} packets in {} gaps'.format(clock.missed,
+                                                               clock.gaps)
+                if abs(clock.mismatch()) > 0.01:
+                    print 'OCR {} means {:.1f} Hz, not the {:.1f} Hz expected'.format(
+                        clock.ocr, timinglib.ocr_rate(clock.ocr, clock.nominal),
+                        clock.expected)
+                if self.queue_overflows:
+                    print 'DSP queue overflowed {} times, dropped {} samples'.format(
+                        self.queue_overflows, self.samples_dropped)
+                if not nowrite:
+                    # clean up (stream stop) - finish writing & close output file
+                    output.close()
+                    if output.dropped_blocks:
+                        print 'Recording fell behind, dropped {} blocks'.format(
+                            output.dropped_blocks)
+                    print "Recorded {} samples to {}".format(samples, output.filename)
+                if source.eof:
+                    print 'End of the recording'
+                    break
+            else:
+                # flush serial buffer & sleep half a second
+                source.flush()
+                time.sleep(0.5)
+
+        # clean up (exit) - stop DSP worker and close serial port(s)
+        source.close()
+        self.dsp_queue.put(None)
+        return
+
+    def dsp_worker(self):
+        """Runs every channel's DSP on each block the poller queues up.
+
+        Blocks until there is something to do; a None in the queue stops it.
+        """
+        while True:
+            item = self.dsp_queue.get()
+            if item is None:
+                self.dsp_queue.task_done()
+                break
+            block, diffs, stamp, cal_output = item
+            start = time.time()
+            if self.dsp is not None:
+                results = self.dsp.process(block, diffs, stamp.rate)
+            else:
+                results = [ch.read_in(block, diffs, stamp.rate)
+                           for ch in self.channels]
+            done = time.time()
+            self.metrics.observe('time.dsp', done - start)
+            self.metrics.observe('latency.dsp', done - stamp.received)
+            if self.tracer is not None:
+                self.tracer.mark(stamp.sample, 'dsp')
+            self.metrics.count('samples.processed', stamp.samples)
+            if cal_output is not None:
+                self._write_calibration(cal_output, block, diffs, results)
+            for callback in self.subscribers:
+                callback(block, diffs, results, stamp)
+            self.dsp_queue.task_done()
+        if self.dsp is not None:
+            self.dsp.close()
+        print 'DSP worker terminating...'
+        return
+
+    def _write_calibration(self, output, block, diffs, results):
+        """Queue one calibration line per packet: raw, filt, cal per channel."""
+        real = np.cumsum(diffs) - 1  # where the received packets ended up
+        lines = []
+        for row, i in zip(block.tolist(), real):
+            output_line = '{},{},'.format(row[0], row[1])
+            for ch, (raw, filt) in zip(self.channels, results):
+                cal = self.cal_labels.get(ch.ID, 0)
+                output_line += '{0:.0f},{1:.2f},{2},'.format(raw[i], filt[i], cal)
+            lines.append(output_line + '\n')
+        output.put(''.join(lines))
+
+    def _open_output_file(self, docalibration):
+        """Open a recording file and return a RecordWriter for it."""
+        binary = self.record_format == 'bin' and not docalibration
+        filename = datetime.datetime.now().strftime("data_%Y-%m-%d_%H%M-%S")
+        filename += '.bin' if binary else '.csv'
+        if docalibration:
+            filename = 'calibration_' + filename
+        filename = './data/' + filename
+        try:
+            if binary:
+                cfg = self.channels[0].cfg
+                recorder = recordlib.BinaryRecorder(filename, cfg['sampfreq'],
+                                                    cfg['indices'],
+                                                    pl.decoded_cols(self.nchans))
+            elif not docalibration:
+                recorder = recordlib.CsvRecorder(filename,
+                                                 recordlib.csv_header(self.nchans))
+            else:
+                # sorted(channels, key=lambda ch: ch.idx)
+                # output.write("Columns\nOCRval,count,Ch0,Ch1,Ch2,Ch3\n")
+                header_line = "Columns\n,,"
+                line2 = '\nOCRval,count,'
+                for ch in self.channels:
+                    header_line += 'Ch{} ({}),,,'.format(ch.idx-2, ch.ID)
+                    line2 += 'raw,filt,cal,'
+                line2 += '\n'
+                header_line += line2
+                recorder = recordlib.CsvRecorder(filename, header_line)
+        except (OSError, IOError):
+            print 'Error opening file: {}'.format(filename)
+            exit(2)
+        return recordlib.RecordWriter(recorder, flush_interval=self.flush_interval)
+
+
+class Engine(object):
+    """The whole pipeline: IO_handler, Channels, detection and key events.
+
+    Detection is part of each Channel's DSP, sample by sample (see
+    dsplib.ThresholdDetector), so it keeps up with the sample rate whether
+    or not anything is drawing plots. With cfg['dsp_procs'] set, that DSP
+    runs in worker processes (see ProcessDSP).
+    Subscribers (i.e. the GUI) are called from the DSP worker thread with
+    (results, changed): results maps channel name -> (raw, filtered)
+    samples of the block, changed lists channels whose state just flipped.
+    While they're being called, stamp is the block's timinglib.Stamp.
+    """
+
+    def __init__(self, cfg, port, bauds, ser=None, nowrite=True):
+        """Constructor. Opens the port, but doesn't start streaming."""
+        self.cfg = cfg
+        # channel list in the same order as the data packet
+        self.channels = sorted([Channel(name, cfg) for name in cfg['plot_names']],
+                               key=lambda ch: ch.idx)
+        self.names = [ch.ID for ch in self.channels]
+        self.thresholds = dict((name, 0) for name in self.names)  # 'on', counts
+        self.states = dict((name, False) for name in self.names)
+        self.bits = 0  # the states packed, bit i = channel i, see keyrules
+        self.stamp = None  # when the latest block was sampled
+        # keyboard events: see key_map
+        self.sendkeys = False
+        self.key_map = []
+        self.subscribers = []
+        self.metrics = metricslib.Metrics()  # see also start()
+        self.metrics_logger = None
+        self.metrics_server = None
+        # opt-in latency trace, written to cfg['trace'] by stop()
+        self.tracer = tracelib.Tracer(cfg['trace']) if cfg['trace'] else None
+        dsp = None
+        if cfg['dsp_procs']:
+            dsp = ProcessDSP(self.channels, cfg['dsp_procs'])
+        self.handler = IO_handler(port, bauds, self.channels, nowrite,
+                                  record_format=cfg['record_format'], ser=ser,
+                                  nchans=cfg['board_chans'], dsp=dsp,
+                                  sampfreq=cfg['sampfreq'], clock=cfg['clock'],
+                                  gap_policy=cfg['gap_policy'],
+                                  metrics=self.metrics, tracer=self.tracer)
+        self.handler.subscribers.append(self._on_block)
+        self.poller = Thread(target=self.handler.poll_serial, args=())
+
+    @property
+    def rate(self):
+        """The sample rate, Hz, as the clock has it (see timinglib.SampleClock)."""
+        return self.handler.clock.rate
+
+    def subscribe(self, callback):
+        """Have callback(results, changed) called after every block."""
+        self.subscribers.append(callback)
+
+    def start(self):
+        """Start the serial poller thread. Set handler.do_polling to stream.
+
+        Also starts the periodic metrics log line (every
+        cfg['metrics_log_s'] seconds) and the metrics HTTP endpoint (on
+        cfg['metrics_port']), if they're turned on.
+        """
+        if self.cfg['metrics_log_s']:
+            self.metrics_logger = metricslib.MetricsLogger(
+                self.metrics, self.cfg['metrics_log_s'],
+                lambda line: sys.stdout.write(line + '\n'))
+        if self.cfg['metrics_port'] is not None:
+            self.metrics_server = metricslib.MetricsServer(
+                self.metrics, self.cfg['metrics_port'])
+            print 'Metrics on http://127.0.0.1:{}/metrics'.format(
+                self.metrics_server.port)
+        self.poller.start()
+
+    def stop(self):
+        """Stop streaming, close the port and wait for all threads to finish."""
+        self.handler.do_polling = False
+        self.handler.kill_thread = True
+        if self.poller.ident is None:
+            self.poller.start()  # it still has to close the port & stop the worker
+        self.poller.join()
+        for thread in self.handler.dsp_threads:
+            thread.join()
+        self.release_keys()
+        if self.metrics_logger is not None:
+            self.metrics_logger.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.tracer is not None:
+            summary = self.tracer.close()
+            print 'Latency trace written to {}'.format(self.tracer.filename)
+            for line in tracelib.format_summary(summary):
+                print line
+
+    def set_threshold(self, name, value):
+        """Set a channel's 'on' threshold; 'off' follows from cfg['hysteresis']."""
+        self.thresholds[name] = value
+        ch = self.channels[self.names.index(name)]
+        ch.levels[:] = [value, value * (1. - self.cfg['hysteresis'])]
+
+    def update_states(self):
+        """Take each channel's detector state; return the names that changed."""
+        changed = []
+        for i, ch in enumerate(self.channels):
+            if ch.detector.active != self.states[ch.ID]:
+                self.states[ch.ID] = ch.detector.active
+                self.bits ^= 1 << i
+                changed.append(ch.ID)
+        return changed
+
+    @property
+    def key_map(self):
+        """Key bindings: a list of (key code, {channel: True/False/None}).
+
+        True = must be active, False = must be inactive, None = don't care.
+        A binding can also be (key code, conditions, group, priority), see
+        keyrules.KeyRules. Setting it compiles the rules; keys held down
+        that the new rules don't want are let go on the next block.
+        """
+        return self._key_map
+
+    @key_map.setter
+    def key_map(self, key_map):
+        rules = keyrules.KeyRules(self.names, key_map)
+        old = getattr(self, 'key_rules', None)
+        if old is not None:
+            rules.pressed = old.pressed
+        self._key_map = key_map
+        self.key_rules = rules
+
+    def send_keys(self):
+        """Press and release keys as the channel states call for.
+
+        Only changes are sent: a key is pressed once when its rule starts
+        matching and released once when it stops. The events are sent
+        from keylib's output thread, so this never waits on the OS.
+        """
+        if not kl.available():
+            return
+        press, release = self.key_rules.update(self.bits)
+        for key in release:
+            kl.KeyUp(key, True)
+        for key in press:
+            kl.KeyDown(key, True)
+        if press or release:
+            kl.when_sent(self._keys_sent(self.stamp))
+
+    def _keys_sent(self, stamp):
+        """What keylib's output thread calls once a block's keys are sent."""
+        tracer = self.tracer
+
+        def sent():
+            self.metrics.observe('latency.keys', time.time() - stamp.received)
+            if tracer is not None:
+                tracer.mark(stamp.sample, 'keys')
+        return sent
+
+    def release_keys(self):
+        """Let go of every key send_keys is holding down."""
+        for key in self.key_rules.release_all():
+            kl.KeyUp(key, True)
+
+    def _on_block(self, block, diffs, results, stamp):
+        self.stamp = stamp
+        changed = self.update_states()
+        self.metrics.observe('latency.detect', time.time() - stamp.received)
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.mark(stamp.sample, 'detect')
+        if changed:
+            self.metrics.count('state_changes', len(changed))
+        if self.sendkeys:
+            self.send_keys()
+        elif self.key_rules.pressed:  # just turned off
+            self.release_keys()
+        results = dict(zip(self.names, results))
+        for callback in self.subscribers:
+            callback(results, changed)
+
@@ -12,11 +12,25 @@
 """A library for the key-press related functions.
 
 Originally named 'keytest.py'.
+
+Key codes are Windows virtual-key codes (Base) whatever the platform.
+KeyDown/KeyUp only queue the event; a dedicated output thread sends it
+through a backend, so a slow OS call never holds up the caller:
+    'windows'   win32api.keybd_event
+    'uinput'    a virtual keyboard through Linux uinput (needs python-evdev
+                and write access to /dev/uinput)
+    'recording' nothing is sent, events are kept in .events (for tests)
+use() picks one (by default the first of windows and uinput that works);
+it's called with the default the first time it's needed.
 """
 
-from win32api import keybd_event
+import os
 import time
 import threading
+try:
+    import Queue
+except ImportError:  # python 3
+    import queue as Queue
 
 loop = False;
 pressed_keys = set()
@@ -39,12 +53,220 @@ Base = {
     'VOLUP': 175,    'DOLDOWN': 174,    'NUMLOCK': 144,    'SCROLL': 145
     }
 
+# evdev key names for Base, where they aren't just KEY_ + the name
+EVDEV_NAMES = {
+    '.': 'KEY_DOT',    '-': 'KEY_MINUS',    ',': 'KEY_COMMA',
+    '=': 'KEY_EQUAL',    '/': 'KEY_SLASH',    ';': 'KEY_SEMICOLON',
+    '[': 'KEY_LEFTBRACE',    ']': 'KEY_RIGHTBRACE',    '\\': 'KEY_BACKSLASH',
+    "'": 'KEY_APOSTROPHE',    'ALT': 'KEY_LEFTALT',    'BS': 'KEY_BACKSPACE',
+    'CTRL': 'KEY_LEFTCTRL',    ' ': 'KEY_SPACE',    'PRINTSCR': 'KEY_SYSRQ',
+    'INS': 'KEY_INSERT',    'DEL': 'KEY_DELETE',    'LWIN': 'KEY_LEFTMETA',
+    'RWIN': 'KEY_RIGHTMETA',    'LSHIFT': 'KEY_LEFTSHIFT',
+    'SHIFT': 'KEY_RIGHTSHIFT',    'LCTRL': 'KEY_LEFTCTRL',
+    'RCTRL': 'KEY_RIGHTCTRL',    'VOLUP': 'KEY_VOLUMEUP',
+    'DOLDOWN': 'KEY_VOLUMEDOWN',    'SCROLL': 'KEY_SCROLLLOCK'
+    }
+
+
+class WindowsBackend(object):
+    """Sends keys with win32api.keybd_event."""
+
+    def __init__(self):
+        from win32api import keybd_event
+        self.keybd_event = keybd_event
+
+    def press(self, Key):
+        self.keybd_event(Key, 0, 1, 0)
+
+    def release(self, Key):
+        self.keybd_event(Key, 0, 2, 0)
+
+    def close(self):
+        pass
+
+
+class UinputBackend(object):
+    """Sends keys from a virtual keyboard made through Linux uinput."""
+
+    def __init__(self):
+        from evdev import UInput, ecodes
+        self.ecodes = ecodes
+        self.codes = {}  # Base code -> evdev code
+        for name, Key in Base.items():
+            code = getattr(ecodes, EVDEV_NAMES.get(name, 'KEY_' + name.upper()),
+                           None)
+            if code is not None:
+                self.codes[Key] = code
+        self.ui = UInput({ecodes.EV_KEY: sorted(set(self.codes.values()))},
+                         name='olimex-emg-read')
+
+    def _write(self, Key, value):
+        code = self.codes.get(Key)
+        if code is not None:
+            self.ui.write(self.ecodes.EV_KEY, code, value)
+            self.ui.syn()
+
+    def press(self, Key):
+        self._write(Key, 1)
+
+    def release(self, Key):
+        self._write(Key, 0)
+
+    def close(self):
+        self.ui.close()
+
+
+class RecordingBackend(object):
+    """Sends nothing; keeps (time, key code, pressed) in .events."""
+
+    def __init__(self):
+        self.events = []
+
+    def press(self, Key):
+        self.events.append((time.time(), Key, True))
+
+    def release(self, Key):
+        self.events.append((time.time(), Key, False))
+
+    def close(self):
+        pass
+
+
+BACKENDS = {'windows': WindowsBackend,
+            'uinput': UinputBackend,
+            'recording': RecordingBackend}
+AUTO = ['windows', 'uinput'] if os.name == 'nt' else ['uinput']
+
+
+class KeyOutput(object):
+    """Sends queued key events through a backend, from its own thread.
+
+    Everything waiting on the queue is taken in one go and coalesced per
+    key: only a change from the key's current state is sent, except that
+    a press and release that cancel out are still sent as one tap.
+    Callbacks queued with when_sent() are called once the events queued
+    before them have been sent.
+    """
+
+    def __init__(self, backend):
+        """Constructor. Starts the output thread."""
+        self.backend = backend
+        self.queue = Queue.Queue()
+        self.down = set()  # keys the backend has been told are pressed
+        # stats
+        self.sent = 0  # events sent to the backend
+        self.coalesced = 0  # events that didn't need sending
+        self.thread = threading.Thread(target=self._run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, Key, pressed):
+        self.queue.put((Key, pressed))
+
+    def when_sent(self, callback):
+        self.queue.put(callback)
+
+    def close(self):
+        """Send whatever is queued and let go of any keys still down, then
+        stop the thread and the backend."""
+        self.queue.put(None)
+        self.thread.join()
+        for Key in sorted(self.down):
+            self.backend.release(Key)
+            self.sent += 1
+        self.down.clear()
+        self.backend.close()
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            try:  # grab whatever else is waiting
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if None in batch:  # close() was called
+                batch = batch[:batch.index(None)]
+                running = False
+            callbacks = [item for item in batch if callable(item)]
+            wanted = {}  # key -> requested states, in order
+            for Key, pressed in [item for item in batch
+                                 if not callable(item)]:
+                wanted.setdefault(Key, []).append(pressed)
+            for Key, states in wanted.items():
+                was = Key in self.down
+                send = [states[-1]] if states[-1] != was else []
+                if not send and len(set(states)) > 1:
+                    send = [not was, was]  # a tap, or a let go & press again
+                for pressed in send:
+                    if pressed:
+                        self.backend.press(Key)
+                        self.down.add(Key)
+                    else:
+                        self.backend.release(Key)
+                        self.down.discard(Key)
+                self.sent += len(send)
+                self.coalesced += len(states) - len(send)
+            for callback in callbacks:
+                callback()
+
+
+output = None  # the KeyOutput in use, see use()
+_tried = False
+
+
+def use(name=None):
+    """Send keys through backend `name` (see BACKENDS), or the first that works.
+
+    Returns the backend, or None if none could be opened - KeyDown and
+    KeyUp then keep track of pressed_keys but send nothing.
+    """
+    global output, _tried
+    close()
+    _tried = True
+    for name in [name] if name else AUTO:
+        try:
+            backend = BACKENDS[name]()
+        except Exception:  # no module, no /dev/uinput access, etc.
+            continue
+        output = KeyOutput(backend)
+        return backend
+    return None
+
+
+def available():
+    """True if keys are actually going somewhere."""
+    if not _tried:
+        use()
+    return output is not None
+
+
+def close():
+    """Stop sending keys (any still queued are sent first, and any still
+    pressed are let go)."""
+    global output, _tried
+    if output is not None:
+        output.close()
+    output, _tried = None, False
+    pressed_keys.clear()
+
+
+def when_sent(callback):
+    """Have callback() called, from the output thread, once every key event
+    queued so far has been sent (i.e. to time them). Never called if keys
+    aren't going anywhere."""
+    if output is not None:
+        output.when_sent(callback)
+
+
 def KeyUp(Key, raw=False):
     if not raw:
         Key = Base[Key]
     if Key in pressed_keys:
         pressed_keys.remove(Key)
-        keybd_event(Key, 0, 2, 0)
+        if available():
+            output.put(Key, False)
 
 
 def KeyDown(Key, raw=False):
@@ -52,7 +274,8 @@ def KeyDown(Key, raw=False):
         Key = Base[Key]
     if Key not in pressed_keys:
         pressed_keys.add(Key)
-        keybd_event(Key, 0, 1, 0)
+        if available():
+            output.put(Key, True)
 
 
 def loopKeys():
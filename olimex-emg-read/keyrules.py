@@ -0,0 +1,89 @@
+# === keyrules.py ===
+# * Function: channel state -> key press rules for olimex-emg-read.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""A library for deciding which keys to hold down, given the channel states.
+
+The channel states are packed into one integer, bit i set when channel i
+is active. Each key binding is compiled into a rule of two bitmasks:
+    on:  channels that must be active
+    off: channels that must be inactive
+and the rule matches a state when state & on == on and state & off == 0.
+Bindings can be put in an exclusive group: of the matching rules in a
+group only the one with the highest priority (then the earliest) counts,
+i.e. 'forward' and 'jump' both want finger extension but only one
+should fire.
+
+Which keys a state holds down is worked out once per state and cached,
+so a tick costs a dict lookup whatever the number of bindings, and
+update() only returns the keys that have to change.
+"""
+
+
+class KeyRules(object):
+    """A key map compiled into bitmask rules."""
+
+    def __init__(self, names, key_map):
+        """Constructor.
+
+        names: channel names, in bit order.
+        key_map: list of (key, {channel: True/False/None}) - True = must
+        be active, False = must be inactive, None = don't care - or
+        (key, conditions, group, priority) to put a binding in an
+        exclusive group (None = no group), where higher priority wins.
+        """
+        bit = dict((name, 1 << i) for i, name in enumerate(names))
+        self.rules = []  # (key, on mask, off mask, group, priority)
+        for binding in key_map:
+            key, conds = binding[:2]
+            group, priority = (tuple(binding[2:4]) + (None, 0))[:2]
+            on = off = 0
+            for name, want in conds.items():
+                if want is True:
+                    on |= bit[name]
+                elif want is False:
+                    off |= bit[name]
+            self.rules.append((key, on, off, group, priority))
+        self.keys = set(rule[0] for rule in self.rules)
+        self._cache = {}  # state -> frozenset of keys to hold down
+        self._state = None  # state update() last saw
+        self.pressed = frozenset()  # keys update() has pressed
+
+    def keys_for(self, state):
+        """The set of keys to hold down in a channel state."""
+        keys = self._cache.get(state)
+        if keys is None:
+            best = {}  # group -> ((priority, -index), key) of the winner
+            held = set()
+            for i, (key, on, off, group, priority) in enumerate(self.rules):
+                if state & on != on or state & off:
+                    continue
+                if group is None:
+                    held.add(key)
+                elif group not in best or (priority, -i) > best[group][0]:
+                    best[group] = ((priority, -i), key)
+            held.update(key for rank, key in best.values())
+            keys = self._cache[state] = frozenset(held)
+        return keys
+
+    def update(self, state):
+        """Move to a new channel state; return the keys to (press, release)."""
+        if state == self._state:
+            return (), ()
+        self._state = state
+        keys = self.keys_for(state)
+        press, release = keys - self.pressed, self.pressed - keys
+        self.pressed = keys
+        return press, release
+
+    def release_all(self):
+        """Forget the state; return the keys that were being held down."""
+        release, self.pressed, self._state = self.pressed, frozenset(), None
+        return release
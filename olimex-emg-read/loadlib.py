@@ -0,0 +1,227 @@
+# === loadlib.py ===
+# * Function: fast, chunked loading of recorded olimex-emg-read sessions.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""A library for reading recorded sessions back, a block at a time.
+
+Three layouts are recognised from the start of the file:
+    binary       recordlib's binary format (BIN_MAGIC, JSON header, records)
+    raw          'RAW DATA ONLY', a line of column names, then one packet
+                 per line: OCRval,count,Ch0,Ch1...
+    calibration  'Columns', a line of channel names ('Ch0 (fi_ext)'), a
+                 line of column names, then OCRval,count and raw,filt,cal
+                 per channel, every line ending in a comma
+Whatever the layout, Session.blocks() yields (N, 2 + nchans) int32 arrays
+laid out as packetlib.decode_packets' output - for calibration files the
+raw columns are picked out and filt/cal are skipped.
+
+CSV text is read in big byte chunks and each chunk is parsed in one
+np.fromstring call, not line by line; only a chunk with a bad line in it
+(i.e. a half-written last line after a crash) is redone line by line, and
+the bad lines dropped. With cache=True the packets are also written to a
+binary recording next to the CSV (its name + CACHE_SUFFIX) as it's read,
+and later loads memory-map that instead, so long as the CSV's size and
+modification time haven't changed.
+"""
+
+import os
+import warnings
+import numpy as np
+import recordlib
+
+LAYOUTS = ['binary', 'raw', 'calibration']
+CACHE_SUFFIX = '.cache'
+CHUNK_BYTES = 1 << 20  # CSV bytes parsed at a time
+
+
+def _source_of(filename):
+    """What a cache has to match to still be valid for filename."""
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+class Session(object):
+    """A recording, of any layout, to be read in blocks.
+
+    Attributes: layout (one of LAYOUTS), nchans, channels (dict of channel
+    name -> column in the blocks, or None if the file doesn't say; raw
+    CSVs don't), meta (the binary header, if any), cached (True if it's
+    being read from a cache file).
+    """
+
+    def __init__(self, filename, cache=False):
+        """Constructor. Reads just the header.
+
+        cache: read the cache file if it's up to date, and write it if not.
+        """
+        self.filename = filename
+        self.cache = filename + CACHE_SUFFIX if cache else None
+        self.meta = None
+        self.cached = False
+        with open(filename, 'rb') as f:
+            magic = f.read(len(recordlib.BIN_MAGIC))
+        if magic == recordlib.BIN_MAGIC:
+            self.layout = 'binary'
+            self._open_binary(filename)
+            return
+        with open(filename, 'rb') as f:
+            head = [f.readline().decode('utf-8', 'replace') for i in range(3)]
+        if head[0].strip() == 'Columns':
+            self.layout = 'calibration'
+            names = [field.split('(')[-1].rstrip(')')
+                     for field in head[1].strip().split(',') if field]
+            self.nchans = len(names)
+            self.channels = dict((name, 2 + i) for i, name in enumerate(names))
+            self.header_lines = 3
+            self.ncols = 2 + 3 * self.nchans  # the trailing comma's dropped
+            self.usecols = [0, 1] + [2 + 3 * i for i in range(self.nchans)]
+        elif head[0].strip() == 'RAW DATA ONLY':
+            self.layout = 'raw'
+            self.nchans = len(head[1].strip().split(',')) - 2
+            self.channels = None
+            self.header_lines = 2
+            self.ncols = 2 + self.nchans
+            self.usecols = None
+        else:
+            raise ValueError('not an EMG recording: {}'.format(filename))
+        if self.cache and os.path.exists(self.cache):
+            try:
+                meta = recordlib.read_header(self.cache)[0]
+            except (ValueError, IOError, OSError):
+                meta = None
+            if meta and meta.get('source') == _source_of(filename):
+                self._open_binary(self.cache)
+                self.cached = True
+
+    def _open_binary(self, filename):
+        self.meta, self.data = recordlib.read_binary(filename)
+        self.nchans = len(self.meta['columns']) - 2
+        self.channels = dict(self.meta['channels']) or None
+
+    def blocks(self, rows=65536):
+        """Yield the packets in (N, 2 + nchans) int32 blocks of `rows` (the
+        last one may be shorter)."""
+        if self.layout == 'binary' or self.cached:
+            for i in range(0, len(self.data), rows):
+                yield np.asarray(self.data[i:i + rows], np.int32)
+            return
+        if not self.cache:
+            for block in _rebatch(self._parse_chunks(), rows):
+                yield block
+            return
+        # write a cache as we go, under a temporary name until it's complete
+        tmp = self.cache + '.tmp'
+        try:
+            recorder = recordlib.BinaryRecorder(
+                tmp, None, self.channels or {},
+                ['OCRval', 'count'] + ['Ch{}'.format(i)
+                                       for i in range(self.nchans)])
+            recorder.meta['source'] = _source_of(self.filename)
+        except (IOError, OSError):  # i.e. a read-only directory: no cache
+            recorder = None
+        done = False
+        try:
+            for block in _rebatch(self._parse_chunks(), rows):
+                if recorder is not None:
+                    recorder.write(block)
+                yield block
+            done = True
+        finally:
+            if recorder is not None:
+                recorder.close()
+                if done:
+                    if os.path.exists(self.cache):  # os.rename won't on Windows
+                        os.remove(self.cache)
+                    os.rename(tmp, self.cache)
+                else:
+                    os.remove(tmp)
+
+    def read(self):
+        """All the packets at once, an (N, 2 + nchans) int32 array."""
+        if self.layout == 'binary' or self.cached:
+            return np.asarray(self.data, np.int32)
+        return np.concatenate(
+            [np.zeros((0, 2 + self.nchans), np.int32)] +
+            list(self.blocks(1 << 20)))
+
+    def _parse_chunks(self):
+        """Parse the CSV in CHUNK_BYTES pieces, yielding arrays of packets."""
+        with open(self.filename, 'rb') as f:
+            for i in range(self.header_lines):
+                f.readline()
+            rest = b''
+            while True:
+                data = f.read(CHUNK_BYTES)
+                if not data:
+                    break
+                data = rest + data
+                end = data.rfind(b'\n') + 1
+                rest = data[end:]
+                if end:
+                    yield self._parse(data[:end])
+            if rest.strip():
+                yield self._parse(rest)
+
+    def _parse(self, text):
+        """Parse whole lines of CSV text into an (N, 2 + nchans) array."""
+        text = text.replace(b'\r', b'')
+        if self.layout == 'calibration':
+            text = text.replace(b',\n', b'\n')
+        lines = text.count(b'\n') + (not text.endswith(b'\n'))
+        with warnings.catch_warnings():  # a bad field only stops the parse
+            warnings.simplefilter('ignore')
+            # filt is a float, so calibration files go through float64
+            values = np.fromstring(text.replace(b'\n', b',').rstrip(b','),
+                                   np.float64 if self.usecols else np.int32,
+                                   sep=',')
+        if len(values) == lines * self.ncols:
+            values = values.reshape(lines, self.ncols)
+        else:
+            values = self._parse_lines(text)
+        if self.usecols:
+            values = values[:, self.usecols]
+        return values.astype(np.int32)
+
+    def _parse_lines(self, text):
+        """The slow way: line by line, dropping lines that don't parse."""
+        rows = []
+        for line in text.decode('utf-8', 'replace').split('\n'):
+            fields = line.rstrip(',').split(',')
+            if len(fields) != self.ncols:
+                continue
+            try:
+                rows.append([float(x) for x in fields])
+            except ValueError:
+                continue
+        return np.array(rows, np.float64).reshape(-1, self.ncols)
+
+
+def _rebatch(arrays, rows):
+    """Re-cut a stream of arrays into blocks of exactly `rows` rows."""
+    pending = []
+    count = 0
+    for a in arrays:
+        pending.append(a)
+        count += len(a)
+        if count < rows:
+            continue
+        a = np.concatenate(pending)
+        end = len(a) - len(a) % rows
+        for i in range(0, end, rows):
+            yield a[i:i + rows]
+        pending = [a[end:]]
+        count = len(a) - end
+    if count:
+        yield np.concatenate(pending)
+
+
+def load(filename, cache=False):
+    """Load a whole recording as an (N, 2 + nchans) int32 array."""
+    return Session(filename, cache).read()
@@ -0,0 +1,200 @@
+# === metricslib.py ===
+# * Function: counters, histograms and a status endpoint for olimex-emg-read.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""A library for keeping an eye on the acquisition pipeline while it runs.
+
+Metrics holds three kinds of thing, all by name:
+    counters: numbers that only go up, bumped with count()
+    gauges: functions called when a snapshot is taken, for stats that are
+        kept somewhere already (i.e. PacketFramer.resyncs) - they cost
+        nothing until someone looks
+    histograms: durations, added with observe(), kept in log-spaced
+        buckets so percentiles come out to within a bucket (~12%)
+Each counter and histogram should only be written from one thread; the
+GIL does the rest. snapshot() gives all of it as a dict, which is what
+the periodic log line, the GUI status panel and MetricsServer (JSON over
+HTTP on localhost) show:
+    curl http://127.0.0.1:8765/metrics
+"""
+
+import json
+import time
+import bisect
+from threading import Thread
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:  # python 3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# histogram bucket upper bounds, seconds: 1 us to ~100 s, 20 per decade
+BOUNDS = [10 ** (e / 20.) for e in range(-120, 41)]
+
+
+class Histogram(object):
+    """Counts of durations, in log-spaced buckets (see BOUNDS)."""
+
+    def __init__(self):
+        """Constructor."""
+        self.counts = [0] * (len(BOUNDS) + 1)  # the last one is overflow
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def observe(self, seconds):
+        """Add one duration."""
+        self.counts[bisect.bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Upper bound of the bucket the p-th percentile falls in, seconds."""
+        if not self.count:
+            return None
+        rank = p / 100. * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return BOUNDS[i] if i < len(BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        """count, mean, p50, p95, p99 and max, times in ms."""
+        if not self.count:
+            return {'count': 0}
+        ms = dict(('p{}'.format(p), 1e3 * self.percentile(p))
+                  for p in (50, 95, 99))
+        ms.update(count=self.count, mean=1e3 * self.total / self.count,
+                  max=1e3 * self.max)
+        return ms
+
+
+class Metrics(object):
+    """Named counters, gauges and histograms for the whole pipeline."""
+
+    def __init__(self):
+        """Constructor."""
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def count(self, name, n=1):
+        """Add n to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, func):
+        """Have func() reported as name in every snapshot."""
+        self.gauges[name] = func
+
+    def histogram(self, name):
+        """Return the histogram called name, making it if need be."""
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = Histogram()
+        return hist
+
+    def observe(self, name, seconds):
+        """Add a duration to a histogram."""
+        self.histogram(name).observe(seconds)
+
+    def snapshot(self):
+        """Everything, as a dict that json.dumps can take."""
+        gauges = {}
+        for name, func in list(self.gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception as e:  # a gauge mustn't take the rest down
+                gauges[name] = '{}: {}'.format(type(e).__name__, e)
+        return {'time': time.time(),
+                'uptime': time.time() - self.started,
+                'counters': dict(self.counters),
+                'gauges': gauges,
+                'histograms': dict((name, hist.summary()) for name, hist
+                                   in list(self.histograms.items()))}
+
+    def status_lines(self, snap=None):
+        """A short human-readable summary, one metric per line."""
+        if snap is None:
+            snap = self.snapshot()
+        lines = []
+        for kind in ('counters', 'gauges'):
+            for name, value in sorted(snap[kind].items()):
+                if isinstance(value, float):
+                    value = '{:.1f}'.format(value)
+                lines.append('{}: {}'.format(name, value))
+        for name, hist in sorted(snap['histograms'].items()):
+            if hist['count']:
+                lines.append('{}: p50 {:.1f} / p99 {:.1f} / max {:.1f} ms'.format(
+                    name, hist['p50'], hist['p99'], hist['max']))
+        return lines
+
+
+class MetricsLogger(object):
+    """Calls write() with a one-line summary every interval seconds."""
+
+    def __init__(self, metrics, interval, write):
+        """Constructor. Starts the logging thread."""
+        self.metrics = metrics
+        self.interval = interval
+        self.write = write
+        self.running = True
+        self.thread = Thread(target=self._run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            if self.running:
+                self.write(' | '.join(self.metrics.status_lines()))
+
+
+class MetricsServer(object):
+    """Serves snapshots as JSON over HTTP, on localhost only.
+
+    GET /metrics (or /) returns Metrics.snapshot(). Runs in its own thread.
+    """
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        """Constructor. Starts serving; port 0 picks a free one (see .port)."""
+        self.metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = json.dumps(metrics.snapshot(), sort_keys=True)
+                body = body.encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'application/json')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass  # no console output per request
+
+        self.server = HTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = Thread(target=self.server.serve_forever, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -12,62 +12,96 @@
 # REPLACE SERIAL PORT FINDER WITH INBUILT FUNCTION
 # "python -m serial.tools.list_ports"
 
-from pyqtgraph.Qt import QtGui, QtCore
 import os
 import sys
 import glob
 import serial
 import argparse
-from threading import Thread
 from time import sleep
-import classes as c
+import engine
+import recordlib
+import profilelib
+import configlib
+c = None  # classes, only imported when there's a GUI (needs Qt)
 # import spaceinvaders as game
 
 # #### GLOBAL VARIABLES ####
 parser = argparse.ArgumentParser()
-parser.add_argument("port", help="the name of the serial \
-                                  port, ie \'COM3\' or \'/dev/ttyS0\'")
+parser.add_argument("port", nargs="*", help="the name of the serial \
+                                  port, ie \'COM3\' or \'/dev/ttyS0\'; \
+                                  give several for several boards")
 parser.add_argument("-b", "--baudrate",
                     help="the serial baud rate, ie 19200, 57600, 115200",
                     type=int, default=115200)
 parser.add_argument("-N", "--nowrite", action="store_true")  # deprecated
 parser.add_argument("-R", "--raw_output", action="store_true")
+parser.add_argument("-n", "--nchans", type=int,
+                    help="channels per board (NUM_CHANS in the firmware), \
+                          default 4")
+parser.add_argument("-B", "--binary", action="store_true",
+                    help="record to a binary file (see recordlib) instead of CSV")
+parser.add_argument("--replay", metavar="FILE",
+                    help="play back a recorded data_*.csv/.bin instead of \
+                          reading a serial port")
+parser.add_argument("--speed", type=float, default=1.0,
+                    help="replay speed, as a multiple of real time \
+                          (0 = as fast as possible)")
+parser.add_argument("--loop", action="store_true",
+                    help="start the replay again when it reaches the end")
+parser.add_argument("--headless", action="store_true",
+                    help="no GUI: stream, detect and send keys from the \
+                          command line until Ctrl+C")
+parser.add_argument("-t", "--threshold", action="append", default=[],
+                    metavar="CHAN=VALUE",
+                    help="detection threshold (p-p or rms) for a channel, \
+                          ie th_add=120; may be repeated")
+parser.add_argument("-k", "--key", action="append", default=[],
+                    metavar="KEY=CHAN[,!CHAN...][@GROUP[:PRIORITY]]",
+                    help="send KEY while the listed channels are active \
+                          (and the !CHANs aren't), ie w=fi_ext,!fi_flx; \
+                          of the keys in a GROUP only the highest \
+                          PRIORITY (then the first given) is sent")
+parser.add_argument("--record", action="store_true",
+                    help="headless only: record the session to ./data/")
+parser.add_argument("--gaps", choices=["interpolate", "hold", "nan"],
+                    help="how to fill in missed packets (default interpolate)")
+parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                    help="serve pipeline metrics as JSON on \
+                          http://127.0.0.1:PORT/metrics")
+parser.add_argument("--metrics-log", type=float, metavar="SECONDS",
+                    help="print a metrics line this often (0 = never, \
+                          default 60)")
+parser.add_argument("--trace", metavar="FILE",
+                    help="trace each block's latency through the pipeline \
+                          and write it to FILE (Chrome trace JSON)")
+parser.add_argument("--key-backend", choices=["windows", "uinput", "recording"],
+                    help="how to send keyboard events (default: \
+                          win32api on Windows, uinput on Linux)")
+parser.add_argument("-P", "--procs", type=int,
+                    help="do the channels' DSP in this many worker \
+                          processes (default 0: in a thread)")
+parser.add_argument("--profile", metavar="NAME",
+                    help="start with a saved patient profile: config, \
+                          thresholds, key map and calibration (see \
+                          profilelib); -t and -k override it")
+parser.add_argument("--save-profile", metavar="NAME",
+                    help="save the session's settings as profile NAME \
+                          when it ends")
 
-# global parameters dict
-config = {'sampfreq': 256,  # sample freq, Hz
-          'datalen': 4096,  # data queue length
-          'mainsfreq': 50,  # local mains freq, Hz
-          'notch_width': 0.5,  # notch filter bandwidth, Hz
-          'filt_order': 3,  # notch filter order
-          'raw_output': False,
-          'title': 'EMG Grapher',  # window title
-          'width': 1280,  # window width
-          'height': 800,  # window height
-          'plot_timer_ms': 50,  # plot update interval, ms
-          'plot_names': ['th_add', 'th_abd', 'fi_flx', 'fi_ext'],
-          'indices': {'th_add': 5,  # index of chan's data in packet
-                      'th_abd': 4,
-                      'fi_flx': 3,
-                      'fi_ext': 2},
-          'names': {'th_add': 'ADduct Thumb',  # description of channel
-                    'th_abd': 'ABduct Thumb',
-                    'fi_flx': 'Flex Fingers',
-                    'fi_ext': 'Extend Fingers'},
-          'keys': None}
+# serial-config.txt, next to this file: defaults for the serial link
+SERIAL_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'serial-config.txt')
 
-prefixes = ['th', 'fi']  # plot name prefixes
+# global parameters dict, see configlib
+config = configlib.defaults()
 
-# part of unimplemented calibration functionality
-calcfg = {'repeats': 5,
-    #    'intervals': [.1, .2]}
-       'intervals': [1., 2.]}
-config['calcfg'] = calcfg
+prefixes = ['th', 'fi']  # plot name prefixes
 
 
 def populate_patterns(prefix_list, cal_cfg):
     """ 'Populate calibration patterns'
-    Part of unimplemented feature to record EMG data while the user was asked
-    to follow a particular movement 'pattern'.
+    Calibration records EMG data while the user is asked to follow a
+    particular movement 'pattern', then fits the thresholds to it.
     """
     cal_patterns = []
     mgroups = sorted(config['plot_names'])
@@ -115,46 +149,188 @@ def serial_ports():
     return result
 
 
+def parse_thresholds(items):
+    """Turn ['chan=value', ...] into a dict of thresholds."""
+    thresholds = {}
+    for item in items:
+        name, value = item.split('=', 1)
+        if name not in config['plot_names']:
+            parser.error('unknown channel: {}'.format(name))
+        thresholds[name] = float(value)
+    return thresholds
+
+
+def parse_key_map(items):
+    """Turn ['key=chan,!chan@group:priority', ...] into an Engine.key_map list."""
+    key_map = []
+    for item in items:
+        key, chans = item.split('=', 1)
+        chans, _, group = chans.partition('@')
+        group, _, priority = group.partition(':')
+        if not engine.kl.available():
+            parser.error('keyboard events are not available here '
+                         '(see --key-backend)')
+        if key not in engine.kl.Base:
+            parser.error('unknown key: {}'.format(key))
+        press_cond = dict((name, None) for name in config['plot_names'])
+        for name in chans.split(','):
+            want = not name.startswith('!')
+            name = name.lstrip('!')
+            if name not in press_cond:
+                parser.error('unknown channel: {}'.format(name))
+            press_cond[name] = want
+        try:
+            priority = int(priority or 0)
+        except ValueError:
+            parser.error('bad priority: {}'.format(item))
+        key_map.append((engine.kl.Base[key], press_cond, group or None, priority))
+    return key_map
+
+
+def save_profile(name, emg, fits):
+    """Save the session's config, thresholds, key map & fits as profile name."""
+    config['profile'] = name
+    print 'Saved profile to {}'.format(profilelib.save(
+        name, config, emg.thresholds, emg.key_map, fits, config['profile_dir']))
+
+
+def run_headless(emg):
+    """Stream until Ctrl+C (or a replay ends), printing channel state changes
+    as they happen."""
+    def report(results, changed):
+        for name in changed:
+            print '{}: {}'.format(name, 'DETECT' if emg.states[name] else 'none')
+    emg.subscribe(report)
+    emg.handler.do_polling = True
+    print 'Streaming. Ctrl+C to stop.'
+    try:
+        while emg.poller.isAlive():
+            sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+
+
+def setup(args):
+    """Everything up to the GUI: config from the profile and the command
+    line, then the Engine.
+
+    Returns (emg, thresholds, fits), or (None, None, None) if none of the
+    ports can be opened. Keys are only sent straight away when headless;
+    with the GUI that's up to its 'Send keyboard events' box.
+    """
+    ser = None
+    profile = None
+    if args.profile:
+        try:
+            profile = profilelib.load(args.profile, config['profile_dir'])
+        except (IOError, OSError, ValueError) as e:
+            parser.error('can\'t load profile {}: {}'.format(args.profile, e))
+        config.update(profile['config'])
+        config['profile'] = args.profile
+    if args.nchans:
+        config['board_chans'] = args.nchans
+    if args.replay:
+        ser = recordlib.ReplaySerial(args.replay, config['sampfreq'],
+                                     args.speed, args.loop)
+        args.port = [args.replay]
+        config['board_chans'] = ser.nchans  # all boards' channels, as recorded
+    if not (args.port and (ser is not None or
+                           all(port in serial_ports() for port in args.port))):
+        return None, None, None
+    configlib.channel_config(config, len(args.port) * config['board_chans'])
+    if args.raw_output:  # set raw output flag
+        config['raw_output'] = True
+    if args.binary:
+        config['record_format'] = 'bin'
+    if args.procs is not None:
+        config['dsp_procs'] = args.procs
+    if args.gaps:
+        config['gap_policy'] = args.gaps
+    if args.metrics_port is not None:
+        config['metrics_port'] = args.metrics_port
+    if args.metrics_log is not None:
+        config['metrics_log_s'] = args.metrics_log
+    if args.trace:
+        config['trace'] = args.trace
+    if args.key_backend:
+        config['key_backend'] = args.key_backend
+    if config['key_backend']:
+        engine.kl.use(config['key_backend'])
+    thresholds = dict((name, value) for name, value in
+                      (profile['thresholds'] if profile else {}).items()
+                      if name in config['plot_names'])
+    thresholds.update(parse_thresholds(args.threshold))
+    if profile and not args.key:
+        key_map = profile['key_map']
+        for binding in key_map:
+            if not set(binding[1]) <= set(config['plot_names']):
+                parser.error('profile {} has keys for channels that '
+                             'aren\'t here'.format(args.profile))
+    else:
+        key_map = parse_key_map(args.key)
+    # the key dialog has a row for every binding
+    config['num_keys'] = max(config['num_keys'], len(key_map))
+    fits = profile['calibration'] if profile else None
+    # declare the engine (Channels, I/O handler, detection)
+    emg = engine.Engine(config, args.port, args.baudrate, ser,
+                        nowrite=not (args.headless and args.record))
+    for name, value in thresholds.items():
+        emg.set_threshold(name, value)
+    emg.key_map = key_map
+    emg.sendkeys = args.headless and bool(key_map)
+    config['engine'] = emg
+    config['handler'] = emg.handler
+    config['poller'] = emg.poller
+    return emg, thresholds, fits
+
+
 def _main():
-    global config
+    global config, c
+    if os.path.exists(SERIAL_CONFIG):
+        serial_cfg = profilelib.read_serial_config(SERIAL_CONFIG)
+        if 'baudrate' in serial_cfg:
+            parser.set_defaults(baudrate=serial_cfg['baudrate'])
     args = parser.parse_args()
-    if args.port in serial_ports():
-        if args.raw_output:  # set raw output flag
-            config['raw_output'] = True
-        channels = []
-        config['cal'] = populate_patterns(prefixes, calcfg)  # unimplemented
-        # declare main window
-        config['win'] = c.DisplayWindow(config)
-        # declare Channels
-        for chname in config['plot_names']:
-            channels.append(c.Channel(chname, config))
-        # ensure channel list is in correct order for data packet
-        channels = sorted(channels, key=lambda ch: ch.idx)
-        # declare I/O handler
-        config['handler'] = c.IO_handler(args.port, args.baudrate, channels)
-        config['poller'] = Thread(target=config['handler'].poll_serial, args=())
-        config['poller'].start()
-        # import objgraph
-        # objgraph.show_refs([config['win']], filename='win_refs.png')
-        # objgraph.show_refs([config['handler']], filename='io_refs.png')
-        # objgraph.show_refs([channels[0]], filename='chan_refs.png')
-        # objgraph.show_backrefs([config['win']], filename='win_Brefs.png')
-        # objgraph.show_backrefs([config['handler']], filename='io_Brefs.png')
-        # objgraph.show_backrefs([channels[0]], filename='chan_Brefs.png')
-        QtGui.QApplication.instance().exec_()  # start Qt stuff
-
-        # main window exit returns control to here
-        # set termination flags
-        config['handler'].do_polling = False
-        config['handler'].kill_thread = True
-        # clean up
-        while config['poller'].isAlive() or config['handler'].ser.is_open:
-            sleep(0.1)
-        for thread in config['handler'].dsp_threads:
-            while thread.isAlive():
-                sleep(0.1)
+    emg, thresholds, fits = setup(args)
+    if emg is None:
+        return
+    if args.headless:
+        emg.start()
+        run_headless(emg)
+        emg.stop()
+        engine.kl.close()
+        if args.save_profile:
+            save_profile(args.save_profile, emg, fits)
         print 'Done.'
-        # sys.exit(c.app.exec_())
+        return
+    import classes as c
+    config['cal'] = populate_patterns(prefixes, config['calcfg'])
+    # declare main window
+    config['win'] = c.DisplayWindow(config)
+    for name, value in thresholds.items():
+        config['win'].plotcontrols[name]['tctlbox'].setValue(int(value))
+        emg.set_threshold(name, value)  # not rounded by the spinbox
+    if emg.key_map:
+        config['win'].set_key_map(emg.key_map)
+    config['win'].calibration.fits = fits
+    emg.start()
+    # import objgraph
+    # objgraph.show_refs([config['win']], filename='win_refs.png')
+    # objgraph.show_refs([config['handler']], filename='io_refs.png')
+    # objgraph.show_refs([channels[0]], filename='chan_refs.png')
+    # objgraph.show_backrefs([config['win']], filename='win_Brefs.png')
+    # objgraph.show_backrefs([config['handler']], filename='io_Brefs.png')
+    # objgraph.show_backrefs([channels[0]], filename='chan_Brefs.png')
+    c.app.exec_()  # start Qt stuff
+
+    # main window exit returns control to here
+    # set termination flags & clean up
+    emg.stop()
+    engine.kl.close()
+    if args.save_profile:
+        save_profile(args.save_profile, emg, config['win'].calibration.fits)
+    print 'Done.'
+    # sys.exit(c.app.exec_())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,171 @@
+# === packetlib.py ===
+# * Function: serial packet framing and decoding for olimex-emg-read.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""A library for cutting the serial byte stream into data packets.
+
+Packets are as sent by olimex-emg-transmit.ino: two HEADER bytes, the OCR
+value, the packet counter, one LSB per channel, then the channels' MSBs
+packed 2 bits at a time, four channels to a byte. The firmware sends 4
+channels by default (NUM_CHANS), so a packet is usually 9 bytes long;
+the functions here take the channel count where it matters.
+"""
+
+import numpy as np
+
+HEADER = 0xcc  # header byte, sent twice at the start of every packet
+SYNC = b'\xcc\xcc'  # the full header pair
+NUM_CHANS = 4  # channels per packet, unless the firmware was built otherwise
+
+
+def msb_bytes(nchans):
+    """Number of packed MSB bytes in a packet of nchans channels."""
+    return (nchans + 3) // 4
+
+
+def packet_size(nchans=NUM_CHANS):
+    """Bytes per packet, headers included."""
+    return 4 + nchans + msb_bytes(nchans)
+
+
+def packet_dtype(nchans=NUM_CHANS):
+    """Layout of one packet of nchans channels on the wire."""
+    return np.dtype([('header', np.uint8, (2,)),
+                     ('ocr', np.uint8),
+                     ('count', np.uint8),
+                     ('lsb', np.uint8, (nchans,)),  # low bytes
+                     ('msb', np.uint8, (msb_bytes(nchans),))])  # high bits
+
+
+def decoded_cols(nchans=NUM_CHANS):
+    """Column names of decode_packets' output."""
+    return ['OCRval', 'count'] + ['Ch{}'.format(i) for i in range(nchans)]
+
+
+PACKET_SIZE = packet_size()
+PACKET_DTYPE = packet_dtype()
+DECODED_COLS = decoded_cols()
+
+
+class PacketFramer(object):
+    """Splits a raw serial byte stream into whole packets.
+
+    Incoming bytes are appended to one reusable bytearray and complete
+    packets are cut off the front of it in bulk, so the per-byte work is
+    all done in C. Once aligned, the framer only checks that every packet
+    still starts with a header pair; if one doesn't it throws bytes away
+    until it finds a header pair that is followed by another one a packet
+    later (a single 0xCC 0xCC can turn up in the data bytes).
+    """
+
+    def __init__(self, packet_size=PACKET_SIZE):
+        """Constructor."""
+        self.packet_size = packet_size
+        self.buf = bytearray()
+        self.synced = False
+        # stats
+        self.packets = 0  # complete packets handed out
+        self.resyncs = 0  # number of times alignment was lost
+        self.discarded = 0  # bytes thrown away while hunting for headers
+
+    def reset(self):
+        """Forget any buffered bytes, i.e. after flushing the serial port."""
+        del self.buf[:]
+        self.synced = False
+
+    def feed(self, data):
+        """Add raw bytes and return all complete packets as a single string.
+
+        The result is a whole number of packets long (possibly zero) and
+        each packet still has its two header bytes.
+        """
+        buf = self.buf
+        buf += data
+        size = self.packet_size
+        end = len(buf)
+        pos = 0
+        out = []
+        while end - pos >= size:
+            if self.synced:
+                # check the header pair of every buffered packet in one go
+                n = (end - pos) // size
+                stop = pos + n * size
+                good = n - max(len(buf[pos:stop:size].lstrip(SYNC[:1])),
+                               len(buf[pos + 1:stop:size].lstrip(SYNC[:1])))
+                if good:
+                    out.append(bytes(buf[pos:pos + good * size]))
+                    pos += good * size
+                    self.packets += good
+                if good < n:  # corrupted or dropped bytes
+                    self.synced = False
+                    self.resyncs += 1
+            else:
+                nxt = buf.find(SYNC, pos)
+                if nxt == -1:
+                    # keep a trailing HEADER, it may be half of a header pair
+                    nxt = end - 1 if buf[end - 1] == HEADER else end
+                    self.discarded += nxt - pos
+                    pos = nxt
+                    break
+                self.discarded += nxt - pos
+                pos = nxt
+                if end - pos < size + 2:
+                    break  # can't confirm this header pair yet
+                if buf[pos + size:pos + size + 2] == SYNC:
+                    self.synced = True
+                else:
+                    self.discarded += 1
+                    pos += 1
+        del buf[:pos]
+        return b''.join(out)
+
+
+def decode_packets(packets, out=None, nchans=NUM_CHANS):
+    """Decode a whole batch of packets at once.
+
+    packets: a string of N complete packets, as returned by PacketFramer.
+    out: optional (N, 2 + nchans) integer array to decode into.
+    Returns an (N, 2 + nchans) array with one row per packet, laid out as
+    decoded_cols(nchans): OCR value, packet counter, then the 10-bit
+    channel values.
+    """
+    frames = np.frombuffer(packets, packet_dtype(nchans))
+    if out is None:
+        out = np.empty((len(frames), 2 + nchans), np.int32)
+    out[:, 0] = frames['ocr']
+    out[:, 1] = frames['count']
+    # spread the packed MSB bytes into 2 bits per channel, then add the LSBs
+    chan = np.arange(nchans)
+    hi_bits = (frames['msb'][:, chan // 4] >> (2 * (chan % 4))) & 3
+    np.left_shift(hi_bits, 8, out=out[:, 2:])
+    out[:, 2:] += frames['lsb']
+    return out
+
+
+def encode_packets(rows):
+    """Pack decoded rows back into packets, exactly as the firmware sends them.
+
+    The inverse of decode_packets: rows is an (N, 2 + nchans) array laid
+    out as decoded_cols(nchans). Returns a string of N packets, headers
+    included.
+    """
+    rows = np.asarray(rows)
+    nchans = rows.shape[1] - 2
+    frames = np.zeros(len(rows), packet_dtype(nchans))
+    frames['header'] = HEADER
+    frames['ocr'] = rows[:, 0]
+    frames['count'] = rows[:, 1]
+    chans = rows[:, 2:]
+    chan = np.arange(nchans)
+    frames['lsb'] = chans & 0xff
+    hi_bits = ((chans >> 8) & 3) << (2 * (chan % 4))
+    for i in range(msb_bytes(nchans)):
+        frames['msb'][:, i] = hi_bits[:, 4 * i:4 * i + 4].sum(axis=1)
+    return frames.tobytes()
@@ -0,0 +1,135 @@
+# === profilelib.py ===
+# * Function: saved session profiles (one per patient) for olimex-emg-read.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""A library for saving a session's settings and loading them back.
+
+A profile is everything worth keeping about one patient's setup:
+    config       the patient's settings from the config dict: channels,
+                 filter, detection and calibration (PROFILE_KEYS) - not
+                 how a run happened to be started (tracing, metrics, key
+                 backend and so on)
+    thresholds   channel name -> detection threshold
+    key_map      the engine's key map, (key, {channel: True/False/None},
+                 group, priority) tuples
+    calibration  the last Calibration.fit() results, or None
+    notches      dsplib's notch designs, so startup doesn't redo them
+Each profile is a JSON file of its own, PROFILE_DIR/<name>.json, so
+listing the profiles is just a directory listing and loading one never
+touches the others. Floats are written with repr(), so everything comes
+back exactly as it was saved.
+
+serial-config.txt (KEY=VALUE lines) is read by read_serial_config().
+"""
+
+import json
+import os
+import dsplib
+
+PROFILE_DIR = 'profiles'
+SUFFIX = '.json'
+VERSION = 1
+# the config keys a profile keeps
+PROFILE_KEYS = ['plot_names', 'indices', 'names', 'board_chans',  # channels
+                'sampfreq', 'clock', 'mainsfreq', 'notch_width',  # filter
+                'filt_order', 'gap_policy', 'fftlen', 'fft_overlap',
+                'envelope', 'detect_window', 'hysteresis',  # detection
+                'hold_ms', 'refractory_ms', 'num_keys',
+                'calcfg']  # calibration
+
+
+def path_of(name, directory=PROFILE_DIR):
+    """The file profile `name` is kept in."""
+    return os.path.join(directory, name + SUFFIX)
+
+
+def profile_names(directory=PROFILE_DIR):
+    """The names of the profiles in directory, sorted."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(f[:-len(SUFFIX)] for f in os.listdir(directory)
+                  if f.endswith(SUFFIX))
+
+
+def save(name, cfg, thresholds, key_map, calibration=None,
+         directory=PROFILE_DIR):
+    """Save a profile, replacing any of the same name.
+
+    The file is written under a temporary name and then renamed, so a
+    crash half way through never leaves a broken profile behind.
+    """
+    profile = {
+        'version': VERSION,
+        'config': _settings(cfg),
+        'thresholds': dict(thresholds),
+        'key_map': [list(binding) for binding in key_map],
+        'calibration': calibration,
+        'notches': [[list(key), sos.tolist()]
+                    for key, sos in dsplib.notch_designs().items()]}
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filename = path_of(name, directory)
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(profile, f, indent=1, sort_keys=True)
+    if os.path.exists(filename):  # os.rename won't on Windows
+        os.remove(filename)
+    os.rename(tmp, filename)
+    return filename
+
+
+def load(name, directory=PROFILE_DIR):
+    """Load a profile: a dict laid out as described above.
+
+    Its notch designs go straight to dsplib, for notch_sos() to hand out.
+    Only PROFILE_KEYS are taken from its config, whatever the file has.
+    """
+    with open(path_of(name, directory)) as f:
+        profile = _native(json.load(f))
+    if profile.get('version') != VERSION:
+        raise ValueError('profile {} is version {}, not {}'.format(
+            name, profile.get('version'), VERSION))
+    profile['config'] = _settings(profile['config'])
+    profile['key_map'] = [tuple(binding) for binding in profile['key_map']]
+    dsplib.load_notch_designs(dict((tuple(key), sos)
+                                   for key, sos in profile.pop('notches')))
+    return profile
+
+
+def _settings(cfg):
+    """The PROFILE_KEYS part of a config dict."""
+    return dict((key, cfg[key]) for key in PROFILE_KEYS if key in cfg)
+
+
+def _native(x):
+    """JSON's unicode strings back to plain str (Python 2), all the way down."""
+    if isinstance(x, dict):
+        return dict((_native(key), _native(value)) for key, value in x.items())
+    if isinstance(x, list):
+        return [_native(value) for value in x]
+    if not isinstance(x, str) and isinstance(x, type(u'')):
+        return x.encode('utf-8')
+    return x
+
+
+def read_serial_config(filename):
+    """Read a serial-config.txt: KEY=VALUE lines, into {'key': int value}.
+
+    Blank lines and lines starting with # are skipped.
+    """
+    settings = {}
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            key, _, value = line.partition('=')
+            settings[key.strip().lower()] = int(value)
+    return settings
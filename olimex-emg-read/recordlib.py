@@ -0,0 +1,331 @@
+# === recordlib.py ===
+# * Function: session recording formats for olimex-emg-read.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""A library for writing and reading back recorded EMG sessions.
+
+Recordings are written by a RecordWriter thread, so the acquisition loop
+only ever has to put a block on a queue. CSV recordings look like:
+    RAW DATA ONLY
+    OCRval,count,Ch0,Ch1,Ch2,Ch3
+    243,0,512,511,509,515
+    ...
+
+The binary format is a small header followed by fixed-width records:
+    BIN_MAGIC (8 bytes)
+    header length in bytes, little-endian uint32 (4 bytes)
+    JSON metadata, space padded so the records start on a 512 byte boundary
+    records: little-endian uint16, one row per packet, same columns as
+        packetlib.decode_packets (OCRval, count, Ch0, Ch1...)
+Metadata holds the sample rate, the OCR value, the start time and the
+channel map (channel name -> column index), so a recording can be opened
+with read_binary() as an np.memmap without any parsing.
+
+Either kind of recording can be played back through IO_handler with a
+ReplaySerial standing in for the serial port.
+"""
+
+import json
+import struct
+import time
+from threading import Thread
+try:
+    import Queue
+except ImportError:  # python 3
+    import queue as Queue
+import numpy as np
+import packetlib as pl
+import timinglib
+
+BIN_MAGIC = b'EMGREC01'
+BIN_ALIGN = 512  # records start at a multiple of this
+BIN_DTYPE = np.dtype('<u2')
+
+
+def csv_header(nchans=pl.NUM_CHANS):
+    """The first two lines of a raw CSV recording of nchans channels."""
+    return 'RAW DATA ONLY\n' + ','.join(pl.decoded_cols(nchans)) + '\n'
+
+
+CSV_HEADER = csv_header()
+
+
+class CsvRecorder(object):
+    """Writes decoded packets to a CSV file, one line per packet."""
+
+    def __init__(self, filename, header=CSV_HEADER):
+        """Constructor. header: text written before any data."""
+        self.filename = filename
+        self.output = open(filename, 'w')
+        self.output.write(header)
+        self.samples = 0
+
+    @property
+    def closed(self):
+        return self.output.closed
+
+    def write(self, data):
+        """Write an (N, 2 + nchans) block of packets, or a string of lines."""
+        if isinstance(data, np.ndarray):
+            self.samples += len(data)
+            row = ','.join(['{}'] * data.shape[1]) + '\n'
+            data = ''.join([row.format(*r) for r in data.tolist()])
+        self.output.write(data)
+
+    def flush(self):
+        self.output.flush()
+
+    def close(self):
+        self.output.close()
+
+
+class BinaryRecorder(object):
+    """Appends decoded packets to a binary recording file.
+
+    The header is written with the first block, once the OCR value the
+    firmware is running with is known.
+    """
+
+    def __init__(self, filename, sampfreq, channel_map, columns=None):
+        """Constructor.
+
+        filename: file to create.
+        sampfreq: nominal sample rate, Hz.
+        channel_map: dict of channel name -> column, i.e. config['indices'].
+        columns: column names, defaults to packetlib.DECODED_COLS.
+        """
+        self.filename = filename
+        self.meta = {'sampfreq': sampfreq,
+                     'channels': dict(channel_map),
+                     'columns': list(columns or pl.DECODED_COLS),
+                     'start_time': time.time(),
+                     'ocr': None}
+        self.output = open(filename, 'wb')
+        self.samples = 0
+
+    @property
+    def closed(self):
+        return self.output.closed
+
+    def _write_header(self):
+        text = json.dumps(self.meta, sort_keys=True).encode('utf-8')
+        length = len(BIN_MAGIC) + 4 + len(text)
+        length += -length % BIN_ALIGN  # pad up to the record boundary
+        self.output.write(BIN_MAGIC + struct.pack('<I', length))
+        self.output.write(text.ljust(length - len(BIN_MAGIC) - 4))
+
+    def write(self, block):
+        """Append an (N, len(columns)) block of decoded packets."""
+        if not len(block):
+            return
+        if self.meta['ocr'] is None:
+            self.meta['ocr'] = int(block[0, 0])
+            self._write_header()
+        self.output.write(np.ascontiguousarray(block, BIN_DTYPE).tobytes())
+        self.samples += len(block)
+
+    def flush(self):
+        self.output.flush()
+
+    def close(self):
+        """Close the file, writing the header if nothing was recorded."""
+        if self.output.closed:
+            return
+        if self.meta['ocr'] is None:
+            self._write_header()
+        self.output.close()
+
+
+class RecordWriter(object):
+    """Writes to a recorder (CsvRecorder/BinaryRecorder) from its own thread.
+
+    put() never blocks: if the queue is full the block is dropped and
+    counted instead, because holding up the serial reader would only lose
+    data somewhere less visible. The writer takes everything waiting on the
+    queue in one go and writes it as a single batch, and flushes the file
+    at most every flush_interval seconds. close() writes out whatever is
+    still queued before closing the file.
+    """
+
+    def __init__(self, recorder, queue_len=1024, flush_interval=1.0):
+        """Constructor. Starts the writer thread."""
+        self.recorder = recorder
+        self.filename = recorder.filename
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(queue_len)
+        self.dropped_blocks = 0  # blocks put() had to throw away
+        self.thread = Thread(target=self._run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def samples(self):
+        return self.recorder.samples
+
+    def put(self, data):
+        """Queue a block of packets (or calibration text) to be written."""
+        try:
+            self.queue.put_nowait(data)
+        except Queue.Full:
+            self.dropped_blocks += 1
+
+    def close(self):
+        """Drain the queue and close the file; waits for the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        last_flush = time.time()
+        dirty = False
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(True, self.flush_interval)]
+            except Queue.Empty:
+                batch = []
+            try:  # grab whatever else is waiting
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            stop = [i for i, item in enumerate(batch) if item is None]
+            if stop:  # close() was called
+                batch = batch[:stop[0]]
+                running = False
+            if batch:
+                if isinstance(batch[0], np.ndarray):
+                    self.recorder.write(np.concatenate(batch))
+                else:
+                    self.recorder.write(''.join(batch))
+                dirty = True
+            if dirty and time.time() - last_flush >= self.flush_interval:
+                self.recorder.flush()
+                last_flush = time.time()
+                dirty = False
+        self.recorder.close()
+
+
+def read_header(filename):
+    """Return the metadata dict and header length of a binary recording."""
+    with open(filename, 'rb') as f:
+        head = f.read(len(BIN_MAGIC) + 4)
+        if head[:len(BIN_MAGIC)] != BIN_MAGIC:
+            raise ValueError('not a binary EMG recording: {}'.format(filename))
+        length = struct.unpack('<I', head[len(BIN_MAGIC):])[0]
+        meta = json.loads(f.read(length - len(head)).decode('utf-8'))
+    return meta, length
+
+
+def read_binary(filename, mode='r'):
+    """Open a binary recording.
+
+    Returns (meta, data), where data is an (N, len(meta['columns']))
+    np.memmap of the records - nothing is read until it's indexed.
+    A partly written last record (i.e. from a crash) is ignored.
+    """
+    meta, offset = read_header(filename)
+    ncols = len(meta['columns'])
+    with open(filename, 'rb') as f:
+        f.seek(0, 2)
+        rows = (f.tell() - offset) // (ncols * BIN_DTYPE.itemsize)
+    if not rows:  # np.memmap can't map zero bytes
+        return meta, np.zeros((0, ncols), BIN_DTYPE)
+    data = np.memmap(filename, BIN_DTYPE, mode, offset, (rows, ncols))
+    return meta, data
+
+
+def read_recording(filename):
+    """Load a whole recording (any layout) as an (N, 2 + nchans) array.
+
+    See loadlib, which also reads one in blocks.
+    """
+    import loadlib  # loadlib builds on this module
+    return loadlib.load(filename)
+
+
+class ReplaySerial(object):
+    """Plays a recording back as if it were arriving on a serial port.
+
+    Has just enough of the serial.Serial interface for IO_handler: the
+    recorded packets are re-encoded to the exact bytes the firmware sends
+    and released at speed times the rate the board sent them at, going by
+    the recorded OCR value (speed=0: as fast as they can be read). The
+    replay clock only runs while the port is being read;
+    reset_input_buffer() pauses it rather than throwing data away. Once
+    it's all been read (and loop is off), eof is True and IO_handler
+    stops polling.
+    """
+
+    def __init__(self, filename, sampfreq, speed=1.0, loop=False):
+        """Constructor.
+
+        sampfreq: the firmware's SAMP_FREQ, Hz, see timinglib.ocr_rate.
+        """
+        self.port = filename
+        self.baudrate = None
+        self.timeout = None
+        self.is_open = False
+        rows = read_recording(filename)
+        self.nchans = rows.shape[1] - 2
+        if len(rows):
+            self.sampfreq = timinglib.ocr_rate(int(rows[0, 0]), sampfreq)
+        else:
+            self.sampfreq = timinglib.packet_rate(sampfreq)
+        # bytes/s
+        self.rate = self.sampfreq * speed * pl.packet_size(self.nchans)
+        self.loop = loop
+        self.stream = pl.encode_packets(rows)
+        self.pos = 0  # bytes handed out so far
+        self._t0 = None
+        self._pos0 = 0
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def reset_input_buffer(self):
+        self._t0 = None  # restart the clock on the next read
+
+    @property
+    def eof(self):
+        """True once the whole recording has been read (never, with loop)."""
+        return not self.loop and self.pos >= len(self.stream)
+
+    @property
+    def in_waiting(self):
+        if self.pos >= len(self.stream) and self.loop:
+            self.pos = self._pos0 = 0
+            self._t0 = time.time()
+        remaining = len(self.stream) - self.pos
+        if not self.rate:
+            return remaining
+        if self._t0 is None:
+            self._t0 = time.time()
+            self._pos0 = self.pos
+        due = self._pos0 + int((time.time() - self._t0) * self.rate)
+        return max(0, min(due, len(self.stream)) - self.pos)
+
+    def read(self, size=1):
+        """Return up to size bytes, waiting up to timeout for them to come."""
+        deadline = time.time() + (self.timeout or 0.)
+        waiting = self.in_waiting
+        while waiting < size and self.pos + waiting < len(self.stream):
+            wait = min(deadline - time.time(), (size - waiting) / self.rate)
+            if wait <= 0:
+                break
+            time.sleep(wait)
+            waiting = self.in_waiting
+        if not waiting and self.timeout:
+            time.sleep(max(0., deadline - time.time()))  # end of recording
+        data = self.stream[self.pos:self.pos + min(size, waiting)]
+        self.pos += len(data)
+        return data
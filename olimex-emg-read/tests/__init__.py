@@ -0,0 +1,16 @@
+# === tests/__init__.py ===
+# * Function: unit tests for the olimex-emg-read libraries.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""Unit tests for the olimex-emg-read libraries.
+
+No hardware, Qt or keyboard access needed. From olimex-emg-read/:
+    python -m unittest discover -s tests -t .
+"""
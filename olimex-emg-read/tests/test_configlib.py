@@ -0,0 +1,41 @@
+# === tests/test_configlib.py ===
+# * Function: tests for configlib.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+import unittest
+import configlib
+
+
+class TestConfig(unittest.TestCase):
+
+    def test_defaults_are_copies(self):
+        cfg = configlib.defaults()
+        cfg['indices']['th_add'] = 9
+        cfg['calcfg']['repeats'] = 1
+        self.assertEqual(configlib.defaults(), configlib.CONFIG)
+        self.assertEqual(configlib.CONFIG['indices']['th_add'], 5)
+
+    def test_fewer_channels(self):
+        cfg = configlib.defaults()
+        configlib.channel_config(cfg, 2)
+        self.assertEqual(sorted(cfg['plot_names']), ['fi_ext', 'fi_flx'])
+        self.assertEqual(cfg['indices'], {'fi_ext': 2, 'fi_flx': 3})
+        self.assertEqual(sorted(cfg['names']), ['fi_ext', 'fi_flx'])
+
+    def test_more_channels(self):
+        cfg = configlib.defaults()
+        configlib.channel_config(cfg, 6)
+        self.assertEqual(cfg['plot_names'][-2:], ['ch4', 'ch5'])
+        self.assertEqual((cfg['indices']['ch4'], cfg['names']['ch5']),
+                         (6, 'Channel 5'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+# === tests/test_dsplib.py ===
+# * Function: tests for dsplib.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+import unittest
+import numpy as np
+from scipy import signal
+import dsplib
+
+CFG = {'mainsfreq': 50, 'notch_width': 0.5, 'filt_order': 3}
+
+
+class TestNotchFilter(unittest.TestCase):
+
+    def reference(self, x, fs):
+        """The filter Channel.dsp used to run: both notches' b/a polynomials
+        convolved, one sample at a time."""
+        b, a = np.array([1.]), np.array([1.])
+        for centre in [50., 25.]:
+            stop = centre + CFG['notch_width'] * np.array([-1., 1.])
+            b_AC, a_AC = signal.butter(CFG['filt_order'], stop / (fs / 2.),
+                                       'bandstop')
+            b, a = np.convolve(b, b_AC), np.convolve(a, a_AC)
+        return dsplib.direct_form(b, a, x)
+
+    def test_matches_direct_form(self):
+        rng = np.random.RandomState(0)
+        # the 12th-order direct form itself drifts a little at higher rates
+        for fs, tol in [(256, 1e-6), (512.295081967, 1e-4)]:
+            t = np.arange(int(2 * fs)) / float(fs)
+            x = 512 + 100 * np.sin(2 * np.pi * 50 * t) + rng.randn(len(t)) * 20
+            expected = self.reference(x, fs)
+            filt = dsplib.NotchFilter(dsplib.notch_sos(CFG, fs))
+            got = np.concatenate([filt.process(block)
+                                  for block in np.array_split(x, 37)])
+            np.testing.assert_allclose(got, expected, rtol=0,
+                                       atol=tol * np.abs(expected).max())
+
+    def test_block_size_doesnt_matter(self):
+        x = np.random.RandomState(1).randn(1000)
+        sos = dsplib.notch_sos(CFG, 256)
+        whole = dsplib.NotchFilter(sos).process(x)
+        filt = dsplib.NotchFilter(sos)
+        parts = np.concatenate([filt.process(x[i:i + 7])
+                                for i in range(0, len(x), 7)])
+        np.testing.assert_allclose(parts, whole, rtol=0, atol=1e-9)
+
+    def test_removes_mains(self):
+        fs = 512.295081967
+        t = np.arange(int(4 * fs)) / fs
+        filt = dsplib.NotchFilter(dsplib.notch_sos(CFG, fs))
+        out = filt.process(100 * np.sin(2 * np.pi * 50 * t))
+        self.assertLess(np.abs(out[-int(fs):]).max(), 1.)
+
+    def test_designs_are_shared(self):
+        sos = dsplib.notch_sos(CFG, 256)
+        self.assertIs(dsplib.notch_sos(dict(CFG), 256), sos)
+        self.assertFalse(sos.flags.writeable)
+        self.assertIsNot(dsplib.notch_sos(CFG, 512), sos)
+
+
+class TestFillGaps(unittest.TestCase):
+
+    values = [10., 40., 50.]
+    diffs = [1, 3, 1]  # two packets missed before the second one
+
+    def test_interpolate(self):
+        np.testing.assert_array_equal(
+            dsplib.fill_gaps(self.values, self.diffs, 0.),
+            [10., 20., 30., 40., 50.])
+
+    def test_hold_policy(self):
+        np.testing.assert_array_equal(
+            dsplib.fill_gaps(self.values, self.diffs, 0., 'hold'),
+            [10., 10., 10., 40., 50.])
+
+    def test_nan_policy(self):
+        np.testing.assert_array_equal(
+            dsplib.fill_gaps(self.values, self.diffs, 0., 'nan'),
+            [10., np.nan, np.nan, 40., 50.])
+
+    def test_gap_before_the_block(self):
+        # interpolated from `last`, the sample before the block
+        np.testing.assert_array_equal(
+            dsplib.fill_gaps([30.], [3], 0.), [10., 20., 30.])
+
+    def test_no_gaps(self):
+        out = dsplib.fill_gaps(self.values, [1, 1, 1], 0.)
+        np.testing.assert_array_equal(out, self.values)
+
+    def test_hold_nans(self):
+        np.testing.assert_array_equal(
+            dsplib.hold_nans(np.array([np.nan, 1., np.nan, np.nan, 2.]), 5.),
+            [5., 1., 1., 1., 2.])
+
+
+class TestThresholdDetector(unittest.TestCase):
+
+    def decide(self, env, **kwargs):
+        det = dsplib.ThresholdDetector(1, on=10., off=5., **kwargs)
+        return det.decide(np.array(env, np.float64)).tolist()
+
+    def test_hysteresis(self):
+        self.assertEqual(self.decide([0, 11, 7, 6, 4, 7, 11]),
+                         [False, True, True, True, False, False, True])
+
+    def test_hold(self):
+        # active for at least 3 samples, however soon the envelope drops
+        self.assertEqual(self.decide([20, 0, 0, 0, 0], hold=3),
+                         [True, True, True, False, False])
+
+    def test_refractory(self):
+        # can't go active again until 4 samples after letting go
+        self.assertEqual(
+            self.decide([20, 0, 20, 20, 20, 20, 20], refractory=4),
+            [True, False, False, False, False, True, True])
+
+    def test_state_carries_over_blocks(self):
+        det = dsplib.ThresholdDetector(1, on=10., off=5., hold=3,
+                                       refractory=4)
+        env = [20, 0, 0, 0, 20, 20, 20, 20, 0, 0]
+        whole = det.decide(np.array(env, np.float64)).tolist()
+        det = dsplib.ThresholdDetector(1, on=10., off=5., hold=3,
+                                       refractory=4)
+        parts = []
+        for i in range(len(env)):
+            parts.extend(det.decide(np.array(env[i:i + 1], np.float64)))
+        self.assertEqual(parts, whole)
+        self.assertEqual(whole, [True, True, True, False, False, False,
+                                 False, True, True, True])
+
+    def test_p2p_envelope(self):
+        x = np.random.RandomState(2).randn(200)
+        det = dsplib.ThresholdDetector(16)
+        env = np.concatenate([det.envelope_of(x[:77]),
+                              det.envelope_of(x[77:])])
+        for k in range(15, len(x)):
+            window = x[k - 15:k + 1]
+            self.assertAlmostEqual(env[k], window.max() - window.min())
+
+    def test_rms_envelope(self):
+        x = np.random.RandomState(3).randn(200)
+        det = dsplib.ThresholdDetector(16, envelope='rms')
+        env = np.concatenate([det.envelope_of(x[:50]),
+                              det.envelope_of(x[50:])])
+        for k in range(15, len(x)):
+            self.assertAlmostEqual(env[k], x[k - 15:k + 1].std())
+
+    def test_unknown_envelope(self):
+        self.assertRaises(ValueError, dsplib.ThresholdDetector, 16,
+                          envelope='abs')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# === tests/test_keylib.py ===
+# * Function: tests for keylib.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+import threading
+import unittest
+import keylib
+
+A, B, C = keylib.Base['a'], keylib.Base['b'], keylib.Base['c']
+
+
+class GatedBackend(keylib.RecordingBackend):
+    """Holds up the first press until let go, so events pile up behind it."""
+
+    def __init__(self):
+        keylib.RecordingBackend.__init__(self)
+        self.waiting = threading.Event()
+        self.gate = threading.Event()
+
+    def press(self, Key):
+        if not self.waiting.is_set():
+            self.waiting.set()
+            self.gate.wait(5)
+        keylib.RecordingBackend.press(self, Key)
+
+
+def events_of(backend, Key):
+    return [pressed for _, k, pressed in backend.events if k == Key]
+
+
+class TestKeyOutput(unittest.TestCase):
+
+    def test_coalescing(self):
+        backend = GatedBackend()
+        out = keylib.KeyOutput(backend)
+        out.put(A, True)
+        self.assertTrue(backend.waiting.wait(5))
+        # all of these go in one batch
+        for Key, pressed in [(B, True), (B, False), (B, True),
+                             (C, True), (C, False),
+                             (A, False), (A, True)]:
+            out.put(Key, pressed)
+        backend.gate.set()
+        out.close()
+        self.assertEqual(events_of(backend, B), [True, False])  # press only
+        self.assertEqual(events_of(backend, C), [True, False])  # a tap
+        # let go and pressed again, then released on close
+        self.assertEqual(events_of(backend, A), [True, False, True, False])
+        self.assertEqual(out.coalesced, 2)
+        self.assertEqual(out.sent, len(backend.events))
+
+    def test_when_sent(self):
+        backend = GatedBackend()
+        out = keylib.KeyOutput(backend)
+        calls = []
+        out.put(A, True)
+        self.assertTrue(backend.waiting.wait(5))
+        out.when_sent(lambda: calls.append(len(backend.events)))
+        out.put(B, True)  # may go in the same batch as the callback
+        out.when_sent(lambda: calls.append(len(backend.events)))
+        self.assertEqual(calls, [])  # not while the press is still going
+        backend.gate.set()
+        out.close()
+        self.assertEqual(calls, [2, 2])
+
+    def test_close_releases_held_keys(self):
+        backend = keylib.RecordingBackend()
+        out = keylib.KeyOutput(backend)
+        out.put(B, True)
+        out.put(A, True)
+        out.put(C, True)
+        out.put(C, False)
+        out.close()
+        self.assertEqual(events_of(backend, A), [True, False])
+        self.assertEqual(events_of(backend, B), [True, False])
+        self.assertEqual(events_of(backend, C), [True, False])
+        self.assertEqual(out.down, set())
+        self.assertEqual(out.sent, 6)
+
+
+class TestModule(unittest.TestCase):
+
+    def tearDown(self):
+        keylib.close()
+
+    def test_key_down_up(self):
+        backend = keylib.use('recording')
+        keylib.KeyDown('a')
+        keylib.KeyDown('a')  # already down: nothing to send
+        keylib.KeyUp('a')
+        keylib.KeyUp('a')
+        keylib.close()
+        self.assertEqual(events_of(backend, A), [True, False])
+
+    def test_close_resets_pressed_keys(self):
+        first = keylib.use('recording')
+        keylib.KeyDown('a')
+        keylib.close()
+        self.assertEqual(keylib.pressed_keys, set())
+        self.assertEqual(events_of(first, A), [True, False])
+        second = keylib.use('recording')
+        keylib.KeyDown('a')  # goes out again through the new backend
+        keylib.close()
+        self.assertEqual(events_of(second, A), [True, False])
+
+    def test_no_backend(self):
+        self.assertIsNone(keylib.use('nonexistent'))
+        self.assertFalse(keylib.available())
+        keylib.when_sent(self.fail)  # nothing to wait for
+
+
+if __name__ == '__main__':
+    unittest.main()
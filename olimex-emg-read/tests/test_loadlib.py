@@ -0,0 +1,144 @@
+# === tests/test_loadlib.py ===
+# * Function: tests for loadlib.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import loadlib
+import recordlib
+from tests.test_packetlib import make_rows
+
+
+class TestLayouts(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rows = make_rows(1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write_raw(self, name, rows):
+        recorder = recordlib.CsvRecorder(self.path(name))
+        recorder.write(rows)
+        recorder.close()
+        return self.path(name)
+
+    def check_blocks(self, session, rows):
+        blocks = list(session.blocks(128))
+        self.assertEqual([len(b) for b in blocks[:-1]],
+                         [128] * (len(blocks) - 1))
+        for block in blocks:
+            self.assertEqual(block.dtype, np.int32)
+        np.testing.assert_array_equal(np.concatenate(blocks), rows)
+
+    def test_raw(self):
+        filename = self.write_raw('raw.csv', self.rows)
+        session = loadlib.Session(filename)
+        self.assertEqual(session.layout, 'raw')
+        self.assertEqual(session.nchans, 4)
+        self.assertIsNone(session.channels)
+        np.testing.assert_array_equal(session.read(), self.rows)
+        self.check_blocks(session, self.rows)
+
+    def test_binary(self):
+        filename = self.path('rec.bin')
+        recorder = recordlib.BinaryRecorder(filename, 256, {'fi_ext': 2})
+        recorder.write(self.rows[:600])
+        recorder.write(self.rows[600:])
+        recorder.close()
+        session = loadlib.Session(filename)
+        self.assertEqual(session.layout, 'binary')
+        self.assertEqual(session.channels, {'fi_ext': 2})
+        self.assertEqual(session.meta['ocr'], 243)
+        self.assertEqual(session.meta['sampfreq'], 256)
+        np.testing.assert_array_equal(session.read(), self.rows)
+        self.check_blocks(session, self.rows)
+
+    def test_calibration(self):
+        rows = self.rows[:, :4]  # two channels
+        with open(self.path('cal.csv'), 'w') as f:
+            f.write('Columns\nCh0 (fi_ext),Ch1 (fi_flex),\n')
+            f.write('OCRval,count,raw,filt,cal,raw,filt,cal,\n')
+            for r in rows.tolist():
+                f.write('{},{},{},{:.3f},1,{},{:.3f},0,\n'.format(
+                    r[0], r[1], r[2], r[2] * .5, r[3], -r[3] * .25))
+        session = loadlib.Session(self.path('cal.csv'))
+        self.assertEqual(session.layout, 'calibration')
+        self.assertEqual(session.channels, {'fi_ext': 2, 'fi_flex': 3})
+        np.testing.assert_array_equal(session.read(), rows)
+        self.check_blocks(session, rows)
+
+    def test_unknown(self):
+        with open(self.path('notes.txt'), 'w') as f:
+            f.write('hello\n')
+        self.assertRaises(ValueError, loadlib.Session, self.path('notes.txt'))
+
+    def test_bad_lines_and_crlf(self):
+        filename = self.write_raw('raw.csv', self.rows)
+        with open(filename, 'rb') as f:
+            text = f.read().replace(b'\n', b'\r\n')
+        with open(filename, 'wb') as f:
+            f.write(text + b'243,232,1,2')  # a half-written last line
+        np.testing.assert_array_equal(loadlib.load(filename), self.rows)
+
+    def test_chunks(self):
+        # lines split across CHUNK_BYTES reads come out whole
+        filename = self.write_raw('raw.csv', self.rows)
+        chunk_bytes = loadlib.CHUNK_BYTES
+        loadlib.CHUNK_BYTES = 100
+        try:
+            np.testing.assert_array_equal(loadlib.load(filename), self.rows)
+        finally:
+            loadlib.CHUNK_BYTES = chunk_bytes
+
+    def test_cache(self):
+        filename = self.write_raw('raw.csv', self.rows)
+        session = loadlib.Session(filename, cache=True)
+        self.assertFalse(session.cached)
+        self.check_blocks(session, self.rows)  # writes the cache
+        self.assertTrue(os.path.exists(filename + loadlib.CACHE_SUFFIX))
+        self.assertFalse(os.path.exists(filename + loadlib.CACHE_SUFFIX +
+                                        '.tmp'))
+        session = loadlib.Session(filename, cache=True)
+        self.assertTrue(session.cached)
+        self.assertEqual(session.layout, 'raw')
+        np.testing.assert_array_equal(session.read(), self.rows)
+        self.check_blocks(session, self.rows)
+        del session  # let go of the memory map
+        # a changed CSV means the cache is out of date
+        more = make_rows(50, seed=1)
+        with open(filename, 'a') as f:
+            f.write(''.join('{},{},{},{},{},{}\n'.format(*r)
+                            for r in more.tolist()))
+        session = loadlib.Session(filename, cache=True)
+        self.assertFalse(session.cached)
+        np.testing.assert_array_equal(session.read(),
+                                      np.concatenate([self.rows, more]))
+        self.assertTrue(loadlib.Session(filename, cache=True).cached)
+
+    def test_partial_read_leaves_no_cache(self):
+        filename = self.write_raw('raw.csv', self.rows)
+        blocks = loadlib.Session(filename, cache=True).blocks(128)
+        next(blocks)
+        blocks.close()
+        self.assertFalse(os.path.exists(filename + loadlib.CACHE_SUFFIX))
+        self.assertFalse(os.path.exists(filename + loadlib.CACHE_SUFFIX +
+                                        '.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# === tests/test_olimex_emg_read.py ===
+# * Function: tests for the main program's session setup.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+import imp
+import os
+import shutil
+import tempfile
+import unittest
+import keylib
+import profilelib
+import recordlib
+from tests.test_packetlib import make_rows
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                    'olimex-emg-read.py')
+KEY_MAP = [(keylib.Base['a'], {'th_add': None, 'th_abd': None,
+                               'fi_flx': False, 'fi_ext': True}, None, 0)]
+
+
+class TestProfileSetup(unittest.TestCase):
+
+    def setUp(self):
+        # a fresh copy each time, config and all (the name has a hyphen in it)
+        self.main = imp.load_source('olimex_emg_read', MAIN)
+        self.dir = tempfile.mkdtemp()
+        self.main.config['profile_dir'] = self.dir
+        self.recording = os.path.join(self.dir, 'rec.csv')
+        recorder = recordlib.CsvRecorder(self.recording)
+        recorder.write(make_rows(100))
+        recorder.close()
+        profilelib.save('patient', self.main.config, {'fi_ext': 50.},
+                        KEY_MAP, directory=self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def session(self, *argv):
+        args = self.main.parser.parse_args(
+            ['--replay', self.recording, '--profile', 'patient'] + list(argv))
+        emg, thresholds, fits = self.main.setup(args)
+        self.addCleanup(emg.stop)
+        self.assertEqual(thresholds, {'fi_ext': 50.})
+        self.assertEqual(emg.key_map, KEY_MAP)
+        return emg
+
+    def test_gui_leaves_keys_off(self):
+        # it's up to the 'Send keyboard events' box, which starts unticked
+        self.assertFalse(self.session().sendkeys)
+
+    def test_headless_sends_keys(self):
+        self.assertTrue(self.session('--headless').sendkeys)
+
+
+if __name__ == '__main__':
+    unittest.main()
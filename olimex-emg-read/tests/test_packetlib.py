@@ -0,0 +1,109 @@
+# === tests/test_packetlib.py ===
+# * Function: tests for packetlib.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+import unittest
+import numpy as np
+import packetlib as pl
+
+
+def make_rows(n, nchans=pl.NUM_CHANS, seed=0):
+    """n decoded packets of random 10-bit samples, counter counting up."""
+    rng = np.random.RandomState(seed)
+    rows = np.empty((n, 2 + nchans), np.int32)
+    rows[:, 0] = 243
+    rows[:, 1] = np.arange(n) % 256
+    rows[:, 2:] = rng.randint(0, 1024, (n, nchans))
+    return rows
+
+
+class TestDecode(unittest.TestCase):
+
+    def test_round_trip(self):
+        for nchans in [1, 4, 5, 8]:
+            rows = make_rows(300, nchans)
+            data = pl.encode_packets(rows)
+            self.assertEqual(len(data), 300 * pl.packet_size(nchans))
+            np.testing.assert_array_equal(
+                pl.decode_packets(data, nchans=nchans), rows)
+
+    def test_known_packet(self):
+        # Ch0 = 0x3ff, Ch1 = 0x100, Ch2 = 0x0cc, Ch3 = 0x201
+        data = b'\xcc\xcc\xf3\x07\xff\x00\xcc\x01\x87'
+        np.testing.assert_array_equal(pl.decode_packets(data),
+                                      [[243, 7, 0x3ff, 0x100, 0x0cc, 0x201]])
+
+    def test_decode_into(self):
+        rows = make_rows(10)
+        out = np.zeros_like(rows)
+        self.assertIs(pl.decode_packets(pl.encode_packets(rows), out), out)
+        np.testing.assert_array_equal(out, rows)
+
+
+class TestPacketFramer(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = make_rows(200)
+        self.data = pl.encode_packets(self.rows)
+        self.size = pl.PACKET_SIZE
+
+    def feed_all(self, framer, data, step):
+        packets = b''.join(framer.feed(data[i:i + step])
+                           for i in range(0, len(data), step))
+        return pl.decode_packets(packets)
+
+    def test_any_chunking(self):
+        for step in [1, 2, 7, self.size, 100, len(self.data)]:
+            framer = pl.PacketFramer()
+            got = self.feed_all(framer, self.data, step)
+            # the last packet waits for the header after it to confirm sync
+            np.testing.assert_array_equal(got, self.rows[:len(got)])
+            self.assertGreaterEqual(len(got), len(self.rows) - 1)
+            self.assertEqual(framer.resyncs, 0)
+            self.assertEqual(framer.discarded, 0)
+
+    def test_starts_mid_packet(self):
+        framer = pl.PacketFramer()
+        got = self.feed_all(framer, self.data[4:], 16)
+        np.testing.assert_array_equal(got, self.rows[1:1 + len(got)])
+        self.assertEqual(framer.discarded, self.size - 4)
+
+    def test_resync_after_dropped_bytes(self):
+        cut = 50 * self.size + 3  # three bytes into packet 50...
+        data = self.data[:cut] + self.data[cut + 2:]  # ...two go missing
+        framer = pl.PacketFramer()
+        got = self.feed_all(framer, data, 32)
+        self.assertEqual(framer.resyncs, 1)
+        np.testing.assert_array_equal(got[:50], self.rows[:50])
+        # packet 50 still had its header, so it's handed out (mangled, but
+        # packet counter gaps take care of that); packet 51 lost its
+        # header to it, and the framer is back in step from packet 52 on
+        np.testing.assert_array_equal(got[51:],
+                                      self.rows[52:52 + len(got) - 51])
+        self.assertGreaterEqual(len(got), len(self.rows) - 2)
+
+    def test_header_bytes_in_data(self):
+        rows = make_rows(50)
+        rows[:, 2:4] = 0xcc  # a header pair in every packet's data
+        framer = pl.PacketFramer()
+        got = self.feed_all(framer, pl.encode_packets(rows)[5:], 1)
+        np.testing.assert_array_equal(got, rows[1:1 + len(got)])
+        self.assertGreaterEqual(len(got), len(rows) - 2)
+
+    def test_reset(self):
+        framer = pl.PacketFramer()
+        framer.feed(self.data[:self.size + 3])
+        framer.reset()
+        self.assertEqual(len(framer.buf), 0)
+        self.assertFalse(framer.synced)
+
+
+if __name__ == '__main__':
+    unittest.main()
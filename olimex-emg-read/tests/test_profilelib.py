@@ -0,0 +1,116 @@
+# === tests/test_profilelib.py ===
+# * Function: tests for profilelib.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import dsplib
+import profilelib
+
+CFG = {'plot_names': ['fi_ext', 'fi_flex'],
+       'indices': {'fi_ext': 2, 'fi_flex': 3},
+       'names': ['fi_ext', 'fi_flex'],
+       'sampfreq': 256, 'clock': 'ocr',
+       'mainsfreq': 50, 'notch_width': 0.5, 'filt_order': 3,
+       'hysteresis': 0.1 + 0.2, 'hold_ms': 120., 'refractory_ms': 1 / 3.,
+       'calcfg': {'rest_s': 2.5, 'gain': 1e-7}}
+RUNTIME = {'trace': 'run.trace', 'metrics_port': 8000,
+           'key_backend': 'recording', 'dsp_procs': 2,
+           'profile_dir': 'elsewhere'}
+THRESHOLDS = {'fi_ext': 12.345678901234567, 'fi_flex': 0.1}
+KEY_MAP = [('LEFT', {'fi_ext': True, 'fi_flex': False}, 'wrist', 1),
+           ('RIGHT', {'fi_ext': None, 'fi_flex': True}, 'wrist', 2)]
+CALIBRATION = {'fi_ext': {'slope': 2 / 3., 'offset': -1e-3},
+               'fi_flex': {'slope': 0.7, 'offset': 5.}}
+
+
+class TestProfiles(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.designs = dsplib.notch_designs()
+        dsplib._notch_designs.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        dsplib._notch_designs.clear()
+        dsplib.load_notch_designs(self.designs)
+
+    def save(self, name='patient', cfg=CFG):
+        return profilelib.save(name, cfg, THRESHOLDS, KEY_MAP, CALIBRATION,
+                               directory=self.dir)
+
+    def test_round_trip(self):
+        sos = dsplib.notch_sos(CFG, 512.295081967).copy()
+        self.save()
+        dsplib._notch_designs.clear()
+        profile = profilelib.load('patient', self.dir)
+        self.assertEqual(profile['config'], CFG)
+        self.assertEqual(profile['thresholds'], THRESHOLDS)
+        self.assertEqual(profile['key_map'], KEY_MAP)
+        self.assertEqual(profile['calibration'], CALIBRATION)
+        self.assertNotIn('notches', profile)
+        # the design comes back from the profile, bit for bit
+        self.assertEqual(len(dsplib.notch_designs()), 1)
+        restored = dsplib.notch_sos(CFG, 512.295081967)
+        self.assertEqual(restored.tolist(), sos.tolist())
+        self.assertFalse(restored.flags.writeable)
+
+    def test_strings_are_native(self):
+        self.save()
+        profile = profilelib.load('patient', self.dir)
+        self.assertIs(type(profile['config']['clock']), str)
+        self.assertIs(type(profile['key_map'][0][0]), str)
+
+    def test_only_patient_settings(self):
+        cfg = dict(CFG, **RUNTIME)
+        self.save(cfg=cfg)
+        with open(profilelib.path_of('patient', self.dir)) as f:
+            saved = json.load(f)['config']
+        self.assertEqual(sorted(saved), sorted(CFG))
+        # and an old profile that has them anyway doesn't bring them back
+        with open(profilelib.path_of('patient', self.dir)) as f:
+            profile = json.load(f)
+        profile['config'].update(RUNTIME)
+        with open(profilelib.path_of('patient', self.dir), 'w') as f:
+            json.dump(profile, f)
+        self.assertEqual(profilelib.load('patient', self.dir)['config'], CFG)
+
+    def test_names(self):
+        self.assertEqual(profilelib.profile_names(
+            os.path.join(self.dir, 'none')), [])
+        self.save('b')
+        self.save('a')
+        self.save('a')  # replaced
+        self.assertEqual(profilelib.profile_names(self.dir), ['a', 'b'])
+
+    def test_wrong_version(self):
+        filename = self.save()
+        with open(filename) as f:
+            profile = json.load(f)
+        profile['version'] = profilelib.VERSION + 1
+        with open(filename, 'w') as f:
+            json.dump(profile, f)
+        self.assertRaises(ValueError, profilelib.load, 'patient', self.dir)
+
+    def test_read_serial_config(self):
+        filename = os.path.join(self.dir, 'serial-config.txt')
+        with open(filename, 'w') as f:
+            f.write('# board settings\nSAMP_FREQ=256\n\n NUM_CHANS = 4 \n')
+        self.assertEqual(profilelib.read_serial_config(filename),
+                         {'samp_freq': 256, 'num_chans': 4})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# === tests/test_recordlib.py ===
+# * Function: tests for recordlib.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import packetlib as pl
+import recordlib
+import timinglib
+from tests.test_packetlib import make_rows
+
+
+class TestRecorders(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rows = make_rows(300)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_binary_header(self):
+        filename = os.path.join(self.dir, 'rec.bin')
+        recorder = recordlib.BinaryRecorder(filename, 256, {'fi_ext': 2})
+        recorder.write(self.rows)
+        recorder.close()
+        meta, length = recordlib.read_header(filename)
+        self.assertEqual(length % recordlib.BIN_ALIGN, 0)
+        self.assertEqual(meta['columns'], pl.DECODED_COLS)
+        meta, data = recordlib.read_binary(filename)
+        np.testing.assert_array_equal(data, self.rows)
+
+    def test_empty_binary(self):
+        filename = os.path.join(self.dir, 'rec.bin')
+        recordlib.BinaryRecorder(filename, 256, {}).close()
+        meta, data = recordlib.read_binary(filename)
+        self.assertIsNone(meta['ocr'])
+        self.assertEqual(data.shape, (0, 2 + pl.NUM_CHANS))
+
+    def test_record_writer(self):
+        filename = os.path.join(self.dir, 'rec.csv')
+        writer = recordlib.RecordWriter(recordlib.CsvRecorder(filename))
+        for i in range(0, len(self.rows), 32):
+            writer.put(self.rows[i:i + 32])
+        writer.close()
+        self.assertEqual(writer.samples, len(self.rows))
+        np.testing.assert_array_equal(recordlib.read_recording(filename),
+                                      self.rows)
+
+
+class TestReplaySerial(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rows = make_rows(300)
+        self.filename = os.path.join(self.dir, 'rec.csv')
+        recorder = recordlib.CsvRecorder(self.filename)
+        recorder.write(self.rows)
+        recorder.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replays_the_bytes(self):
+        ser = recordlib.ReplaySerial(self.filename, 256, speed=0)
+        ser.open()
+        data = ser.read(len(ser.stream) + 10)
+        self.assertEqual(data, pl.encode_packets(self.rows))
+        self.assertEqual(ser.read(10), b'')
+
+    def test_loop(self):
+        ser = recordlib.ReplaySerial(self.filename, 256, speed=0, loop=True)
+        size = len(pl.encode_packets(self.rows))
+        data = ser.read(size) + ser.read(size)
+        self.assertEqual(data, pl.encode_packets(self.rows) * 2)
+
+    def test_eof(self):
+        ser = recordlib.ReplaySerial(self.filename, 256, speed=0)
+        data = b''
+        while not ser.eof:
+            data += ser.read(100)
+        self.assertEqual(data, pl.encode_packets(self.rows))
+        ser = recordlib.ReplaySerial(self.filename, 256, speed=0, loop=True)
+        ser.read(len(ser.stream))
+        self.assertFalse(ser.eof)
+
+    def test_paced(self):
+        ser = recordlib.ReplaySerial(self.filename, 256)
+        self.assertEqual(ser.sampfreq, timinglib.packet_rate(256))
+        self.assertAlmostEqual(ser.rate,
+                               timinglib.packet_rate(256) * pl.PACKET_SIZE)
+        ser.timeout = 0.05
+        data = ser.read(len(ser.stream))  # only what's due by the timeout
+        self.assertLess(len(data), len(ser.stream) // 2)
+
+if __name__ == '__main__':
+    unittest.main()
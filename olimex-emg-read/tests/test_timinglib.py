@@ -0,0 +1,90 @@
+# === tests/test_timinglib.py ===
+# * Function: tests for timinglib.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+import unittest
+import numpy as np
+import timinglib
+import virtualboard
+from tests.test_packetlib import make_rows
+
+
+class TestRates(unittest.TestCase):
+
+    def test_ocr(self):
+        self.assertEqual(timinglib.ocr_value(256), 243)
+        self.assertAlmostEqual(timinglib.packet_rate(256),
+                               16e6 / (128 * 244))
+        self.assertAlmostEqual(timinglib.ocr_rate(243, 256),
+                               timinglib.packet_rate(256))
+
+    def test_expected_rate(self):
+        self.assertEqual(timinglib.expected_rate(
+            {'sampfreq': 256, 'clock': 'nominal'}), 256.)
+        self.assertEqual(timinglib.expected_rate(
+            {'sampfreq': 256, 'clock': 'ocr'}), timinglib.packet_rate(256))
+
+    def test_virtual_board_agrees(self):
+        board = virtualboard.VirtualBoard(256)
+        self.assertEqual(board.ocr, 243)
+        self.assertEqual(board.rate, timinglib.packet_rate(256))
+
+
+class TestSampleClock(unittest.TestCase):
+
+    def test_timestamps(self):
+        clock = timinglib.SampleClock(256)
+        rows = make_rows(600)
+        diffs, stamp = clock.update(rows[:100], now=10.)
+        self.assertTrue((diffs == 1).all())
+        self.assertEqual(stamp.sample, 0)
+        self.assertEqual(stamp.rate, timinglib.packet_rate(256))
+        # the last packet of the first block is taken to arrive as it's sent
+        self.assertAlmostEqual(clock.time_of(99), 10.)
+        diffs, stamp = clock.update(rows[100:], now=99.)  # arrival jitter
+        self.assertEqual(stamp.sample, 100)
+        self.assertAlmostEqual(stamp.time, 10. + 1. / stamp.rate)
+        self.assertEqual(clock.mismatch(), 0.)
+
+    def test_gaps_and_wrap(self):
+        clock = timinglib.SampleClock(256)
+        rows = make_rows(600)  # the counter wraps at 256
+        rows = np.delete(rows, [300, 301, 302], axis=0)
+        clock.update(rows[:250], now=0.)
+        diffs, stamp = clock.update(rows[250:], now=1.)
+        self.assertEqual(stamp.samples, 350)
+        self.assertEqual(diffs.tolist().count(4), 1)
+        self.assertEqual((clock.gaps, clock.missed), (1, 3))
+        gap = [e for e in clock.events if e['type'] == 'gap'][0]
+        self.assertEqual((gap['sample'], gap['missed']), (300, 3))
+
+    def test_nominal_source(self):
+        clock = timinglib.SampleClock(256, source='nominal')
+        diffs, stamp = clock.update(make_rows(10), now=0.)
+        self.assertEqual(stamp.rate, 256.)
+        self.assertAlmostEqual(clock.mismatch(),
+                               timinglib.packet_rate(256) / 256. - 1.)
+
+    def test_rate_change(self):
+        clock = timinglib.SampleClock(256)
+        rows = make_rows(20)
+        clock.update(rows[:10], now=0.)
+        t = clock.time_of(10)
+        rows[10:, 0] = 121  # twice as fast
+        diffs, stamp = clock.update(rows[10:], now=1.)
+        self.assertAlmostEqual(stamp.rate, 2 * timinglib.packet_rate(256))
+        self.assertAlmostEqual(stamp.time, t)  # no jump at the change
+
+    def test_unknown_source(self):
+        self.assertRaises(ValueError, timinglib.SampleClock, 256, 'gps')
+
+
+if __name__ == '__main__':
+    unittest.main()
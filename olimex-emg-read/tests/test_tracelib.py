@@ -0,0 +1,64 @@
+# === tests/test_tracelib.py ===
+# * Function: tests for tracelib.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import tracelib
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tracer = tracelib.Tracer(os.path.join(self.dir, 'trace.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_mark_at_arrival(self):
+        # read marked when the bytes came in, 20 ms before anything else
+        received = time.time() - 0.02
+        self.tracer.mark(0, 'read', received)
+        self.tracer.mark(0, 'dsp')
+        latency = self.tracer.summary()['dsp']['max']
+        self.assertGreaterEqual(latency, 19.)
+        self.assertLess(latency, 1000.)
+
+    def test_last_mark_wins(self):
+        t = time.time()
+        self.tracer.mark(64, 'read', t)
+        self.tracer.mark(64, 'keys', t + 0.001)
+        self.tracer.mark(64, 'keys', t + 0.004)
+        self.assertAlmostEqual(self.tracer.summary()['keys']['max'], 4.,
+                               places=3)
+
+    def test_close(self):
+        t = time.time()
+        for block in [0, 64]:
+            self.tracer.mark(block, 'read', t)
+            self.tracer.mark(block, 'dsp', t + 0.002)
+            self.tracer.mark(block, 'detect', t + 0.003)
+        summary = self.tracer.close()
+        self.assertEqual(sorted(summary), ['detect', 'dsp'])
+        self.assertEqual(summary['dsp']['count'], 2)
+        with open(self.tracer.filename) as f:
+            trace = json.load(f)
+        slices = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual(len(slices), 4)
+        self.assertEqual(len(tracelib.format_summary(summary)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+# === timinglib.py ===
+# * Function: sample clock and timestamps for olimex-emg-read.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""A library for working out when each sample was taken.
+
+Every packet carries the OCR value the firmware's timer runs with and an
+8-bit packet counter. The counter is unwrapped into a monotonic sample
+number (missed packets included), and the OCR value gives the rate the
+board really samples at, which is not quite the SAMP_FREQ it was built
+with. Timer2 is in CTC mode and the ISR sends a packet on every compare
+match, so packets go out at
+    F_CPU / (N * (1 + OCR))
+with N the prescaler - twice the f_OC2A of setSampleFreq()'s datasheet
+formula. With SAMP_FREQ 256 that's 512.3 Hz (as in serial-config.txt).
+The config's 'sampfreq' is SAMP_FREQ, so everything that needs the real
+rate (filters, detection timing, replay) goes through packet_rate() or
+expected_rate() rather than using it as it is.
+"""
+
+import time
+from collections import deque, namedtuple
+import numpy as np
+
+F_CPU = 16000000  # Arduino Uno clock, Hz
+MIN_F_64PRE = 488  # minimum samp freq when prescaler=64
+
+# when a block was sampled: sample number of its first sample (counting
+# missed ones), number of samples including missed ones, time of its first
+# sample (time.time() scale), the sample rate used, and when the block
+# arrived (for latency)
+Stamp = namedtuple('Stamp', 'sample samples time rate received')
+
+
+def ocr_value(samp_freq):
+    """The OCR value setSampleFreq() in the firmware works out for samp_freq."""
+    ocr = F_CPU // 2 // 64 // samp_freq - 1
+    if samp_freq < MIN_F_64PRE:
+        ocr >>= 1  # prescaler goes to 128
+    return min(max(ocr, 0), 255)
+
+
+def ocr_rate(ocr, samp_freq):
+    """The packet rate of a board sending ocr, built with SAMP_FREQ samp_freq.
+
+    samp_freq only decides the prescaler, as in setSampleFreq().
+    """
+    prescaler = 128 if samp_freq < MIN_F_64PRE else 64
+    return F_CPU / float(prescaler * (ocr + 1))
+
+
+def packet_rate(samp_freq):
+    """The packet rate of a board built with SAMP_FREQ samp_freq."""
+    return ocr_rate(ocr_value(samp_freq), samp_freq)
+
+
+def expected_rate(cfg):
+    """The rate samples should come at, going by cfg's sampfreq and clock.
+
+    That's what the DSP is set up for before the first packet, and all
+    along if the board's OCR value agrees (see SampleClock).
+    """
+    if cfg['clock'] == 'ocr':
+        return packet_rate(cfg['sampfreq'])
+    return float(cfg['sampfreq'])
+
+
+class SampleClock(object):
+    """Turns the packet counter into sample numbers and timestamps.
+
+    The clock starts on the first block after reset(): its last packet is
+    taken to have been sampled when the block arrived, and from then on
+    sample k was taken k / rate seconds after sample 0. That way jitter in
+    when blocks arrive never shows up in the timestamps.
+
+    Missed packets and changes of rate are kept as events, dicts with a
+    'type' ('gap' or 'rate'), the 'sample' number and 'time' they happened
+    at, and details; only the latest max_events are kept.
+    """
+
+    def __init__(self, nominal, source='ocr', max_events=1024):
+        """Constructor.
+
+        nominal: the sample rate in the config, Hz (the firmware's SAMP_FREQ).
+        source: 'ocr' to use the rate worked out from the OCR value (until
+        the first packet, the rate SAMP_FREQ nominal gives), 'nominal' to
+        use nominal regardless.
+        """
+        if source not in ('ocr', 'nominal'):
+            raise ValueError('unknown clock source: {}'.format(source))
+        self.nominal = nominal
+        self.source = source
+        self.expected = expected_rate({'sampfreq': nominal, 'clock': source})
+        self.events = deque(maxlen=max_events)
+        self.reset()
+
+    def reset(self):
+        """Start again from sample 0, i.e. for a new stream."""
+        self.rate = self.expected
+        self.ocr = None
+        self.sample = 0  # sample number of the next sample
+        self.prev_count = None
+        self.t0 = None  # time of sample 0
+        # stats
+        self.gaps = 0  # number of gaps
+        self.missed = 0  # packets missed in them
+
+    def time_of(self, sample):
+        """Time sample number `sample` was taken, time.time() scale."""
+        return self.t0 + sample / self.rate
+
+    def update(self, block, now=None):
+        """Take in a block of decoded packets, as it arrives.
+
+        now: when it arrived, default time.time().
+        Returns (diffs, stamp): the packet counter step before each packet
+        (1 unless packets were missed) and the block's Stamp.
+        """
+        if now is None:
+            now = time.time()
+        counts = block[:, 1]
+        if self.prev_count is None:  # on first sample, force diff to 1
+            self.prev_count = counts[0] - 1
+        diffs = np.diff(counts, prepend=self.prev_count) % 256
+        diffs[diffs == 0] = 256  # a whole counter cycle went missing
+        self.prev_count = counts[-1]
+        samples = int(diffs.sum())
+        ocr = int(block[-1, 0])
+        if ocr != self.ocr:
+            self._set_rate(ocr, now)
+        if self.t0 is None:
+            self.t0 = now - (samples - 1) / self.rate
+        first = self.sample
+        gaps = np.flatnonzero(diffs != 1)
+        if len(gaps):
+            ends = first + np.cumsum(diffs) - 1  # sample number of each packet
+            for i in gaps.tolist():
+                missed = int(diffs[i]) - 1
+                start = int(ends[i]) - missed
+                self.events.append({'type': 'gap', 'sample': start,
+                                    'time': self.time_of(start),
+                                    'missed': missed})
+            self.gaps += len(gaps)
+            self.missed += samples - len(diffs)
+        self.sample += samples
+        return diffs, Stamp(first, samples, self.time_of(first), self.rate, now)
+
+    def _set_rate(self, ocr, now):
+        """The OCR value changed (or turned up for the first time)."""
+        rate = ocr_rate(ocr, self.nominal)
+        if self.source == 'ocr' and self.t0 is not None:
+            # keep the timestamp of the next sample where it was
+            self.t0 = self.time_of(self.sample) - self.sample / rate
+        if self.source == 'ocr':
+            self.rate = rate
+        self.ocr = ocr
+        self.events.append({'type': 'rate', 'sample': self.sample,
+                            'time': now, 'ocr': ocr, 'rate': rate,
+                            'nominal': self.nominal})
+
+    def mismatch(self):
+        """How far the OCR rate is off the expected one, i.e. 0.01 = 1% fast.
+
+        Not 0 if the board was built with another SAMP_FREQ (or, with
+        source 'nominal', because SAMP_FREQ isn't the packet rate).
+        """
+        if self.ocr is None:
+            return 0.
+        return ocr_rate(self.ocr, self.nominal) / self.expected - 1.
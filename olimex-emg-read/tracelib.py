@@ -0,0 +1,111 @@
+# === tracelib.py ===
+# * Function: end-to-end latency tracing for olimex-emg-read.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""A library for timing each block of samples through the pipeline.
+
+When tracing is on, each stage marks a block (by its sample number, see
+timinglib.Stamp) as it finishes with it:
+    read    its bytes came in off the serial port (Stamp.received)
+    dsp     filtered, spectrum and detection done
+    detect  channel states updated
+    keys    keyboard events sent, by keylib's output thread once the
+            backend call returned (only blocks that changed a key)
+    plot    drawn (only the newest block at each plot update)
+close() writes the marks out as a Chrome trace (open it in
+chrome://tracing or https://ui.perfetto.dev) and returns p50/p95/p99
+latency from 'read' to each later stage. Marking is one list append, so
+tracing changes the timings it measures as little as possible.
+"""
+
+import json
+import time
+import numpy as np
+
+STAGES = ['read', 'dsp', 'detect', 'keys', 'plot']
+clock = getattr(time, 'monotonic', time.time)  # python 2 has no monotonic
+
+
+class Tracer(object):
+    """Collects stage marks for blocks; writes them out on close()."""
+
+    def __init__(self, filename, max_marks=1000000):
+        """Constructor. Stops marking (silently) after max_marks marks."""
+        self.filename = filename
+        self.max_marks = max_marks
+        self.marks = []  # (block, stage, time)
+        self.t0 = clock()
+        self.offset = self.t0 - time.time()  # time.time() to clock()
+
+    def mark(self, block, stage, when=None):
+        """Note that stage is done with block (a sample number), now or at
+        `when` (time.time() scale, i.e. Stamp.received)."""
+        if len(self.marks) < self.max_marks:
+            t = clock() if when is None else when + self.offset
+            self.marks.append((block, stage, t))
+
+    def blocks(self):
+        """Return {block: {stage: time}} for every block marked so far."""
+        out = {}
+        for block, stage, t in list(self.marks):
+            out.setdefault(block, {})[stage] = t
+        return out
+
+    def summary(self, blocks=None):
+        """Latency from 'read' to each later stage: count, p50/p95/p99/max ms."""
+        if blocks is None:
+            blocks = self.blocks()
+        summary = {}
+        for stage in STAGES[1:]:
+            lat = np.array([b[stage] - b['read'] for b in blocks.values()
+                            if 'read' in b and stage in b])
+            if not len(lat):
+                continue
+            ms = np.percentile(1e3 * lat, [50, 95, 99])
+            summary[stage] = {'count': len(lat), 'p50': ms[0], 'p95': ms[1],
+                              'p99': ms[2], 'max': 1e3 * lat.max()}
+        return summary
+
+    def close(self):
+        """Write the trace file; return the summary."""
+        blocks = self.blocks()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                   'args': {'name': stage}} for tid, stage in enumerate(STAGES)]
+        for block, stages in sorted(blocks.items()):
+            done = sorted((t, stage) for stage, t in stages.items())
+            # one slice per stage, from the stage before it to this one
+            for (t_prev, prev), (t, stage) in zip(done, done[1:]):
+                events.append({'name': stage, 'ph': 'X', 'pid': 1,
+                               'tid': STAGES.index(stage),
+                               'ts': 1e6 * (t_prev - self.t0),
+                               'dur': 1e6 * (t - t_prev),
+                               'args': {'block': block, 'from': prev}})
+            if done:
+                t, stage = done[0]
+                events.append({'name': stage, 'ph': 'i', 's': 't', 'pid': 1,
+                               'tid': STAGES.index(stage),
+                               'ts': 1e6 * (t - self.t0),
+                               'args': {'block': block}})
+        summary = self.summary(blocks)
+        with open(self.filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'latency_ms': summary}}, f)
+        return summary
+
+
+def format_summary(summary):
+    """The summary from Tracer.close() as lines of text."""
+    lines = []
+    for stage in STAGES[1:]:
+        if stage in summary:
+            lines.append('read -> {}: p50 {p50:.2f} p95 {p95:.2f} p99 {p99:.2f} '
+                         'max {max:.2f} ms ({count} blocks)'.format(
+                             stage, **summary[stage]))
+    return lines
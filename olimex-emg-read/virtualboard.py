@@ -0,0 +1,227 @@
+# === virtualboard.py ===
+# * Function: a software stand-in for olimex-emg-transmit.ino.
+# *
+# * This is part of Christian D'Abrera's engineering final
+# * year project titled "EMG Bio-feedback for rehabilitation".
+# *
+# * Christian D'Abrera
+# * Curtin University 2017
+# * christian.dabrera@student.curtin.edu.au
+# * chrisdabrera@gmail.com
+
+"""A virtual Olimex board, for load testing olimex-emg-read without hardware.
+
+Sends the same packets as olimex-emg-transmit.ino over a pseudo-terminal
+(posix only), so the reader can be pointed at it like a real port:
+    python virtualboard.py --rate 4096 --drop 0.001
+    python olimex-emg-read.py /dev/pts/5
+Packets can be dropped (the counter still advances, as if the PC missed
+them) and bytes corrupted, to exercise resync and gap interpolation.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import errno
+import argparse
+from threading import Thread
+import numpy as np
+import packetlib as pl
+from timinglib import ocr_value, ocr_rate
+
+
+def dummy_cycle(nchans=pl.NUM_CHANS):
+    """Run the firmware's DUMMY pulse generator until it starts repeating.
+
+    A straight port of dummyRead() and the dummy part of togglePins().
+    Returns (lead_in, cycle): (N, nchans) arrays of ADC values for the samples
+    after reset that never come round again, then the repeating part.
+    """
+    dummy_counter, dummy_index, dummy_offset = 1, 0, 0
+    send_dummy, direction, count = False, 1, 3
+    seen = {}
+    rows = []
+    while True:
+        state = (dummy_counter, dummy_index, dummy_offset,
+                 send_dummy, direction, count)
+        if state in seen:
+            rows = np.array(rows, np.int32)
+            return rows[:seen[state]], rows[seen[state]:]
+        seen[state] = len(rows)
+        row = []
+        for i in range(nchans):  # dummyRead(i)
+            result = 512
+            if not dummy_counter:
+                send_dummy = True
+            if send_dummy:
+                if i == dummy_index:
+                    result += dummy_offset
+                dummy_offset += direction
+                if dummy_offset == 255:
+                    direction = -1
+                elif dummy_offset == 0:
+                    direction = 1
+                    send_dummy = False
+                    dummy_index = (dummy_index + 1) % nchans
+            row.append(result)
+        rows.append(row)
+        count -= 1  # togglePins()
+        if not count:
+            count = 15
+        if not count % 4:
+            dummy_counter = (dummy_counter + 1) % 256
+
+
+class VirtualBoard(object):
+    """Generates firmware-accurate packets for a given SAMP_FREQ.
+
+    Like the firmware, the board sends packets at the rate its OCR value
+    works out to (see timinglib.ocr_rate), i.e. 512.3 Hz for SAMP_FREQ 256;
+    that's self.rate.
+    generate() can be used on its own (i.e. for benchmarks); start() also
+    opens a pseudo-terminal and streams to it in real time from a thread.
+    """
+
+    def __init__(self, samp_freq=256, dummy=False, drop=0., corrupt=0.,
+                 mainsfreq=50, seed=None, nchans=pl.NUM_CHANS):
+        """Constructor.
+
+        samp_freq: SAMP_FREQ in the firmware, Hz - anything, not just what
+        the Uno can do, but it goes through setSampleFreq()'s OCR value.
+        nchans: channels per packet, as NUM_CHANS in the firmware.
+        dummy: send the firmware's DUMMY pulses instead of noise and hum.
+        drop: chance of each packet going missing.
+        corrupt: chance of each packet having one byte overwritten.
+        """
+        self.samp_freq = samp_freq
+        self.ocr = ocr_value(samp_freq)
+        self.rate = ocr_rate(self.ocr, samp_freq)  # packets/s
+        self.nchans = nchans
+        self.packet_size = pl.packet_size(nchans)
+        self.drop = drop
+        self.corrupt = corrupt
+        self.mainsfreq = mainsfreq
+        self.rng = np.random.RandomState(seed)
+        self.dummy = dummy_cycle(nchans) if dummy else None
+        self.sample = 0  # samples generated so far
+        self.port = None
+        self.running = False
+        self.thread = None
+        # stats
+        self.packets_sent = 0
+        self.packets_dropped = 0  # dropped on purpose
+        self.packets_corrupted = 0
+        self.bytes_overrun = 0  # bytes the reader didn't take in time
+
+    def adc_values(self, n):
+        """Return the next n samples of ADC readings, (n, nchans)."""
+        idx = np.arange(self.sample, self.sample + n)
+        if self.dummy is not None:
+            lead_in, cycle = self.dummy
+            looped = cycle[(idx - len(lead_in)) % len(cycle)]
+            early = idx < len(lead_in)
+            looped[early] = lead_in[idx[early]]
+            return looped
+        # resting EMG: noise plus some mains hum for the notch to chew on
+        hum = 40. * np.sin(2 * np.pi * self.mainsfreq * idx / float(self.rate))
+        noise = self.rng.normal(0., 8., (n, self.nchans))
+        return np.clip(512 + hum[:, np.newaxis] + noise, 0, 1023).astype(np.int32)
+
+    def generate(self, n):
+        """Return the bytes for the next n packets, drops and corruption included."""
+        rows = np.empty((n, 2 + self.nchans), np.int32)
+        rows[:, 0] = self.ocr
+        rows[:, 1] = np.arange(self.sample, self.sample + n) % 256
+        rows[:, 2:] = self.adc_values(n)
+        self.sample += n
+        if self.drop:
+            keep = self.rng.random_sample(n) >= self.drop
+            self.packets_dropped += n - keep.sum()
+            rows = rows[keep]
+        data = np.frombuffer(pl.encode_packets(rows), np.uint8).copy()
+        if self.corrupt and len(rows):
+            hit = np.flatnonzero(self.rng.random_sample(len(rows)) < self.corrupt)
+            offsets = hit * self.packet_size + self.rng.randint(
+                0, self.packet_size, len(hit))
+            data[offsets] = self.rng.randint(0, 256, len(hit))
+            self.packets_corrupted += len(hit)
+        self.packets_sent += len(rows)
+        return data.tobytes()
+
+    def start(self, tick=0.005):
+        """Open a pseudo-terminal and start streaming to it. Returns its path."""
+        import pty
+        import tty
+        master, slave = pty.openpty()
+        tty.setraw(slave)  # no newline translation, echo etc.
+        self._master, self._slave = master, slave
+        self.port = os.ttyname(slave)
+        self.running = True
+        self.thread = Thread(target=self._stream, args=(tick,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        """Stop streaming and close the pseudo-terminal."""
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            os.close(self._master)
+            os.close(self._slave)
+            self.thread = None
+
+    def _stream(self, tick):
+        import fcntl
+        # never block: a real board doesn't wait for the PC either
+        flags = fcntl.fcntl(self._master, fcntl.F_GETFL)
+        fcntl.fcntl(self._master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        t0 = time.time()
+        start = self.sample
+        while self.running:
+            due = start + int((time.time() - t0) * self.rate) - self.sample
+            if due > 0:
+                data = self.generate(due)
+                try:
+                    written = os.write(self._master, data)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    written = 0
+                self.bytes_overrun += len(data) - written
+            time.sleep(tick)
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-r", "--rate", type=int, default=256,
+                        help="SAMP_FREQ, Hz (packets go out at the rate \
+                              its OCR value gives, i.e. 512.3 Hz for 256)")
+    parser.add_argument("--dummy", action="store_true",
+                        help="send the firmware's DUMMY pulses")
+    parser.add_argument("--drop", type=float, default=0.,
+                        help="chance of dropping each packet")
+    parser.add_argument("--corrupt", type=float, default=0.,
+                        help="chance of corrupting a byte in each packet")
+    parser.add_argument("-n", "--nchans", type=int, default=pl.NUM_CHANS,
+                        help="channels per packet")
+    args = parser.parse_args()
+    board = VirtualBoard(args.rate, args.dummy, args.drop, args.corrupt,
+                         nchans=args.nchans)
+    print('Virtual board on {} at {:.1f} Hz (SAMP_FREQ {}, OCR {}). '
+          'Ctrl+C to stop.'.format(board.start(), board.rate, args.rate,
+                                   board.ocr))
+    try:
+        while True:
+            time.sleep(5)
+            print('sent {}, dropped {}, corrupted {}, overrun {} bytes'.format(
+                board.packets_sent, board.packets_dropped,
+                board.packets_corrupted, board.bytes_overrun))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        board.stop()
+
+
+if __name__ == '__main__':
+    _main()
@@ -1,4 +1,4 @@
-/* Code for sampling 4 channels of EMG signals using the
+/* Code for sampling NUM_CHANS (4 by default) channels of EMG signals using the
  * Olimex 'EMG EKG' Arduino shield on an Arduino Uno.
  * 
  * This is part of Christian D'Abrera's engineering final
@@ -32,7 +32,9 @@
 #define SAMP_FREQ 256
 #define LED_PIN  13
 #define CAL_SIG_PIN 9
-#define PACKET_SIZE 9
+#define NUM_CHANS 4 // ADC channels sent, A0 upwards (6 at most on an Uno)
+#define MSB_BYTES ((NUM_CHANS + 3) / 4) // 2 high bits per channel
+#define PACKET_SIZE (4 + NUM_CHANS + MSB_BYTES) // headers, OCR, counter, data
 #define BAUDRATE 115200
 #define MIN_F_64PRE 488 // minimum samp freq when prescaler=64
 
@@ -81,7 +83,7 @@ int dummyRead(byte i){
     } else if (dummy_offset == 0) {
       dir = 1;
       send_dummy = false;
-      dummy_index = (++dummy_index) % 4;
+      dummy_index = (++dummy_index) % NUM_CHANS;
     }
   }
   return result;
@@ -199,22 +201,27 @@ ISR(TIMER2_COMPA_vect){
   Serial.write(TXData[1]);
   Serial.write(TXData[2]);
   Serial.write(TXData[3]++); // increment packet counter
-  // Read 4 ADC channels
+  // Read NUM_CHANS ADC channels
   byte i = 0;
-  TXData[8] = 0; // initialize combined MSBs
-  for(i=0;i<4;i++){
+  for(i=0;i<MSB_BYTES;i++){
+    TXData[4 + NUM_CHANS + i] = 0; // initialize combined MSBs
+  }
+  for(i=0;i<NUM_CHANS;i++){
 #ifdef DUMMY
     ADC_val = dummyRead(i);
 #else
     ADC_val = analogRead(i); // read ADC channel i
 #endif
     byte hiBits = (byte)(ADC_val >> 8); // get MSBs
-    TXData[8] |= (hiBits << (2 * i)); // Lshift 2i times & store
+    // 4 channels per MSB byte, Lshift 2(i%4) times & store
+    TXData[4 + NUM_CHANS + i / 4] |= (hiBits << (2 * (i % 4)));
     TXData[4 + i] = (byte)ADC_val; // store LSBs
     Serial.write(TXData[4 + i]); // send LSBs
   }
   // send high bits
-  Serial.write(TXData[8]); // send combined MSBs
+  for(i=0;i<MSB_BYTES;i++){
+    Serial.write(TXData[4 + NUM_CHANS + i]); // send combined MSBs
+  }
 
   // Toggle LED and CAL_SIG_PIN at SAMPFREQ/8
   togglePins();